@@ -1,36 +1,458 @@
 # Importiamo le librerie necessarie
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
 from sentence_transformers import SentenceTransformer
 from PIL import Image
+from collections import OrderedDict
+from concurrent.futures import Future
+import diskcache
+import numpy as np
 import base64
+import hashlib
 import io
+import itertools
+import os
+import queue
+import threading
+import time
+import unicodedata
+import uuid
 
 # -----------------------------------------------------------------------------
 # 1. INIZIALIZZAZIONE DELL'APPLICAZIONE E DEL MODELLO
 # -----------------------------------------------------------------------------
 app = Flask(__name__)
- 
+
+# Metriche in formato Prometheus, esposte su /metrics. Con più worker di Gunicorn
+# ogni processo scrive i propri valori in PROMETHEUS_MULTIPROC_DIR e /metrics
+# restituisce la somma di tutti i worker.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+ITEM_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 4096)
+REQUEST_SECONDS = Histogram(
+    "embedding_request_seconds", "Durata delle richieste a /create-embedding", ["kind"], buckets=LATENCY_BUCKETS
+)
+REQUEST_ITEMS = Histogram("embedding_request_items", "Elementi per richiesta a /create-embedding", ["kind"], buckets=ITEM_BUCKETS)
+BATCH_SIZE = Histogram("embedding_batch_size", "Elementi codificati in una singola chiamata al modello", buckets=ITEM_BUCKETS)
+QUEUE_WAIT_SECONDS = Histogram(
+    "embedding_queue_wait_seconds", "Attesa di un elemento nella coda del micro-batching", buckets=LATENCY_BUCKETS
+)
+ENCODE_SECONDS = Histogram("embedding_encode_seconds", "Durata di una chiamata al modello", buckets=LATENCY_BUCKETS)
+CACHE_LOOKUPS = Counter("embedding_cache_lookups_total", "Ricerche nella cache degli embedding, per esito", ["result"])
+
+# X-Request-ID ricevuto dall'orchestratore, oppure uno nuovo per i client che non
+# lo inviano: prefissa i log di /create-embedding e torna nell'header della risposta.
+REQUEST_ID_HEADER = "X-Request-ID"
+
+
+@app.before_request
+def assign_request_id():
+    g.request_id = (request.headers.get(REQUEST_ID_HEADER) or "").strip()[:64] or uuid.uuid4().hex
+
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers[REQUEST_ID_HEADER] = g.request_id
+    return response
+
 # Definiamo il percorso che useremo per la cache del modello.
-# Questo percorso deve corrispondere al volume emptyDir che configurerai su OpenShift.
-MODEL_CACHE_PATH = "/app//model_cache"
+# Questo percorso deve corrispondere al volume emptyDir che configurerai su OpenShift;
+# fuori dal container (es. nel benchmark) si indica una cartella scrivibile con MODEL_CACHE_PATH.
+MODEL_CACHE_PATH = os.getenv("MODEL_CACHE_PATH", "/app/model_cache")
+EMBEDDING_MODEL_NAME = 'clip-ViT-B-32'
+# Cartella con il modello già salvato (es. incluso nell'immagine con BAKE_MODEL=true).
+# Se esiste, il modello viene caricato da lì senza alcuna richiesta all'Hugging Face Hub;
+# altrimenti si torna al download nella cache (MODEL_CACHE_PATH).
+EMBEDDING_MODEL_PATH = os.getenv("EMBEDDING_MODEL_PATH", "")
+# Backend di calcolo: "torch" (sentence-transformers) oppure "onnx" (ONNX Runtime, vedi
+# onnx_backend.py). L'API /create-embedding è la stessa per entrambi.
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").lower()
+# Cartella dei modelli ONNX già esportati (es. inclusa nell'immagine con BAKE_MODEL=true).
+# Se non esiste si usa MODEL_CACHE_PATH/onnx, dove i modelli mancanti vengono esportati
+# dal modello PyTorch al primo avvio.
+EMBEDDING_ONNX_PATH = os.getenv("EMBEDDING_ONNX_PATH", "")
+if not (EMBEDDING_ONNX_PATH and os.path.isdir(EMBEDDING_ONNX_PATH)):
+    EMBEDDING_ONNX_PATH = os.path.join(MODEL_CACHE_PATH, "onnx")
+# Con "true" si usano i modelli ONNX quantizzati in int8
+EMBEDDING_ONNX_QUANTIZE = os.getenv("EMBEDDING_ONNX_QUANTIZE", "true").lower() in ("1", "true", "yes")
+# Thread di ONNX Runtime per ogni worker (0 = scelta automatica di ONNX Runtime)
+EMBEDDING_ONNX_THREADS = int(os.getenv("EMBEDDING_ONNX_THREADS", "0"))
+BACKENDS = ("torch", "onnx")
+
+
+def load_sentence_transformer():
+    if EMBEDDING_MODEL_PATH and os.path.isdir(EMBEDDING_MODEL_PATH):
+        print(f"Caricamento del modello di embedding dalla cartella locale {EMBEDDING_MODEL_PATH}...")
+        return SentenceTransformer(EMBEDDING_MODEL_PATH, local_files_only=True)
+    if EMBEDDING_MODEL_PATH:
+        print(f"ATTENZIONE: cartella del modello {EMBEDDING_MODEL_PATH} non trovata, uso la cache in {MODEL_CACHE_PATH}.")
+    print("Caricamento del modello di embedding CLIP in corso...")
+    return SentenceTransformer(
+        EMBEDDING_MODEL_NAME,
+        cache_folder=MODEL_CACHE_PATH  # <-- Configurazione esplicita della cache
+    )
+
+
+def load_model():
+    if EMBEDDING_BACKEND not in BACKENDS:
+        raise ValueError(f"Backend non valido: {EMBEDDING_BACKEND} (usa uno tra {', '.join(BACKENDS)})")
+    if EMBEDDING_BACKEND == "torch":
+        return load_sentence_transformer()
+
+    from onnx_backend import OnnxClipEncoder, export, quantize_models, model_files
+    if not all(os.path.exists(path) for path in model_files(EMBEDDING_ONNX_PATH, EMBEDDING_ONNX_QUANTIZE)):
+        if EMBEDDING_ONNX_QUANTIZE and all(os.path.exists(path) for path in model_files(EMBEDDING_ONNX_PATH, False)):
+            quantize_models(EMBEDDING_ONNX_PATH)
+        else:
+            print(f"Modelli ONNX non trovati in {EMBEDDING_ONNX_PATH}: esportazione dal modello PyTorch...")
+            export(load_sentence_transformer(), EMBEDDING_ONNX_PATH, EMBEDDING_ONNX_QUANTIZE)
+    print(f"Caricamento del modello ONNX{' int8' if EMBEDDING_ONNX_QUANTIZE else ''} da {EMBEDDING_ONNX_PATH}...")
+    return OnnxClipEncoder(EMBEDDING_ONNX_PATH, EMBEDDING_ONNX_QUANTIZE, EMBEDDING_ONNX_THREADS)
+
 
 # Carica il modello CLIP, specificando esplicitamente la cartella della cache.
 # Questa operazione scaricherà il modello la prima volta e verrà eseguita
-# una sola volta all'avvio del container.
-print("Caricamento del modello di embedding CLIP in corso...")
+# una sola volta all'avvio del container. Con "gunicorn --preload" (vedi
+# gunicorn.conf.py) il caricamento avviene nel processo master prima del fork:
+# i worker condividono i pesi in copy-on-write invece di caricarne una copia ciascuno.
 try:
-    model = SentenceTransformer(
-        'clip-ViT-B-32',
-        cache_folder=MODEL_CACHE_PATH  # <-- Configurazione esplicita della cache
-    )
-    print("Modello CLIP caricato con successo. ✅")
+    model = load_model()
+    print(f"Modello CLIP caricato con successo (backend {EMBEDDING_BACKEND}). ✅")
 except Exception as e:
     print(f"ERRORE CRITICO durante il caricamento del modello CLIP: {e}")
     model = None
 
+
+class Warmup:
+    """Prima codifica (un testo e un'immagine) eseguita in background in ogni worker.
+
+    Non va eseguita nel master prima del fork: il pool di thread di PyTorch/OpenMP
+    creato da una codifica non è utilizzabile in sicurezza nei processi figli.
+    Finché non è completata, /ready risponde 503.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+        self.duration_s = None
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def start(self):
+        # Idempotente: un solo warmup per processo
+        with self._lock:
+            if self._pid == os.getpid() or model is None:
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name="embedding-warmup", daemon=True).start()
+
+    def _run(self):
+        started = time.perf_counter()
+        try:
+            model.encode(["warmup"])
+            model.encode([Image.new("RGB", (224, 224))])
+        except Exception as e:
+            print(f"Errore durante il warmup del modello di embedding: {e}")
+            self.error = str(e)
+            return
+        self.duration_s = round(time.perf_counter() - started, 3)
+        print(f"Warmup del modello di embedding completato in {self.duration_s}s (pid {os.getpid()}).")
+        self.done.set()
+
+
+warmup = Warmup()
+
 # -----------------------------------------------------------------------------
-# 2. DEFINIZIONE DELL'ENDPOINT PER CREARE GLI EMBEDDING
+# 2. MICRO-BATCHING DELLE RICHIESTE
 # -----------------------------------------------------------------------------
+# Numero massimo di elementi (testi o immagini) passati a una singola chiamata model.encode.
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "64"))
+# Finestra di attesa (in millisecondi) entro cui le richieste concorrenti vengono unite.
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "5"))
+# Numero massimo di elementi accettati in una singola richiesta HTTP.
+EMBEDDING_MAX_REQUEST_ITEMS = int(os.getenv("EMBEDDING_MAX_REQUEST_ITEMS", "4096"))
+# Invecchiamento della priorità, in elementi per secondo di attesa: una richiesta di N
+# elementi resta dietro a quelle più piccole arrivate dopo al più (N - 1) / valore secondi.
+EMBEDDING_PRIORITY_AGING = float(os.getenv("EMBEDDING_PRIORITY_AGING", "100"))
+
+
+class MicroBatcher:
+    """Unisce gli elementi di richieste concorrenti in poche chiamate a model.encode.
+
+    Ogni richiesta HTTP deposita i propri elementi in una coda e attende i risultati;
+    un thread dedicato raccoglie gli elementi arrivati entro la finestra di batching
+    e li codifica insieme, al massimo max_batch_size per chiamata. Le richieste più
+    piccole (es. la domanda di una chat) hanno la precedenza su quelle grandi
+    (es. l'indicizzazione di un PDF), così non restano in coda dietro centinaia di chunk;
+    con aging_rate > 0 l'attesa conta come elementi in meno, così un flusso continuo
+    di richieste piccole non blocca all'infinito quelle grandi.
+    """
+
+    def __init__(self, encode_fn, max_batch_size, window_s, aging_rate=0.0):
+        self.encode_fn = encode_fn
+        self.max_batch_size = max_batch_size
+        self.window_s = window_s
+        self.aging_rate = aging_rate
+        self._queue = queue.PriorityQueue()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def _ensure_worker(self):
+        # Il thread viene avviato alla prima richiesta e non all'import del modulo,
+        # così ogni worker di Gunicorn ha il proprio thread dopo il fork.
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def encode(self, items):
+        """Restituisce un array NumPy (len(items), dim), nello stesso ordine degli elementi."""
+        self._ensure_worker()
+        futures = []
+        enqueued = time.monotonic()
+        # La priorità è la dimensione della richiesta, ridotta di aging_rate elementi per
+        # ogni secondo di anzianità rispetto alle richieste successive; il contatore
+        # mantiene l'ordine FIFO.
+        priority = len(items) + self.aging_rate * enqueued
+        for item in items:
+            future = Future()
+            self._queue.put((priority, next(self._counter), item, future, enqueued))
+            futures.append(future)
+        return np.stack([future.result() for future in futures])
+
+    def _collect_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window_s
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            items = [entry[2] for entry in batch]
+            started = time.monotonic()
+            for entry in batch:
+                QUEUE_WAIT_SECONDS.observe(started - entry[4])
+            BATCH_SIZE.observe(len(items))
+            try:
+                with ENCODE_SECONDS.time():
+                    vectors = self.encode_fn(items)
+            except Exception as e:
+                print(f"Errore durante la codifica di un batch di {len(items)} elementi: {e}")
+                for entry in batch:
+                    entry[3].set_exception(e)
+                continue
+            for entry, vector in zip(batch, vectors):
+                entry[3].set_result(vector)
+
+
+batcher = MicroBatcher(
+    lambda items: model.encode(items, batch_size=EMBEDDING_MAX_BATCH_SIZE),
+    max_batch_size=EMBEDDING_MAX_BATCH_SIZE,
+    window_s=EMBEDDING_BATCH_WINDOW_MS / 1000.0,
+    aging_rate=EMBEDDING_PRIORITY_AGING,
+)
+
+
+# -----------------------------------------------------------------------------
+# 3. CACHE DEGLI EMBEDDING (MEMORIA LRU + DISCO)
+# -----------------------------------------------------------------------------
+# Numero massimo di vettori tenuti nella cache in memoria di ogni worker.
+EMBEDDING_CACHE_MEMORY_ITEMS = int(os.getenv("EMBEDDING_CACHE_MEMORY_ITEMS", "20000"))
+# Dimensione massima della cache su disco, condivisa tra i worker del pod (0 = disabilitata).
+EMBEDDING_CACHE_DISK_BYTES = int(os.getenv("EMBEDDING_CACHE_DISK_BYTES", str(1024 ** 3)))
+EMBEDDING_CACHE_DISK_PATH = os.path.join(MODEL_CACHE_PATH, "embedding_cache")
+
+
+class EmbeddingCache:
+    """Cache content-addressed dei vettori, indicizzata per hash di (modello, contenuto).
+
+    Il primo livello è una LRU in memoria limitata a memory_items vettori; il secondo
+    è una cache diskcache sotto MODEL_CACHE_PATH, che sopravvive ai riavvii dei worker
+    ed è condivisa tra i processi dello stesso pod.
+    """
+
+    def __init__(self, memory_items, disk_path, disk_bytes):
+        self.memory_items = memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "memory_evictions": 0, "disk_errors": 0}
+        self._disk = None
+        if disk_bytes > 0:
+            try:
+                self._disk = diskcache.Cache(disk_path, size_limit=disk_bytes)
+            except Exception as e:
+                print(f"ATTENZIONE: cache su disco non disponibile in {disk_path}: {e}")
+
+    def _remember(self, key, vector):
+        # Chiamata con il lock acquisito
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+            self.stats["memory_evictions"] += 1
+
+    def get_many(self, keys):
+        """Restituisce un dizionario chiave -> vettore con le sole chiavi trovate."""
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+                    self.stats["memory_hits"] += 1
+                    CACHE_LOOKUPS.labels("memory_hit").inc()
+        for key in keys:
+            if key in found:
+                continue
+            raw = self._disk_get(key)
+            if raw is None:
+                continue
+            vector = np.frombuffer(raw, dtype=np.float32)
+            found[key] = vector
+            with self._lock:
+                self.stats["disk_hits"] += 1
+                self._remember(key, vector)
+            CACHE_LOOKUPS.labels("disk_hit").inc()
+        with self._lock:
+            self.stats["misses"] += len(keys) - len(found)
+        CACHE_LOOKUPS.labels("miss").inc(len(keys) - len(found))
+        return found
+
+    def put_many(self, vectors_by_key):
+        with self._lock:
+            for key, vector in vectors_by_key.items():
+                self._remember(key, vector)
+        for key, vector in vectors_by_key.items():
+            self._disk_set(key, np.asarray(vector, dtype=np.float32).tobytes())
+
+    def _disk_get(self, key):
+        if self._disk is None:
+            return None
+        try:
+            return self._disk.get(key)
+        except Exception as e:
+            print(f"Errore in lettura dalla cache su disco: {e}")
+            with self._lock:
+                self.stats["disk_errors"] += 1
+            return None
+
+    def _disk_set(self, key, raw):
+        if self._disk is None:
+            return
+        try:
+            self._disk.set(key, raw)
+        except Exception as e:
+            print(f"Errore in scrittura sulla cache su disco: {e}")
+            with self._lock:
+                self.stats["disk_errors"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.stats, memory_items=len(self._memory), memory_capacity=self.memory_items)
+        if self._disk is not None:
+            data["disk_items"] = len(self._disk)
+            data["disk_bytes"] = self._disk.volume()
+        return data
+
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_MEMORY_ITEMS, EMBEDDING_CACHE_DISK_PATH, EMBEDDING_CACHE_DISK_BYTES)
+
+
+def normalize_text(text):
+    # Spazi e forme Unicode equivalenti non cambiano l'embedding: li uniformiamo
+    # così testi identici a meno della formattazione condividono la stessa chiave.
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+# I vettori dei backend non sono identici bit per bit (soprattutto in int8):
+# ogni backend ha le proprie chiavi, quelle del backend torch restano invariate.
+if EMBEDDING_BACKEND == "onnx":
+    EMBEDDING_CACHE_NAMESPACE = f"{EMBEDDING_MODEL_NAME}:onnx{'-int8' if EMBEDDING_ONNX_QUANTIZE else ''}"
+else:
+    EMBEDDING_CACHE_NAMESPACE = EMBEDDING_MODEL_NAME
+
+
+def cache_key(kind, payload):
+    digest = hashlib.sha256()
+    for part in (EMBEDDING_CACHE_NAMESPACE.encode(), kind.encode(), payload):
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def embed_items(keyed_items):
+    """Calcola gli embedding di una lista di (chiave, elemento) usando la cache.
+
+    Solo gli elementi non presenti in cache vengono passati al modello, una volta
+    sola anche se ripetuti nella stessa richiesta.
+    """
+    keys = [key for key, _ in keyed_items]
+    found = embedding_cache.get_many(list(dict.fromkeys(keys)))
+    missing = {}
+    for key, item in keyed_items:
+        if key not in found and key not in missing:
+            missing[key] = item
+    if missing:
+        vectors = batcher.encode(list(missing.values()))
+        # Copia di ogni riga: una vista terrebbe in vita l'intero array del batch nella cache
+        computed = {key: np.array(vector) for key, vector in zip(missing.keys(), vectors)}
+        embedding_cache.put_many(computed)
+        found.update(computed)
+    return np.stack([found[key] for key in keys])
+
+
+def decode_base64_image(base64_image_string):
+    # Decodifica la stringa Base64 in dati binari e apre l'immagine con Pillow.
+    # Image.open legge solo l'intestazione: load() decodifica subito i pixel, così un file
+    # troncato o corrotto viene rifiutato con un 400 invece di far fallire l'intero micro-batch.
+    image_data = base64.b64decode(base64_image_string)
+    image = Image.open(io.BytesIO(image_data))
+    image.load()
+    return cache_key("image", image_data), image
+
+# Tipi di dato ammessi per la risposta binaria
+BINARY_DTYPES = {"float32": np.float32, "float16": np.float16}
+
+
+def embedding_response(embedding):
+    """Serializza gli embedding nel formato richiesto dal client (content negotiation).
+
+    Di default risponde in JSON. Con "Accept: application/octet-stream" restituisce invece
+    il buffer NumPy grezzo (little-endian, ordine C), con forma e tipo negli header
+    X-Embedding-Shape e X-Embedding-Dtype; il tipo si sceglie con l'header
+    X-Embedding-Dtype o il parametro ?dtype= (float32 di default, oppure float16).
+    """
+    best = request.accept_mimetypes.best_match(["application/json", "application/octet-stream"])
+    if best != "application/octet-stream":
+        # Converte il risultato (un array NumPy) in una lista Python per la risposta JSON
+        return jsonify({"embedding": embedding.tolist()})
+
+    dtype_name = request.headers.get("X-Embedding-Dtype") or request.args.get("dtype", "float32")
+    if dtype_name not in BINARY_DTYPES:
+        return jsonify({"error": f"Tipo non supportato: '{dtype_name}'. Usa float32 o float16."}), 400
+    data = np.ascontiguousarray(embedding, dtype=np.dtype(BINARY_DTYPES[dtype_name]).newbyteorder("<"))
+    return Response(data.tobytes(), mimetype="application/octet-stream", headers={
+        "X-Embedding-Shape": ",".join(str(dim) for dim in data.shape),
+        "X-Embedding-Dtype": dtype_name,
+    })
+
+# -----------------------------------------------------------------------------
+# 4. DEFINIZIONE DELL'ENDPOINT PER CREARE GLI EMBEDDING
+# -----------------------------------------------------------------------------
+# Contratto: "text" (o "image") può essere un singolo valore oppure una lista.
+# - valore singolo -> {"embedding": [float, ...]}
+# - lista          -> {"embedding": [[float, ...], ...]} nello stesso ordine della lista
+# Con "Accept: application/octet-stream" la stessa struttura viene restituita in binario
+# (vedi embedding_response).
 @app.route('/create-embedding', methods=['POST'])
 def create_embedding():
     # Se il modello non è stato caricato, restituisce un errore
@@ -42,39 +464,83 @@ def create_embedding():
     if not json_data:
         return jsonify({"error": "Richiesta JSON non valida o vuota."}), 400
 
-    embedding = None
+    kind = 'text' if 'text' in json_data else 'image' if 'image' in json_data else None
+    # Se non viene fornito né testo né immagine
+    if kind is None:
+        return jsonify({"error": "La richiesta deve contenere una chiave 'text' o 'image'."}), 400
+    values = json_data[kind]
+    is_batch = isinstance(values, list)
+    # Il limite si controlla prima di normalizzare i testi o decodificare le immagini
+    if is_batch and len(values) > EMBEDDING_MAX_REQUEST_ITEMS:
+        return jsonify({"error": f"Troppi elementi nella richiesta: massimo {EMBEDDING_MAX_REQUEST_ITEMS}."}), 413
 
     # Caso 1: La richiesta contiene una chiave "text"
-    if 'text' in json_data:
-        text = json_data['text']
-        print(f"Creazione embedding per il testo: '{text[:50]}...'")
-        embedding = model.encode(text)
+    if kind == 'text':
+        texts = values if is_batch else [values]
+        if not all(isinstance(text, str) for text in texts):
+            return jsonify({"error": "La chiave 'text' deve contenere una stringa o una lista di stringhe."}), 400
+        if texts:
+            print(f"[{g.request_id}] Creazione embedding per {len(texts)} testi, il primo: '{texts[0][:50]}...'")
+        items = []
+        for text in texts:
+            text = normalize_text(text)
+            items.append((cache_key("text", text.encode("utf-8")), text))
 
     # Caso 2: La richiesta contiene una chiave "image" con dati in Base64
-    elif 'image' in json_data:
-        base64_image_string = json_data['image']
-        print("Creazione embedding per un'immagine...")
+    else:
+        print(f"[{g.request_id}] Creazione embedding per {len(values) if is_batch else 1} immagini...")
         try:
-            # Decodifica la stringa Base64 in dati binari
-            image_data = base64.b64decode(base64_image_string)
-            # Apre l'immagine usando la libreria Pillow
-            image = Image.open(io.BytesIO(image_data))
-            # Crea l'embedding per l'immagine
-            embedding = model.encode(image)
+            items = [decode_base64_image(value) for value in (values if is_batch else [values])]
         except Exception as e:
             return jsonify({"error": f"Errore nel processare l'immagine Base64: {e}"}), 400
-    
-    # Se non viene fornito né testo né immagine
-    else:
-        return jsonify({"error": "La richiesta deve contenere una chiave 'text' o 'image'."}), 400
 
-    # Converte il risultato (un array NumPy) in una lista Python per la risposta JSON
-    return jsonify({"embedding": embedding.tolist()})
+    if not items:
+        return embedding_response(np.empty((0, 0), dtype=np.float32))
+
+    REQUEST_ITEMS.labels(kind).observe(len(items))
+    try:
+        with REQUEST_SECONDS.labels(kind).time():
+            embeddings = embed_items(items)
+    except Exception as e:
+        print(f"[{g.request_id}] Errore durante la creazione degli embedding: {e}")
+        return jsonify({"error": f"Errore durante la creazione degli embedding: {e}"}), 500
+
+    return embedding_response(embeddings if is_batch else embeddings[0])
+
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    # Contatori di hit/miss/evizioni della cache di questo worker
+    return jsonify(embedding_cache.snapshot())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Metriche Prometheus: con più worker si aggregano i file di PROMETHEUS_MULTIPROC_DIR
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+@app.route('/ready', methods=['GET'])
+def ready():
+    # Readiness probe: pronto solo dopo che il warmup di questo worker è completato
+    if model is None:
+        return jsonify({"status": "error", "error": "Modello di embedding non disponibile."}), 503
+    warmup.start()
+    if warmup.error:
+        return jsonify({"status": "error", "error": warmup.error}), 503
+    if not warmup.done.is_set():
+        return jsonify({"status": "warming_up"}), 503
+    return jsonify({"status": "ready", "backend": EMBEDDING_BACKEND, "warmup_s": warmup.duration_s, "pid": os.getpid()})
 
 # -----------------------------------------------------------------------------
-# 3. AVVIO DEL SERVER (usato solo per test locali)
+# 5. AVVIO DEL SERVER (usato solo per test locali)
 # -----------------------------------------------------------------------------
 if __name__ == '__main__':
     # Questo blocco viene eseguito solo se avvii lo script con "python embed_app.py".
     # In produzione su OpenShift, Gunicorn avvierà l'app, ignorando questo blocco.
+    warmup.start()
     app.run(host='0.0.0.0', port=8080)
\ No newline at end of file
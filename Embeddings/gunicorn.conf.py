@@ -0,0 +1,40 @@
+# ==============================================================================
+# CONFIGURAZIONE DI GUNICORN PER IL SERVIZIO DI EMBEDDING
+#
+# Con preload_app il modulo app.py (e quindi il modello CLIP) viene caricato una
+# sola volta nel processo master; i worker nascono con fork e condividono i pesi
+# in copy-on-write. Il warmup invece va eseguito in ogni worker dopo il fork.
+# ==============================================================================
+import gc
+import os
+import shutil
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8080")
+workers = int(os.getenv("GUNICORN_WORKERS", "2"))
+# --threads permette a ogni worker di servire più richieste in parallelo:
+# il micro-batching unisce così le richieste concorrenti in un'unica chiamata al modello.
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+preload_app = os.getenv("EMBEDDING_PRELOAD", "true").lower() in ("1", "true", "yes")
+
+# Metriche dei worker (vedi /metrics): i file di un avvio precedente vanno eliminati
+# prima che l'app venga caricata, quindi qui e non in un hook
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
+
+def when_ready(server):
+    # Eseguito nel master dopo il caricamento dell'app e prima del fork dei worker:
+    # gli oggetti già creati (modello compreso) escono dal garbage collector ciclico,
+    # che altrimenti li visiterebbe nei worker copiando le pagine condivise.
+    if preload_app:
+        gc.freeze()
+        server.log.info("Oggetti del master congelati (gc.freeze) prima del fork dei worker.")
+
+
+def post_worker_init(worker):
+    # Eseguito in ogni worker dopo il caricamento dell'app (con o senza preload):
+    # avvia il warmup, al termine del quale /ready risponde 200.
+    import app as embedding_app
+    embedding_app.warmup.start()
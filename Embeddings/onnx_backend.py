@@ -0,0 +1,315 @@
+# ==============================================================================
+# BACKEND ONNX RUNTIME PER IL MODELLO CLIP
+#
+# Esporta le due torri di CLIP (testo e immagini, ciascuna con la sua proiezione)
+# in due file ONNX, opzionalmente quantizzati in int8 (quantizzazione dinamica dei
+# pesi), e le esegue con ONNX Runtime. OnnxClipEncoder.encode accetta le stesse
+# liste miste di testi e immagini PIL di SentenceTransformer.encode e restituisce
+# gli stessi vettori (non normalizzati), così app.py usa l'uno o l'altro in modo
+# trasparente (EMBEDDING_BACKEND=torch|onnx).
+#
+# Uso da riga di comando:
+#   python onnx_backend.py --export [--quantize]   esporta in EMBEDDING_ONNX_PATH
+#   python onnx_backend.py --parity                similarità del coseno con PyTorch
+#   python onnx_backend.py --benchmark             confronto tra torch, onnx e onnx int8
+# ==============================================================================
+import argparse
+import json
+import os
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+OPSET_VERSION = 17
+
+
+def model_files(directory, quantize):
+    # Percorsi dei modelli delle due torri (testo, immagini)
+    suffix = ".int8.onnx" if quantize else ".onnx"
+    return os.path.join(directory, "text" + suffix), os.path.join(directory, "vision" + suffix)
+
+
+def export(sentence_model, directory, quantize=False):
+    """Esporta le torri di CLIP di un SentenceTransformer nella cartella indicata.
+
+    Nella stessa cartella viene salvato il processor (tokenizer e preprocessing delle
+    immagini), così per servire il modello ONNX non serve caricare quello PyTorch.
+    """
+    import torch
+
+    clip_module = sentence_model[0]
+    clip, processor = clip_module.model.eval(), clip_module.processor
+
+    # Il modello CLIP è un sottomodulo delle torri: i pesi diventano initializer del
+    # grafo ONNX (e non costanti), come richiesto dalla quantizzazione
+    class TextTower(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.clip = clip
+
+        def forward(self, input_ids, attention_mask):
+            pooled = self.clip.text_model(input_ids=input_ids, attention_mask=attention_mask)[1]
+            return self.clip.text_projection(pooled)
+
+    class VisionTower(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.clip = clip
+
+        def forward(self, pixel_values):
+            return self.clip.visual_projection(self.clip.vision_model(pixel_values=pixel_values)[1])
+
+    os.makedirs(directory, exist_ok=True)
+    # Prima il processor e poi i modelli: chi trova i file .onnx trova anche il processor
+    processor.save_pretrained(directory)
+    text_path, vision_path = model_files(directory, quantize=False)
+    tokens = processor.tokenizer(["testo di esempio", "un secondo testo più lungo"], padding=True, return_tensors="pt")
+    crop = processor.image_processor.crop_size
+    pixel_values = torch.zeros(1, 3, crop["height"], crop["width"])
+
+    with torch.no_grad():
+        _export_file(
+            TextTower(), (tokens["input_ids"], tokens["attention_mask"]), text_path,
+            input_names=["input_ids", "attention_mask"],
+            dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "attention_mask": {0: "batch", 1: "sequence"}}
+        )
+        _export_file(
+            VisionTower(), (pixel_values,), vision_path,
+            input_names=["pixel_values"], dynamic_axes={"pixel_values": {0: "batch"}}
+        )
+    print(f"Modelli ONNX esportati in {directory}.")
+    if quantize:
+        quantize_models(directory)
+
+
+def _export_file(module, args, path, input_names, dynamic_axes):
+    import torch
+
+    # Scrittura su file temporaneo e rename: più worker possono esportare insieme
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    torch.onnx.export(
+        module, args, tmp_path, input_names=input_names, output_names=["embedding"],
+        dynamic_axes=dict(dynamic_axes, embedding={0: "batch"}), opset_version=OPSET_VERSION, dynamo=False
+    )
+    os.replace(tmp_path, path)
+
+
+def quantize_models(directory):
+    """Crea le versioni int8 dei modelli esportati (pesi int8, attivazioni quantizzate al volo)."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    for source, target in zip(model_files(directory, quantize=False), model_files(directory, quantize=True)):
+        tmp_path = f"{target}.{os.getpid()}.tmp"
+        # Solo MatMul/Gemm: le convoluzioni int8 della patch embedding sono lente su CPU
+        quantize_dynamic(source, tmp_path, weight_type=QuantType.QInt8, op_types_to_quantize=["MatMul", "Gemm"])
+        os.replace(tmp_path, target)
+    print(f"Modelli ONNX quantizzati in int8 in {directory}.")
+
+
+class OnnxClipEncoder:
+    """Encoder CLIP su ONNX Runtime, con il metodo encode di SentenceTransformer usato da app.py.
+
+    Le sessioni di ONNX Runtime (e i loro thread) vengono create nel processo che le
+    usa: con il preload di Gunicorn il master carica solo il processor e ogni worker
+    apre le proprie sessioni dopo il fork.
+    """
+
+    def __init__(self, directory, quantize=False, threads=0):
+        self.text_path, self.vision_path = model_files(directory, quantize)
+        for path in (self.text_path, self.vision_path):
+            if not os.path.exists(path):
+                raise FileNotFoundError(f"Modello ONNX non trovato: {path}")
+        from transformers import CLIPProcessor
+
+        self.processor = CLIPProcessor.from_pretrained(directory)
+        self.quantize = quantize
+        # 0 = numero di thread scelto da ONNX Runtime (i core fisici)
+        self.threads = threads
+        self._sessions = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _get_sessions(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                import onnxruntime as ort
+
+                options = ort.SessionOptions()
+                options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+                options.intra_op_num_threads = self.threads
+                options.inter_op_num_threads = 1
+                self._sessions = tuple(
+                    ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+                    for path in (self.text_path, self.vision_path)
+                )
+                self._pid = os.getpid()
+            return self._sessions
+
+    def encode(self, items, batch_size=32, **kwargs):
+        """Restituisce un array NumPy (len(items), dim), nello stesso ordine degli elementi."""
+        text_session, vision_session = self._get_sessions()
+        images = [i for i, item in enumerate(items) if isinstance(item, Image.Image)]
+        # Testi ordinati per lunghezza: meno padding in ogni batch
+        texts = sorted((i for i, item in enumerate(items) if not isinstance(item, Image.Image)), key=lambda i: len(items[i]))
+        vectors = {}
+
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            tokens = self.processor.tokenizer([items[i] for i in batch], padding=True, truncation=True, return_tensors="np")
+            output = text_session.run(None, {
+                "input_ids": tokens["input_ids"].astype(np.int64),
+                "attention_mask": tokens["attention_mask"].astype(np.int64),
+            })[0]
+            vectors.update(zip(batch, output))
+
+        for start in range(0, len(images), batch_size):
+            batch = images[start:start + batch_size]
+            pixel_values = self.processor.image_processor([items[i] for i in batch], return_tensors="np")["pixel_values"]
+            output = vision_session.run(None, {"pixel_values": pixel_values.astype(np.float32)})[0]
+            vectors.update(zip(batch, output))
+
+        if not vectors:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([vectors[i] for i in range(len(items))]).astype(np.float32, copy=False)
+
+
+# -----------------------------------------------------------------------------
+# PARITÀ E BENCHMARK (riga di comando)
+# -----------------------------------------------------------------------------
+SAMPLE_TEXTS = [
+    "Il contratto di fornitura scade il 31 dicembre.",
+    "Procedura di manutenzione ordinaria del compressore.",
+    "Una foto di un gatto addormentato sul divano.",
+    "Relazione trimestrale sui consumi energetici dello stabilimento di Torino.",
+    "Elenco dei fornitori approvati",
+    "Come si richiede il rimborso delle spese di trasferta?",
+    "Schema elettrico del quadro di distribuzione principale, revisione 4.",
+    "Mappa stradale del centro storico",
+]
+
+
+def sample_images(count, seed=0):
+    # Immagini sintetiche (rumore e gradienti) di dimensioni diverse
+    rng = np.random.default_rng(seed)
+    images = []
+    for i in range(count):
+        height, width = 160 + 40 * (i % 4), 200 + 30 * (i % 3)
+        if i % 2:
+            pixels = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+        else:
+            gradient = np.linspace(0, 255, width, dtype=np.uint8)
+            pixels = np.stack([np.tile(gradient, (height, 1))] * 3, axis=-1)
+            pixels[:, :, i % 3] = 255 - pixels[:, :, i % 3]
+        images.append(Image.fromarray(pixels))
+    return images
+
+
+def cosine(a, b):
+    a, b = np.asarray(a, dtype=np.float64), np.asarray(b, dtype=np.float64)
+    return np.sum(a * b, axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+
+def load_sentence_model(name):
+    from sentence_transformers import SentenceTransformer
+
+    return SentenceTransformer(name, local_files_only=os.path.isdir(name))
+
+
+def ensure_exported(sentence_model, directory, quantize):
+    if not all(os.path.exists(path) for path in model_files(directory, quantize)):
+        if all(os.path.exists(path) for path in model_files(directory, quantize=False)):
+            quantize_models(directory)
+        else:
+            export(sentence_model, directory, quantize)
+
+
+def run_parity(sentence_model, directory, threads):
+    texts, images = SAMPLE_TEXTS, sample_images(8)
+    reference = {"text": sentence_model.encode(texts), "image": sentence_model.encode(images)}
+    results = []
+    for quantize in (False, True):
+        ensure_exported(sentence_model, directory, quantize)
+        encoder = OnnxClipEncoder(directory, quantize, threads)
+        for kind, items in (("text", texts), ("image", images)):
+            similarity = cosine(reference[kind], encoder.encode(items))
+            results.append({
+                "backend": "onnx-int8" if quantize else "onnx", "kind": kind,
+                "min_cosine": round(float(similarity.min()), 6), "mean_cosine": round(float(similarity.mean()), 6),
+            })
+
+    print(f"\n{'backend':<12}{'tipo':<8}{'coseno min':>12}{'coseno medio':>14}")
+    for result in results:
+        print(f"{result['backend']:<12}{result['kind']:<8}{result['min_cosine']:>12}{result['mean_cosine']:>14}")
+    return results
+
+
+def run_benchmark(sentence_model, directory, threads, batch_size, repeats):
+    encoders = {"torch": sentence_model}
+    for quantize in (False, True):
+        ensure_exported(sentence_model, directory, quantize)
+        encoders["onnx-int8" if quantize else "onnx"] = OnnxClipEncoder(directory, quantize, threads)
+    workloads = {
+        "text": (SAMPLE_TEXTS * (batch_size // len(SAMPLE_TEXTS) + 1))[:batch_size],
+        "image": sample_images(batch_size),
+    }
+
+    results = []
+    for name, encoder in encoders.items():
+        for kind, items in workloads.items():
+            encoder.encode(items[:2], batch_size=batch_size)  # warmup
+            # Latenza di un singolo elemento (es. la domanda di una chat)
+            started = time.perf_counter()
+            for _ in range(repeats):
+                encoder.encode(items[:1], batch_size=batch_size)
+            latency_ms = (time.perf_counter() - started) / repeats * 1000
+            # Throughput con batch pieni (es. l'indicizzazione di un documento)
+            started = time.perf_counter()
+            for _ in range(repeats):
+                encoder.encode(items, batch_size=batch_size)
+            throughput = len(items) * repeats / (time.perf_counter() - started)
+            results.append({
+                "backend": name, "kind": kind, "batch_size": batch_size,
+                "latency_ms": round(latency_ms, 2), "items_per_s": round(throughput, 1),
+            })
+
+    print(f"\n{'backend':<12}{'tipo':<8}{'latenza ms':>12}{'elementi/s':>12}")
+    for result in results:
+        print(f"{result['backend']:<12}{result['kind']:<8}{result['latency_ms']:>12}{result['items_per_s']:>12}")
+    return results
+
+
+def main():
+    default_model = os.getenv("EMBEDDING_MODEL_PATH", "")
+    if not os.path.isdir(default_model):
+        default_model = "clip-ViT-B-32"
+    parser = argparse.ArgumentParser(description="Esportazione, parità e benchmark del backend ONNX di CLIP.")
+    action = parser.add_mutually_exclusive_group(required=True)
+    action.add_argument("--export", action="store_true", help="esporta i modelli ONNX")
+    action.add_argument("--parity", action="store_true", help="confronta i vettori ONNX con quelli PyTorch")
+    action.add_argument("--benchmark", action="store_true", help="confronta le prestazioni dei backend")
+    parser.add_argument("--model", default=default_model, help="modello sentence-transformers (nome o cartella)")
+    parser.add_argument("--onnx-path", default=os.getenv("EMBEDDING_ONNX_PATH", "/app/model_cache/onnx"))
+    parser.add_argument("--quantize", action="store_true", help="con --export crea anche la versione int8")
+    parser.add_argument("--threads", type=int, default=int(os.getenv("EMBEDDING_ONNX_THREADS", "0")))
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--output", help="file JSON in cui salvare i risultati")
+    options = parser.parse_args()
+
+    sentence_model = load_sentence_model(options.model)
+    if options.export:
+        export(sentence_model, options.onnx_path, options.quantize)
+        return
+    if options.parity:
+        results = run_parity(sentence_model, options.onnx_path, options.threads)
+    else:
+        results = run_benchmark(sentence_model, options.onnx_path, options.threads, options.batch_size, options.repeats)
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,21 @@
 # Importiamo le librerie necessarie
-from flask import Flask, request, jsonify
-from llama_cpp import Llama
+from flask import Flask, Response, g, request, jsonify, stream_with_context
+import llama_cpp
+from llama_cpp import Llama, LlamaDiskCache, LlamaRAMCache
+from llama_cpp.llama_chat_format import Jinja2ChatFormatter, format_llama3
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+import numpy as np
+import codecs
+import heapq
+import itertools
+import json
+import math
 import os # Necessario per leggere le variabili d'ambiente
+import queue
+import threading
+import time
+import uuid
 
 # -----------------------------------------------------------------------------
 # 1. INIZIALIZZAZIONE DELL'APPLICAZIONE FLASK
@@ -12,11 +26,46 @@ app = Flask(__name__)
 # Impostiamo la configurazione per restituire JSON con caratteri non-ASCII (es. lettere accentate)
 app.config['JSON_AS_ASCII'] = False
 
+# Metriche in formato Prometheus, esposte su /metrics
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+REQUESTS = Counter("llm_requests_total", "Richieste di generazione concluse, per esito", ["outcome"])
+QUEUE_WAIT_SECONDS = Histogram("llm_queue_wait_seconds", "Attesa in coda prima della generazione", ["priority"], buckets=LATENCY_BUCKETS)
+FIRST_TOKEN_SECONDS = Histogram(
+    "llm_time_to_first_token_seconds", "Tempo dall'inizio della generazione al primo token (prefill compreso)",
+    buckets=LATENCY_BUCKETS
+)
+GENERATION_SECONDS = Histogram("llm_generation_seconds", "Durata della generazione, esclusa l'attesa in coda", buckets=LATENCY_BUCKETS)
+PROMPT_TOKENS = Histogram("llm_prompt_tokens", "Token del prompt per richiesta", buckets=TOKEN_BUCKETS)
+PROMPT_TOKENS_REUSED = Counter("llm_prompt_tokens_reused_total", "Token del prompt non ricalcolati grazie alla cache dei prefissi")
+COMPLETION_TOKENS = Histogram("llm_completion_tokens", "Token generati per richiesta", buckets=TOKEN_BUCKETS)
+DECODE_TOKENS_PER_SECOND = Histogram(
+    "llm_decode_tokens_per_second", "Velocità di decodifica per richiesta (primo token escluso)",
+    buckets=(0.5, 1, 2, 4, 8, 12, 16, 24, 32, 48, 64, 128)
+)
+BATCH_SIZE = Histogram("llm_batch_size", "Sequenze avanzate insieme in ogni passo di decodifica", buckets=(1, 2, 3, 4, 6, 8, 12, 16, 32))
+
+# ID della chat a cui appartiene la generazione (propagato dall'orchestratore o
+# generato qui): lo riportano i log della coda, con attesa, primo token ed esito.
+REQUEST_ID_HEADER = "X-Request-ID"
+
+
+@app.before_request
+def assign_request_id():
+    g.request_id = (request.headers.get(REQUEST_ID_HEADER) or "").strip()[:64] or uuid.uuid4().hex
+
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers[REQUEST_ID_HEADER] = g.request_id
+    return response
+
 # -----------------------------------------------------------------------------
 # 2. CARICAMENTO DEL MODELLO GGUF
 # -----------------------------------------------------------------------------
 # Definiamo il percorso della cache che corrisponderà al volume emptyDir su OpenShift
-MODEL_CACHE_PATH = "/app/model_cache"
+# (fuori dal container si può indicare un'altra cartella con MODEL_CACHE_PATH)
+MODEL_CACHE_PATH = os.getenv("MODEL_CACHE_PATH", "/app/model_cache")
 os.environ['HF_HOME'] = MODEL_CACHE_PATH
 os.environ['HUGGINGFACE_HUB_CACHE'] = MODEL_CACHE_PATH
 os.environ['HF_HUB_CACHE'] = MODEL_CACHE_PATH
@@ -26,6 +75,119 @@ hf_token = os.getenv("HUGGING_FACE_HUB_TOKEN")
 if not hf_token:
     print("ATTENZIONE: La variabile d'ambiente HUGGING_FACE_HUB_TOKEN non è stata trovata.")
 
+# Decodifica speculativa: un modello di bozza propone i token successivi e il modello
+# principale li verifica tutti con una sola valutazione. Le risposte RAG copiano
+# spesso intere frasi dal contesto, il caso ideale per il "prompt lookup".
+# LLM_SPECULATIVE: "off" (default), "prompt-lookup" (bozze prese dal prompt stesso)
+# oppure "draft" (un piccolo GGUF con lo stesso vocabolario, es. Llama 3.2 1B).
+# Nota: con la decodifica speculativa llama.cpp conserva i logit di tutto il
+# contesto, quindi memoria e stati della cache dei prefissi diventano molto più grandi.
+LLM_SPECULATIVE = os.getenv("LLM_SPECULATIVE", "off")
+# Token proposti a ogni passo e lunghezza massima degli n-grammi cercati nel prompt
+LLM_DRAFT_TOKENS = int(os.getenv("LLM_DRAFT_TOKENS", "10"))
+LLM_PROMPT_LOOKUP_NGRAM = int(os.getenv("LLM_PROMPT_LOOKUP_NGRAM", "2"))
+LLM_DRAFT_REPO = os.getenv("LLM_DRAFT_REPO", "bartowski/Llama-3.2-1B-Instruct-GGUF")
+LLM_DRAFT_FILE = os.getenv("LLM_DRAFT_FILE", "Llama-3.2-1B-Instruct-Q4_K_M.gguf")
+
+# Generazione in batch: fino a LLM_MAX_BATCH_SIZE richieste avanzano insieme, un token
+# per passo, con una sola llama_decode su un contesto a più sequenze (vedi sezione 4).
+# 1 (default) = una richiesta alla volta. Con valori maggiori la cache dei prefissi e
+# la decodifica speculativa vengono disattivate: entrambe lavorano su un contesto con
+# una sola sequenza.
+LLM_MAX_BATCH_SIZE = max(1, int(os.getenv("LLM_MAX_BATCH_SIZE", "1")))
+# Token di contesto disponibili per ogni richiesta (prompt più risposta)
+LLM_CONTEXT_SIZE = 4096
+
+
+class GGUFDraftModel(LlamaDraftModel):
+    """Bozze generate in modo greedy da un piccolo modello GGUF.
+
+    generate() riusa da solo il prefisso già valutato, quindi a ogni passo il
+    modello di bozza elabora solo i token nuovi.
+    """
+
+    def __init__(self, model, num_pred_tokens):
+        self.model = model
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, /, **kwargs):
+        try:
+            tokens = self.model.generate(input_ids.tolist(), temp=0.0, top_k=1, reset=True)
+            return np.array(list(itertools.islice(tokens, self.num_pred_tokens)), dtype=np.intc)
+        except Exception as e:
+            # Senza bozza la generazione prosegue normalmente, un token alla volta
+            print(f"Errore del modello di bozza: {e}")
+            return np.array([], dtype=np.intc)
+
+
+class CountingDraftModel(LlamaDraftModel):
+    """Avvolge il modello di bozza e misura quanti token proposti vengono accettati.
+
+    llama.cpp chiama la bozza dopo ogni valutazione con tutti i token già accettati:
+    tra due chiamate consecutive la sequenza cresce di un token scelto dal modello
+    principale più le bozze accettate. Le proposte dell'ultima chiamata non sono
+    ancora state verificate e restano fuori dal conteggio.
+    """
+
+    def __init__(self, draft):
+        self.draft = draft
+        self.reset()
+
+    def reset(self):
+        self.calls = 0
+        self.proposed = 0
+        self.last_proposed = 0
+        self.first_length = None
+        self.last_length = None
+
+    def __call__(self, input_ids, /, **kwargs):
+        tokens = self.draft(input_ids, **kwargs)
+        if self.first_length is None:
+            self.first_length = len(input_ids)
+        self.last_length = len(input_ids)
+        self.calls += 1
+        self.proposed += len(tokens)
+        self.last_proposed = len(tokens)
+        return tokens
+
+    def stats(self):
+        verified = self.proposed - self.last_proposed
+        accepted = (self.last_length - self.first_length) - (self.calls - 1) if self.calls else 0
+        return {
+            "speculative": LLM_SPECULATIVE,
+            "draft_tokens_proposed": verified,
+            "draft_tokens_accepted": accepted,
+            "draft_acceptance_rate": round(accepted / verified, 4) if verified else None,
+        }
+
+
+def load_draft_model():
+    if LLM_SPECULATIVE != "off" and LLM_MAX_BATCH_SIZE > 1:
+        print(f"Decodifica speculativa ({LLM_SPECULATIVE}) disattivata: non compatibile con LLM_MAX_BATCH_SIZE > 1.")
+        return None
+    if LLM_SPECULATIVE == "prompt-lookup":
+        draft = LlamaPromptLookupDecoding(max_ngram_size=LLM_PROMPT_LOOKUP_NGRAM, num_pred_tokens=LLM_DRAFT_TOKENS)
+    elif LLM_SPECULATIVE == "draft":
+        print(f"Caricamento del modello di bozza {LLM_DRAFT_REPO}/{LLM_DRAFT_FILE}...")
+        draft = GGUFDraftModel(
+            Llama.from_pretrained(
+                repo_id=LLM_DRAFT_REPO, filename=LLM_DRAFT_FILE, hf_token=hf_token,
+                n_gpu_layers=0, n_ctx=4096, cache_dir=MODEL_CACHE_PATH, verbose=False
+            ),
+            LLM_DRAFT_TOKENS
+        )
+    else:
+        return None
+    print(f"Decodifica speculativa attiva: {LLM_SPECULATIVE}, {LLM_DRAFT_TOKENS} token di bozza.")
+    return CountingDraftModel(draft)
+
+
+try:
+    draft_model = load_draft_model()
+except Exception as e:
+    print(f"ERRORE durante il caricamento del modello di bozza, decodifica speculativa disattivata: {e}")
+    draft_model = None
+
 print("Tentativo di caricamento del modello Llama 3 GGUF...")
 
 try:
@@ -40,7 +202,10 @@ try:
         
         # Parametri fondamentali per l'esecuzione
         n_gpu_layers=0,      # <-- Forza l'esecuzione al 100% sulla CPU
-        n_ctx=4096,          # <-- Imposta la dimensione massima del contesto
+        # Dimensione massima del contesto. In batch questo contesto serve solo al
+        # tokenizer: la memoria KV delle richieste è nel contesto a più sequenze.
+        n_ctx=LLM_CONTEXT_SIZE if LLM_MAX_BATCH_SIZE == 1 else 512,
+        draft_model=draft_model,  # <-- Decodifica speculativa (None se disattivata)
         cache_dir=MODEL_CACHE_PATH, # <-- Specifica dove salvare/cercare il modello
         verbose=True         # <-- Abilita log dettagliati al caricamento
     )
@@ -51,8 +216,637 @@ except Exception as e:
     llm = None
 
 # -----------------------------------------------------------------------------
-# 3. DEFINIZIONE DELL'ENDPOINT API
+# 3. CACHE DEI PREFISSI DEL PROMPT (STATO KV)
+# -----------------------------------------------------------------------------
+# System prompt e contesto RAG sono spesso identici tra domande consecutive: salvando
+# lo stato di llama.cpp dopo ogni richiesta, la successiva riparte dal prefisso comune
+# più lungo e il prefill viene eseguito solo sui token nuovi.
+# LLM_PREFIX_CACHE: "ram" (default), "disk" (sotto MODEL_CACHE_PATH) oppure "off".
+LLM_PREFIX_CACHE = os.getenv("LLM_PREFIX_CACHE", "ram")
+# Spazio massimo occupato dagli stati salvati; oltre il limite si elimina il meno recente.
+LLM_PREFIX_CACHE_BYTES = int(os.getenv("LLM_PREFIX_CACHE_BYTES", str(2 << 30)))
+
+
+class PrefixStatsMixin:
+    """Misura, a ogni ricerca in cache, quanti token del prompt non vanno ricalcolati.
+
+    llama.cpp riusa il più lungo tra il prefisso già presente nel contesto attivo e
+    quello dello stato trovato in cache: la stessa regola è applicata qui per
+    registrare i token risparmiati dall'ultima richiesta e i totali cumulativi.
+    """
+
+    model = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.last_lookup = None
+        self.stats = {"lookups": 0, "hits": 0, "prompt_tokens": 0, "prompt_tokens_reused": 0}
+
+    def _record(self, prompt_tokens, reused, cache_hit):
+        self.last_lookup = {"prompt_tokens": prompt_tokens, "prompt_tokens_reused": reused}
+        self.stats["lookups"] += 1
+        self.stats["hits"] += int(cache_hit)
+        self.stats["prompt_tokens"] += prompt_tokens
+        self.stats["prompt_tokens_reused"] += reused
+
+    def __getitem__(self, key):
+        key = tuple(key)
+        context_prefix = Llama.longest_token_prefix(self.model._input_ids.tolist(), key) if self.model else 0
+        try:
+            state = super().__getitem__(key)
+        except KeyError:
+            self._record(len(key), context_prefix, False)
+            raise
+        cached_prefix = Llama.longest_token_prefix(state.input_ids[:state.n_tokens].tolist(), key)
+        self._record(len(key), max(context_prefix, cached_prefix), cached_prefix > context_prefix)
+        return state
+
+
+class PrefixRAMCache(PrefixStatsMixin, LlamaRAMCache):
+    pass
+
+
+class PrefixDiskCache(PrefixStatsMixin, LlamaDiskCache):
+    pass
+
+
+prefix_cache = None
+if LLM_PREFIX_CACHE != "off" and LLM_MAX_BATCH_SIZE > 1:
+    print("Cache dei prefissi disattivata: non compatibile con LLM_MAX_BATCH_SIZE > 1.")
+elif llm is not None and LLM_PREFIX_CACHE != "off":
+    if LLM_PREFIX_CACHE == "disk":
+        prefix_cache = PrefixDiskCache(
+            cache_dir=os.path.join(MODEL_CACHE_PATH, "prefix_cache"),
+            capacity_bytes=LLM_PREFIX_CACHE_BYTES
+        )
+    else:
+        prefix_cache = PrefixRAMCache(capacity_bytes=LLM_PREFIX_CACHE_BYTES)
+    prefix_cache.model = llm
+    llm.set_cache(prefix_cache)
+    print(f"Cache dei prefissi attiva ({LLM_PREFIX_CACHE}, max {LLM_PREFIX_CACHE_BYTES} byte).")
+
+
+def prefix_stats():
+    # Statistiche sul prompt dell'ultima generazione (None se la cache è disattivata)
+    if prefix_cache is None or prefix_cache.last_lookup is None:
+        return {"prompt_tokens": None, "prompt_tokens_reused": None}
+    return dict(prefix_cache.last_lookup)
+
+
+def reset_prefix_stats():
+    if prefix_cache is not None:
+        prefix_cache.last_lookup = None
+
+# -----------------------------------------------------------------------------
+# 4. SCHEDULER DELLE RICHIESTE (CODA, PRIORITÀ E SCADENZE)
+# -----------------------------------------------------------------------------
+# Le richieste concorrenti attendono in una coda limitata, servita da un unico thread
+# in ordine di priorità: una generazione alla volta oppure, con LLM_MAX_BATCH_SIZE > 1,
+# fino a LLM_MAX_BATCH_SIZE richieste decodificate insieme.
+# Numero massimo di richieste in attesa; oltre si risponde subito 503 con Retry-After.
+LLM_MAX_QUEUE_DEPTH = int(os.getenv("LLM_MAX_QUEUE_DEPTH", "16"))
+# Le richieste con max_tokens fino a questa soglia sono considerate interattive.
+LLM_INTERACTIVE_MAX_TOKENS = int(os.getenv("LLM_INTERACTIVE_MAX_TOKENS", "1024"))
+# Tempo massimo concesso a una richiesta se il client non indica il proprio timeout.
+LLM_DEFAULT_TIMEOUT = float(os.getenv("LLM_DEFAULT_TIMEOUT", "1200"))
+
+# Classi di priorità: un valore più basso viene servito prima
+PRIORITIES = {"interactive": 0, "batch": 1}
+PRIORITY_NAMES = {value: name for name, value in PRIORITIES.items()}
+
+
+class QueueFullError(Exception):
+    """La coda ha raggiunto LLM_MAX_QUEUE_DEPTH richieste in attesa."""
+
+    def __init__(self, retry_after):
+        super().__init__("Coda delle richieste piena.")
+        self.retry_after = retry_after
+
+
+class DeadlineExceededError(Exception):
+    """Il client ha già smesso di attendere: la richiesta viene scartata."""
+
+
+class GenerationJob:
+    """Una richiesta in coda: il lavoro da eseguire (funzione o ChatSequence) e il canale dei suoi eventi."""
+
+    def __init__(self, fn, priority, deadline, request_id=None, stream=False):
+        self.fn = fn
+        self.priority = priority
+        self.deadline = deadline
+        self.request_id = request_id
+        self.stream = stream
+        self.enqueued_at = time.monotonic()
+        self.queue_wait = None
+        self.first_item_sent = False
+        self.events = queue.Queue()
+        self.cancelled = threading.Event()
+
+    def expired(self):
+        """True se la scadenza è passata.
+
+        In streaming la scadenza vale solo fino al primo evento: da lì in poi è il
+        client a controllare l'attesa tra un token e l'altro (timeout di lettura),
+        così una risposta lunga non viene troncata.
+        """
+        if self.stream and self.first_item_sent:
+            return False
+        return time.monotonic() >= self.deadline
+
+    def results(self):
+        """Restituisce gli eventi prodotti dalla generazione man mano che arrivano.
+
+        Se il consumatore smette di leggere (es. il client si disconnette), la
+        generazione viene interrotta al token successivo.
+        """
+        received = False
+        try:
+            while True:
+                if self.stream and received:
+                    kind, value = self.events.get()
+                else:
+                    remaining = self.deadline - time.monotonic()
+                    kind, value = self.events.get(timeout=max(remaining, 0.001))
+                if kind == "item":
+                    received = True
+                    yield value
+                elif kind == "error":
+                    raise value
+                else:
+                    return
+        except queue.Empty:
+            raise DeadlineExceededError("Tempo massimo della richiesta superato.")
+        finally:
+            self.cancelled.set()
+
+
+class GenerationScheduler:
+    """Coda a priorità con limite di profondità, davanti a un unico thread di generazione."""
+
+    def __init__(self, max_depth, max_batch_size=1):
+        self.max_depth = max_depth
+        self.max_batch_size = max_batch_size
+        self._heap = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._worker = None
+        self._active = []
+        self.stats = {
+            "submitted": 0, "completed": 0, "failed": 0,
+            "rejected": 0, "expired": 0, "cancelled": 0,
+            "last_queue_wait_s": 0.0, "max_queue_wait_s": 0.0, "total_queue_wait_s": 0.0,
+            "avg_service_time_s": 0.0,
+        }
+
+    def _ensure_worker(self):
+        # Avviato alla prima richiesta, dopo il fork del worker di Gunicorn
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._run, name="llm-scheduler", daemon=True)
+            self._worker.start()
+
+    def retry_after(self):
+        # Stima dei secondi necessari a smaltire la coda attuale (max_batch_size richieste alla volta)
+        backlog = len(self._heap) + len(self._active)
+        return max(1, int(math.ceil(backlog * self.stats["avg_service_time_s"] / self.max_batch_size)))
+
+    def submit(self, fn, priority, deadline, request_id=None, stream=False):
+        job = GenerationJob(fn, priority, deadline, request_id, stream)
+        with self._condition:
+            if len(self._heap) >= self.max_depth:
+                self.stats["rejected"] += 1
+                REQUESTS.labels("rejected").inc()
+                raise QueueFullError(self.retry_after())
+            heapq.heappush(self._heap, (priority, next(self._counter), job))
+            self.stats["submitted"] += 1
+            self._ensure_worker()
+            self._condition.notify()
+        return job
+
+    def _next_job(self, block=True):
+        # Prossima richiesta in ordine di priorità; None se la coda è vuota e block=False
+        with self._condition:
+            while not self._heap:
+                if not block:
+                    return None
+                self._condition.wait()
+            _, _, job = heapq.heappop(self._heap)
+            self._active.append(job)
+            return job
+
+    def _start(self, job):
+        """Registra l'attesa in coda; False se la richiesta è stata annullata o è scaduta."""
+        now = time.monotonic()
+        job.queue_wait = now - job.enqueued_at
+        QUEUE_WAIT_SECONDS.labels(PRIORITY_NAMES[job.priority]).observe(job.queue_wait)
+        if job.cancelled.is_set():
+            self._finish(job, "cancelled")
+            return False
+        if now >= job.deadline:
+            # Il chiamante ha già superato il proprio timeout: inutile generare
+            job.events.put(("error", DeadlineExceededError("Richiesta scaduta in coda.")))
+            self._finish(job, "expired")
+            return False
+
+        with self._condition:
+            self.stats["last_queue_wait_s"] = job.queue_wait
+            self.stats["max_queue_wait_s"] = max(self.stats["max_queue_wait_s"], job.queue_wait)
+            self.stats["total_queue_wait_s"] += job.queue_wait
+        return True
+
+    def _deliver(self, job, item):
+        """Invia un evento al client; restituisce l'esito se la generazione va interrotta."""
+        job.first_item_sent = True
+        job.events.put(("item", item))
+        if job.expired():
+            # Scadenza raggiunta durante la generazione: il client riceve un
+            # errore esplicito, non una risposta troncata senza avviso
+            job.events.put(("error", DeadlineExceededError("Tempo massimo della richiesta superato durante la generazione.")))
+            return "expired"
+        if job.cancelled.is_set():
+            return "cancelled"
+        return None
+
+    def _run(self):
+        while True:
+            job = self._next_job()
+            if not self._start(job):
+                continue
+            started = time.monotonic()
+            outcome = "completed"
+            try:
+                for item in job.fn(job):
+                    outcome = self._deliver(job, item) or "completed"
+                    if outcome != "completed":
+                        break
+                else:
+                    job.events.put(("done", None))
+            except Exception as e:
+                outcome = "failed"
+                job.events.put(("error", e))
+            self._finish(job, outcome, service_time=time.monotonic() - started)
+
+    def _finish(self, job, outcome, service_time=None):
+        REQUESTS.labels(outcome).inc()
+        if outcome != "completed":
+            print(f"[{job.request_id}] Generazione non completata: {outcome}.")
+        with self._condition:
+            self._active.remove(job)
+            self.stats[outcome] += 1
+            if service_time is not None:
+                # Media mobile esponenziale, usata per stimare il Retry-After
+                previous = self.stats["avg_service_time_s"]
+                self.stats["avg_service_time_s"] = service_time if previous == 0 else 0.8 * previous + 0.2 * service_time
+
+    def snapshot(self):
+        with self._condition:
+            depth_by_priority = {name: 0 for name in PRIORITIES}
+            for priority, _, _ in self._heap:
+                depth_by_priority[PRIORITY_NAMES[priority]] += 1
+            oldest = min((job.enqueued_at for _, _, job in self._heap), default=None)
+            return dict(
+                self.stats,
+                queue_depth=len(self._heap),
+                queue_depth_by_priority=depth_by_priority,
+                max_queue_depth=self.max_depth,
+                busy=bool(self._active),
+                active=len(self._active),
+                max_batch_size=self.max_batch_size,
+                oldest_wait_s=0.0 if oldest is None else time.monotonic() - oldest,
+            )
+
+
+def chat_completion_job(messages, max_tokens):
+    """Crea la funzione eseguita dallo scheduler per una richiesta di chat.
+
+    La generazione avviene sempre in streaming, così una richiesta annullata o
+    scaduta si interrompe al token successivo. Vengono prodotti eventi
+    {"token": "..."} e, alla fine, {"done": true} con le statistiche del prompt.
+    """
+    def run(job):
+        reset_prefix_stats()
+        if draft_model is not None:
+            draft_model.reset()
+        started = time.monotonic()
+        first_token_at = None
+        text = []
+        for chunk in llm.create_chat_completion(messages=messages, max_tokens=max_tokens, stream=True):
+            token = chunk['choices'][0]['delta'].get('content')
+            if token:
+                if first_token_at is None:
+                    first_token_at = time.monotonic()
+                text.append(token)
+                yield {"token": token}
+        stats = dict(prefix_stats(), **generation_stats(started, first_token_at, "".join(text)))
+        record_generation(job, stats, time.monotonic() - started)
+        yield dict(stats, done=True, queue_wait_s=round(job.queue_wait, 3))
+    return run
+
+
+def record_generation(job, stats, duration):
+    # Metriche e riga di log della generazione appena conclusa
+    prompt_tokens = stats["prompt_tokens"]
+    if prompt_tokens is None:
+        # Senza cache dei prefissi: token valutati nel contesto meno quelli generati
+        prompt_tokens = max(llm.n_tokens - stats["completion_tokens"], 0)
+    PROMPT_TOKENS.observe(prompt_tokens)
+    PROMPT_TOKENS_REUSED.inc(stats["prompt_tokens_reused"] or 0)
+    COMPLETION_TOKENS.observe(stats["completion_tokens"])
+    GENERATION_SECONDS.observe(duration)
+    if stats["time_to_first_token_s"] is not None:
+        FIRST_TOKEN_SECONDS.observe(stats["time_to_first_token_s"])
+    if stats["decode_tokens_per_s"] is not None:
+        DECODE_TOKENS_PER_SECOND.observe(stats["decode_tokens_per_s"])
+    print(
+        f"[{job.request_id}] Generazione: attesa in coda {job.queue_wait:.2f}s, primo token dopo "
+        f"{stats['time_to_first_token_s']}s, prompt {prompt_tokens} token ({stats['prompt_tokens_reused'] or 0} "
+        f"dalla cache), {stats['completion_tokens']} token generati a {stats['decode_tokens_per_s']} token/s."
+    )
+
+
+def generation_stats(started, first_token_at, text):
+    """Tempi e velocità della generazione, più le statistiche della decodifica speculativa.
+
+    La velocità di decodifica esclude il primo token, il cui tempo comprende il prefill.
+    """
+    completion_tokens = len(llm.tokenize(text.encode("utf-8"), add_bos=False, special=False)) if text else 0
+    stats = timing_stats(started, first_token_at, completion_tokens)
+    if draft_model is not None:
+        stats.update(draft_model.stats())
+    return stats
+
+
+def timing_stats(started, first_token_at, completion_tokens):
+    finished = time.monotonic()
+    decode_s = finished - first_token_at if first_token_at is not None else 0.0
+    return {
+        "completion_tokens": completion_tokens,
+        "time_to_first_token_s": round(first_token_at - started, 3) if first_token_at is not None else None,
+        "decode_tokens_per_s": round((completion_tokens - 1) / decode_s, 2) if completion_tokens > 1 and decode_s > 0 else None,
+    }
+
+
+# Generazione in batch (LLM_MAX_BATCH_SIZE > 1). L'oggetto Llama lega un contesto a una
+# sola sequenza, quindi il motore usa direttamente l'API a basso livello di llama.cpp:
+# un contesto con n_seq_max = LLM_MAX_BATCH_SIZE (LLM_CONTEXT_SIZE token per sequenza)
+# e un llama_batch in cui ogni token porta il seq_id della propria richiesta.
+class ChatSequence:
+    """Una richiesta nel batch: prompt, sampler, posizione nel contesto e testo prodotto."""
+
+    def __init__(self, prompt_tokens, max_tokens):
+        self.prompt_tokens = prompt_tokens
+        self.max_tokens = max_tokens
+        self.job = None
+        self.seq_id = None
+        self.sampler = None
+        self.position = 0
+        self.last_token = None
+        self.completion_tokens = 0
+        # I token possono spezzare un carattere UTF-8: i byte incompleti attendono il successivo
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.started = None
+        self.first_token_at = None
+
+
+def chat_formatter(model):
+    # Template di chat del GGUF; senza template si usa il formato di Llama 3
+    template = model.metadata.get("tokenizer.chat_template")
+    if template is None:
+        return format_llama3
+    special_text = lambda token: model.detokenize([token], special=True).decode("utf-8", errors="ignore")
+    return Jinja2ChatFormatter(template=template, eos_token=special_text(model.token_eos()), bos_token=special_text(model.token_bos()))
+
+
+def chat_sequence(messages, max_tokens):
+    """Prepara una richiesta di chat per il motore in batch (template e tokenizzazione)."""
+    formatted = format_chat(messages=messages)
+    prompt_tokens = llm.tokenize(formatted.prompt.encode("utf-8"), add_bos=not formatted.added_special, special=True)
+    return ChatSequence(prompt_tokens, max_tokens)
+
+
+def new_sampler():
+    # Stessi parametri predefiniti di create_chat_completion, usata con una sola sequenza
+    sampler = llama_cpp.llama_sampler_chain_init(llama_cpp.llama_sampler_chain_default_params())
+    for stage in (
+        llama_cpp.llama_sampler_init_top_k(40),
+        llama_cpp.llama_sampler_init_top_p(0.95, 1),
+        llama_cpp.llama_sampler_init_min_p(0.05, 1),
+        llama_cpp.llama_sampler_init_temp(0.2),
+        llama_cpp.llama_sampler_init_dist(llama_cpp.LLAMA_DEFAULT_SEED),
+    ):
+        llama_cpp.llama_sampler_chain_add(sampler, stage)
+    return sampler
+
+
+class BatchedGenerationScheduler(GenerationScheduler):
+    """Stessa coda a priorità, ma il thread di generazione serve più richieste insieme.
+
+    A ogni passo una sola llama_decode avanza di un token tutte le sequenze attive.
+    Una richiesta entra appena c'è un posto libero (dopo il prefill del suo prompt,
+    durante il quale le altre attendono) ed esce appena termina, liberando la sua
+    parte di cache KV per la successiva. Il job di ogni richiesta è una ChatSequence.
+    """
+
+    def __init__(self, max_depth, model, max_batch_size):
+        super().__init__(max_depth, max_batch_size)
+        self.model = model
+        params = llama_cpp.llama_context_params.from_buffer_copy(model.context_params)
+        params.n_ctx = LLM_CONTEXT_SIZE * max_batch_size
+        params.n_seq_max = max_batch_size
+        self.ctx = llama_cpp.llama_init_from_model(model.model, params)
+        if self.ctx is None:
+            raise RuntimeError("Impossibile creare il contesto llama.cpp per la generazione in batch.")
+        self.memory = llama_cpp.llama_get_memory(self.ctx)
+        self.vocab = llama_cpp.llama_model_get_vocab(model.model)
+        self.n_batch = params.n_batch
+        self.batch = llama_cpp.llama_batch_init(max(self.n_batch, max_batch_size), 0, 1)
+        self.free_seq_ids = list(range(max_batch_size))
+        self.sequences = []
+        self.stats.update(steps=0, batched_tokens=0, generated_tokens=0, busy_s=0.0)
+
+    def _run(self):
+        while True:
+            self._admit(block=not self.sequences)
+            if not self.sequences:
+                continue
+            started = time.monotonic()
+            try:
+                self._step()
+            except Exception as e:
+                print(f"Errore durante la generazione in batch: {e}")
+                for sequence in list(self.sequences):
+                    sequence.job.events.put(("error", e))
+                    self._release(sequence, "failed")
+            self.stats["busy_s"] += time.monotonic() - started
+
+    def _admit(self, block):
+        # Aggiunge al batch le richieste in coda, finché c'è posto
+        while len(self.sequences) < self.max_batch_size:
+            job = self._next_job(block)
+            if job is None:
+                return
+            block = False
+            if not self._start(job):
+                continue
+            sequence = job.fn
+            sequence.job = job
+            started = time.monotonic()
+            try:
+                self._prefill(sequence)
+            except Exception as e:
+                job.events.put(("error", e))
+                self._release(sequence, "failed")
+            self.stats["busy_s"] += time.monotonic() - started
+
+    def _prefill(self, sequence):
+        sequence.started = time.monotonic()
+        prompt = sequence.prompt_tokens
+        if len(prompt) >= LLM_CONTEXT_SIZE:
+            raise ValueError(f"Il prompt ({len(prompt)} token) supera il contesto di {LLM_CONTEXT_SIZE} token.")
+        sequence.seq_id = self.free_seq_ids.pop()
+        sequence.sampler = new_sampler()
+        self.sequences.append(sequence)
+        # Il prompt viene valutato a blocchi di n_batch token; servono solo i logit dell'ultimo
+        for start in range(0, len(prompt), self.n_batch):
+            chunk = prompt[start:start + self.n_batch]
+            self._fill([
+                (token, start + i, sequence.seq_id, start + i == len(prompt) - 1)
+                for i, token in enumerate(chunk)
+            ])
+            self._decode()
+        sequence.position = len(prompt)
+        self._accept(sequence, self.batch.n_tokens - 1)
+
+    def _step(self):
+        for sequence in list(self.sequences):
+            if sequence.job.cancelled.is_set():
+                self._release(sequence, "cancelled")
+        if not self.sequences:
+            return
+        batch = list(self.sequences)
+        self._fill([(sequence.last_token, sequence.position, sequence.seq_id, True) for sequence in batch])
+        self._decode()
+        self.stats["steps"] += 1
+        self.stats["batched_tokens"] += len(batch)
+        BATCH_SIZE.observe(len(batch))
+        for index, sequence in enumerate(batch):
+            sequence.position += 1
+            self._accept(sequence, index)
+
+    def _fill(self, entries):
+        # Riempie il llama_batch con (token, posizione, seq_id, servono i logit)
+        self.batch.n_tokens = len(entries)
+        for i, (token, position, seq_id, logits) in enumerate(entries):
+            self.batch.token[i] = token
+            self.batch.pos[i] = position
+            self.batch.n_seq_id[i] = 1
+            self.batch.seq_id[i][0] = seq_id
+            self.batch.logits[i] = logits
+
+    def _decode(self):
+        result = llama_cpp.llama_decode(self.ctx, self.batch)
+        if result != 0:
+            raise RuntimeError(f"llama_decode ha restituito {result}.")
+
+    def _accept(self, sequence, index):
+        # Campiona il token della sequenza dai logit in posizione index del batch
+        token = llama_cpp.llama_sampler_sample(sequence.sampler, self.ctx, index)
+        sequence.last_token = token
+        if llama_cpp.llama_vocab_is_eog(self.vocab, token):
+            self._complete(sequence)
+            return
+        sequence.completion_tokens += 1
+        self.stats["generated_tokens"] += 1
+        if sequence.first_token_at is None:
+            sequence.first_token_at = time.monotonic()
+        text = sequence.decoder.decode(self.model.detokenize([token]))
+        if text:
+            outcome = self._deliver(sequence.job, {"token": text})
+            if outcome is not None:
+                self._release(sequence, outcome)
+                return
+        # Il token campionato occuperà la posizione successiva nel contesto
+        if sequence.completion_tokens >= sequence.max_tokens or sequence.position >= LLM_CONTEXT_SIZE:
+            self._complete(sequence)
+
+    def _complete(self, sequence):
+        job = sequence.job
+        items = []
+        tail = sequence.decoder.decode(b"", final=True)
+        if tail:
+            items.append({"token": tail})
+        stats = dict(
+            {"prompt_tokens": len(sequence.prompt_tokens), "prompt_tokens_reused": None},
+            **timing_stats(sequence.started, sequence.first_token_at, sequence.completion_tokens)
+        )
+        record_generation(job, stats, time.monotonic() - sequence.started)
+        items.append(dict(stats, done=True, queue_wait_s=round(job.queue_wait, 3)))
+        for item in items:
+            outcome = self._deliver(job, item)
+            if outcome is not None:
+                self._release(sequence, outcome)
+                return
+        job.events.put(("done", None))
+        self._release(sequence, "completed")
+
+    def _release(self, sequence, outcome):
+        # Libera il posto nel batch e la parte di cache KV della sequenza
+        if sequence in self.sequences:
+            self.sequences.remove(sequence)
+        if sequence.seq_id is not None:
+            llama_cpp.llama_memory_seq_rm(self.memory, sequence.seq_id, -1, -1)
+            self.free_seq_ids.append(sequence.seq_id)
+            sequence.seq_id = None
+        if sequence.sampler is not None:
+            llama_cpp.llama_sampler_free(sequence.sampler)
+            sequence.sampler = None
+        service_time = time.monotonic() - sequence.started if sequence.started is not None else None
+        self._finish(sequence.job, outcome, service_time=service_time)
+
+    def snapshot(self):
+        stats = super().snapshot()
+        stats["avg_batch_size"] = round(stats["batched_tokens"] / stats["steps"], 2) if stats["steps"] else None
+        stats["tokens_per_s"] = round(stats["generated_tokens"] / stats["busy_s"], 2) if stats["busy_s"] else None
+        stats["busy_s"] = round(stats["busy_s"], 2)
+        return stats
+
+
+scheduler = GenerationScheduler(LLM_MAX_QUEUE_DEPTH)
+if llm is not None and LLM_MAX_BATCH_SIZE > 1:
+    try:
+        format_chat = chat_formatter(llm)
+        scheduler = BatchedGenerationScheduler(LLM_MAX_QUEUE_DEPTH, llm, LLM_MAX_BATCH_SIZE)
+        print(f"Generazione in batch attiva: fino a {LLM_MAX_BATCH_SIZE} richieste insieme.")
+    except Exception as e:
+        print(f"ERRORE CRITICO durante la creazione del contesto per la generazione in batch: {e}")
+        llm = None
+# Un solo worker di Gunicorn serve il modello: la profondità della coda si legge direttamente
+Gauge("llm_queue_depth", "Richieste in attesa nella coda").set_function(lambda: len(scheduler._heap))
+
+# -----------------------------------------------------------------------------
+# 5. DEFINIZIONE DELL'ENDPOINT API
 # -----------------------------------------------------------------------------
+def sse_event(data):
+    # Formatta un evento server-sent events con un payload JSON
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def stream_events(job):
+    """Inoltra gli eventi della richiesta in coda come eventi SSE.
+
+    Ogni evento contiene {"token": "..."}; la generazione termina con {"done": true}
+    (insieme alle statistiche sul prompt riusato dalla cache dei prefissi) oppure,
+    in caso di errore a stream già avviato, con {"error": "..."}.
+    """
+    try:
+        for event in job.results():
+            yield sse_event(event)
+    except DeadlineExceededError as e:
+        yield sse_event({"error": str(e)})
+    except Exception as e:
+        print(f"[{g.request_id}] Errore durante la generazione del testo in streaming: {e}")
+        yield sse_event({"error": "Errore interno del server durante la generazione."})
+
+
 @app.route('/generate', methods=['POST'])
 def generate_text():
     # Se il modello non è stato caricato, restituisce un errore
@@ -71,28 +865,112 @@ def generate_text():
 
     # Estrae il numero massimo di token, con un valore di default se non fornito
     max_tokens = json_data.get('max_tokens', 512)
+    if isinstance(max_tokens, bool) or not isinstance(max_tokens, int) or max_tokens <= 0:
+        return jsonify({"error": "La chiave 'max_tokens' deve essere un intero positivo."}), 400
+
+    # Priorità esplicita oppure dedotta dalla lunghezza massima della risposta
+    priority_name = json_data.get('priority') or ("interactive" if max_tokens <= LLM_INTERACTIVE_MAX_TOKENS else "batch")
+    if priority_name not in PRIORITIES:
+        return jsonify({"error": f"Priorità non valida: usa una tra {', '.join(PRIORITIES)}."}), 400
+
+    # Il client può indicare dopo quanti secondi smetterà di attendere la risposta
+    # (in streaming vale fino al primo token, poi conta il timeout di lettura del client)
+    try:
+        timeout = float(request.headers.get('X-Request-Timeout', LLM_DEFAULT_TIMEOUT))
+    except ValueError:
+        return jsonify({"error": "L'header X-Request-Timeout deve essere un numero di secondi."}), 400
+    deadline = time.monotonic() + min(timeout, LLM_DEFAULT_TIMEOUT)
 
     try:
-        # Genera la risposta usando il metodo create_chat_completion
-        response = llm.create_chat_completion(
-            messages=messages,
-            max_tokens=max_tokens
+        work = chat_sequence(messages, max_tokens) if LLM_MAX_BATCH_SIZE > 1 else chat_completion_job(messages, max_tokens)
+        job = scheduler.submit(
+            work, PRIORITIES[priority_name], deadline, g.request_id,
+            stream=bool(json_data.get('stream'))
         )
-        
-        # Estrae il contenuto del messaggio di risposta
-        cleaned_response = response['choices'][0]['message']['content'].strip()
+    except QueueFullError as e:
+        response = jsonify({"error": "Servizio sovraccarico, riprova più tardi."})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 503
+
+    # Con "stream": true i token vengono inviati man mano che il modello li produce
+    if json_data.get('stream'):
+        return Response(
+            stream_with_context(stream_events(job)),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+    try:
+        # Attende la generazione completa e ricompone il testo della risposta
+        tokens = []
+        stats = {}
+        for event in job.results():
+            if "token" in event:
+                tokens.append(event["token"])
+            else:
+                stats = event
+        cleaned_response = "".join(tokens).strip()
+        stats.pop("done", None)
 
-        # Restituisce la risposta in formato JSON
-        return jsonify({"response": cleaned_response})
+        # Restituisce la risposta in formato JSON, con i token del prompt riusati dalla cache
+        return jsonify(dict(stats, response=cleaned_response))
 
+    except DeadlineExceededError as e:
+        return jsonify({"error": str(e)}), 504
     except Exception as e:
-        print(f"Errore durante la generazione del testo: {e}")
+        print(f"[{g.request_id}] Errore durante la generazione del testo: {e}")
         return jsonify({"error": "Errore interno del server durante la generazione."}), 500
 
+
+@app.route('/tokenize', methods=['POST'])
+def tokenize_texts():
+    # Conta i token dei testi con il tokenizer del modello, senza passare dalla coda:
+    # l'orchestratore lo usa per riempire il contesto RAG senza superare n_ctx.
+    if llm is None:
+        return jsonify({"error": "Il modello non è disponibile a causa di un errore di caricamento."}), 503
+
+    json_data = request.get_json()
+    texts = (json_data or {}).get('texts')
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return jsonify({"error": "La chiave 'texts' è obbligatoria e deve essere una lista di stringhe."}), 400
+
+    counts = [len(llm.tokenize(text.encode("utf-8"), add_bos=False, special=False)) for text in texts]
+    return jsonify({"counts": counts, "n_ctx": LLM_CONTEXT_SIZE})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Metriche Prometheus (con PROMETHEUS_MULTIPROC_DIR si aggregano più processi)
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+@app.route('/queue-stats', methods=['GET'])
+def queue_stats():
+    # Profondità della coda e tempi di attesa, utili per l'autoscaling
+    return jsonify(scheduler.snapshot())
+
+
+@app.route('/prefix-cache', methods=['GET'])
+def prefix_cache_stats():
+    # Stato della cache dei prefissi: occupazione e token di prompt risparmiati
+    if prefix_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify(dict(
+        prefix_cache.stats,
+        enabled=True,
+        backend=LLM_PREFIX_CACHE,
+        size_bytes=prefix_cache.cache_size,
+        capacity_bytes=prefix_cache.capacity_bytes
+    ))
+
 # -----------------------------------------------------------------------------
-# 4. AVVIO DEL SERVER (usato solo per test locali)
+# 6. AVVIO DEL SERVER (usato solo per test locali)
 # -----------------------------------------------------------------------------
 if __name__ == '__main__':
     # Questo blocco viene eseguito solo se avvii lo script con "python app.py".
     # In produzione su OpenShift, Gunicorn avvierà l'app, ignorando questo blocco.
-    app.run(host='0.0.0.0', port=8080)
\ No newline at end of file
+    app.run(host='0.0.0.0', port=8080)
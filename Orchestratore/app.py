@@ -3,33 +3,927 @@
 # ==============================================================================
 import os
 import requests
-import chromadb
+import requests.adapters
+import urllib3.exceptions
 import uuid
 import io
-from flask import Flask, request, jsonify
+import contextlib
+import fcntl
+import hashlib
+import json
+import multiprocessing
+import threading
+import time
+import numpy as np
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from flask import Flask, Response, g, request, jsonify
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram, generate_latest, multiprocess
 from pypdf import PdfReader
 
+import pdf_worker
+
 app = Flask(__name__)
 app.config['JSON_AS_ASCII'] = False
 
 # Leggi la configurazione dei servizi dipendenti dalle variabili d'ambiente
 EMBEDDING_API_URL = os.getenv("EMBEDDING_API_URL", "http://embedding-service:8080/create-embedding")
 LLM_API_URL = os.getenv("LLM_API_URL", "http://llm-api-service:8080/generate") 
+# Endpoint per contare i token con il tokenizer del modello (stesso servizio LLM)
+LLM_TOKENIZE_URL = os.getenv("LLM_TOKENIZE_URL", LLM_API_URL.rsplit("/", 1)[0] + "/tokenize")
+# Contesto del modello usato se il servizio LLM non riesce a contare i token
+LLM_CONTEXT_WINDOW = int(os.getenv("LLM_CONTEXT_WINDOW", "4096"))
+# Backend dei vettori: "chroma" (server ChromaDB condiviso e durevole) oppure
+# "numpy" (indice locale in VECTOR_INDEX_PATH, senza round-trip di rete)
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "chroma")
 CHROMA_HOST = os.getenv("CHROMA_HOST", "chromadb-service")
 CHROMA_PORT = int(os.getenv("CHROMA_PORT", "8000"))
+# Timeout (in secondi) di ogni chiamata a ChromaDB e connessioni massime per processo:
+# oltre il limite le chiamate attendono una connessione libera, al più CHROMA_TIMEOUT
+CHROMA_TIMEOUT = float(os.getenv("CHROMA_TIMEOUT", "30"))
+CHROMA_MAX_CONNECTIONS = int(os.getenv("CHROMA_MAX_CONNECTIONS", "16"))
+# Cartella dell'indice locale; con più repliche va montata su un volume comune
+VECTOR_INDEX_PATH = os.getenv("VECTOR_INDEX_PATH", "/tmp/vector-index")
+# Con "1" le matrici dei vettori vengono mappate dal disco invece che copiate in memoria
+VECTOR_INDEX_MMAP = os.getenv("VECTOR_INDEX_MMAP", "1") == "1"
+# Formato di trasferimento degli embedding: "float32" o "float16" (binario) oppure "json"
+EMBEDDING_WIRE_FORMAT = os.getenv("EMBEDDING_WIRE_FORMAT", "float32")
+# Secondi di attesa massima della risposta dell'LLM, comunicati anche al servizio
+# LLM (header X-Request-Timeout) perché scarti le richieste ormai inutili
+LLM_TIMEOUT = int(os.getenv("LLM_TIMEOUT", "300"))
+# Timeout (in secondi) e connessioni massime verso ciascun servizio dipendente.
+# Le connessioni sono keep-alive e vengono riutilizzate tra le richieste.
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "64"))
+EMBEDDING_TIMEOUT = float(os.getenv("EMBEDDING_TIMEOUT", "60"))
+EMBEDDING_MAX_CONNECTIONS = int(os.getenv("EMBEDDING_MAX_CONNECTIONS", "16"))
+# Secondi di attesa massima di una connessione libera quando il pool è pieno:
+# oltre si risponde 503 invece di bloccare il worker
+HTTP_POOL_TIMEOUT = float(os.getenv("HTTP_POOL_TIMEOUT", "30"))
+
+# Metriche in formato Prometheus, esposte su /metrics. Con più worker di Gunicorn
+# ogni processo scrive i propri valori in PROMETHEUS_MULTIPROC_DIR e /metrics
+# restituisce la somma di tutti i worker.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+STAGE_SECONDS = Histogram(
+    "orchestrator_stage_seconds", "Durata delle fasi di /index-pdf e /chat (tempo cumulato per richiesta)",
+    ["operation", "stage"], buckets=LATENCY_BUCKETS
+)
+OPERATIONS = Counter("orchestrator_operations_total", "Indicizzazioni e chat concluse, per esito", ["operation", "outcome"])
+UPSTREAM_SECONDS = Histogram(
+    "orchestrator_upstream_request_seconds", "Durata delle chiamate ai servizi dipendenti",
+    ["service"], buckets=LATENCY_BUCKETS
+)
+EMBEDDING_REQUEST_ITEMS = Histogram(
+    "orchestrator_embedding_request_items", "Testi inviati in una richiesta al servizio di embedding",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256)
+)
+CONTEXT_TOKENS = Histogram(
+    "orchestrator_context_tokens", "Token del contesto RAG inviato all'LLM",
+    buckets=(0, 128, 256, 512, 1024, 2048, 4096, 8192)
+)
+
+# ID della richiesta, ricevuto da ui.py (o generato qui) e inoltrato ai servizi di
+# embedding e LLM: compare nei log di ogni servizio attraversato dalla richiesta.
+REQUEST_ID_HEADER = "X-Request-ID"
+
+
+def request_id_from(headers):
+    return (headers.get(REQUEST_ID_HEADER) or "").strip()[:64] or uuid.uuid4().hex
+
+
+@app.before_request
+def assign_request_id():
+    g.request_id = request_id_from(request.headers)
+
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers[REQUEST_ID_HEADER] = g.request_id
+    return response
+
+
+class StageTimer:
+    """Tempi delle fasi di una singola indicizzazione o chat.
+
+    Ogni fase accumula il proprio tempo (anche da più thread); a fine operazione i
+    tempi finiscono negli istogrammi e in una riga di log con l'ID della richiesta.
+    """
+
+    def __init__(self, operation, request_id):
+        self.operation = operation
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.durations = {}
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    def since(self, stage, started):
+        self.add(stage, time.perf_counter() - started)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.since(name, started)
+
+    def finish(self, outcome):
+        with self._lock:
+            if self.finished:
+                return
+            self.finished = True
+            durations = dict(self.durations, total=time.perf_counter() - self.started)
+        for stage, seconds in durations.items():
+            STAGE_SECONDS.labels(self.operation, stage).observe(seconds)
+        OPERATIONS.labels(self.operation, outcome).inc()
+        stages = ", ".join(f"{stage} {seconds:.3f}s" for stage, seconds in durations.items())
+        print(f"[{self.request_id}] {self.operation} ({outcome}): {stages}")
+
+
+def open_vector_store():
+    # Entrambi i backend espongono la stessa interfaccia (quella del client di ChromaDB)
+    if VECTOR_BACKEND == "numpy":
+        from vector_store import NumpyVectorStore
+        print(f"Indice vettoriale locale in {VECTOR_INDEX_PATH} (mmap: {VECTOR_INDEX_MMAP}).")
+        return NumpyVectorStore(VECTOR_INDEX_PATH, use_mmap=VECTOR_INDEX_MMAP)
+    import chromadb
+    import httpx
+    from chromadb.config import Settings
+    try:
+        print(f"Connessione a ChromaDB su {CHROMA_HOST}:{CHROMA_PORT}...")
+        client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT, settings=Settings(
+            chroma_http_max_connections=CHROMA_MAX_CONNECTIONS,
+            chroma_http_max_keepalive_connections=CHROMA_MAX_CONNECTIONS
+        ))
+        # Il client crea la sua sessione httpx senza timeout e non lo rende configurabile:
+        # senza un limite una chiamata (o l'attesa di una connessione) può restare appesa
+        session = getattr(getattr(client, "_server", None), "_session", None)
+        if isinstance(session, httpx.Client):
+            session.timeout = httpx.Timeout(CHROMA_TIMEOUT)
+        else:
+            print("Attenzione: impossibile impostare il timeout del client di ChromaDB.")
+        print("Connessione a ChromaDB riuscita. ✅")
+        return client
+    except Exception as e:
+        print(f"ERRORE: Impossibile connettersi a ChromaDB. {e}")
+        return None
+
+
+vector_store = open_vector_store()
+
+
+class BoundedWaitAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter che attende una connessione libera al più pool_timeout secondi.
+
+    requests non passa un timeout al pool di urllib3: con pool_block=True una
+    richiesta attenderebbe per sempre. Scaduta l'attesa, urllib3 solleva EmptyPoolError.
+    """
+
+    def __init__(self, pool_timeout, **kwargs):
+        self.pool_timeout = pool_timeout
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        pool_timeout = self.pool_timeout
+
+        def urlopen(pool, *urlopen_args, **urlopen_kwargs):
+            urlopen_kwargs.setdefault("pool_timeout", pool_timeout)
+            return super(type(pool), pool).urlopen(*urlopen_args, **urlopen_kwargs)
+
+        self.poolmanager.pool_classes_by_scheme = {
+            scheme: type(pool_class.__name__, (pool_class,), {"urlopen": urlopen})
+            for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items()
+        }
+
 
-try:
-    print(f"Connessione a ChromaDB su {CHROMA_HOST}:{CHROMA_PORT}...")
-    chroma_client = chromadb.HttpClient(host=CHROMA_HOST, port=CHROMA_PORT)
-    print("Connessione a ChromaDB riuscita. ✅")
-except Exception as e:
-    print(f"ERRORE: Impossibile connettersi a ChromaDB. {e}")
-    chroma_client = None
+def pooled_session(max_connections):
+    # Sessione HTTP con un pool limitato di connessioni keep-alive: oltre il limite
+    # le richieste attendono una connessione libera (al più HTTP_POOL_TIMEOUT secondi)
+    # invece di aprirne di nuove.
+    session = requests.Session()
+    adapter = BoundedWaitAdapter(HTTP_POOL_TIMEOUT, pool_connections=1, pool_maxsize=max_connections, pool_block=True)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+embedding_session = pooled_session(EMBEDDING_MAX_CONNECTIONS)
+llm_session = pooled_session(LLM_MAX_CONNECTIONS)
+
+
+def embedding_request_headers(request_id=None):
+    headers = {REQUEST_ID_HEADER: request_id} if request_id else {}
+    if EMBEDDING_WIRE_FORMAT != "json":
+        headers.update({"Accept": "application/octet-stream", "X-Embedding-Dtype": EMBEDDING_WIRE_FORMAT})
+    return headers
+
+
+def decode_embeddings(headers, content):
+    """Decodifica la risposta del servizio di embedding in un array NumPy float32.
+
+    In formato binario il buffer viene decodificato senza copie con np.frombuffer;
+    solo il float16 viene convertito in float32 per l'indice vettoriale.
+    """
+    if "X-Embedding-Shape" not in headers:
+        return np.asarray(json.loads(content)['embedding'], dtype=np.float32)
+    shape = tuple(int(dim) for dim in headers["X-Embedding-Shape"].split(","))
+    dtype = np.dtype(headers["X-Embedding-Dtype"]).newbyteorder("<")
+    embeddings = np.frombuffer(content, dtype=dtype).reshape(shape)
+    return embeddings if embeddings.dtype == np.float32 else embeddings.astype(np.float32)
+
+
+def create_embeddings(text, request_id=None):
+    """Chiede gli embedding al servizio dedicato e li restituisce come array NumPy float32.
+
+    Accetta un testo singolo (restituisce un vettore) o una lista di testi (restituisce
+    una matrice).
+    """
+    EMBEDDING_REQUEST_ITEMS.observe(len(text) if isinstance(text, list) else 1)
+    with UPSTREAM_SECONDS.labels("embedding").time():
+        response = embedding_session.post(
+            EMBEDDING_API_URL, json={"text": text}, headers=embedding_request_headers(request_id), timeout=EMBEDDING_TIMEOUT
+        )
+    response.raise_for_status()
+    return decode_embeddings(response.headers, response.content)
 
 
 # ==============================================================================
-# 2. ENDPOINT PER L'INDICIZZAZIONE DEL PDF
+# 2. PIPELINE DI INDICIZZAZIONE DEL PDF
 # ==============================================================================
+# Processi usati per estrarre il testo delle pagine in parallelo e pagine per ogni task
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", str(min(4, os.cpu_count() or 1))))
+PDF_PAGES_PER_TASK = int(os.getenv("PDF_PAGES_PER_TASK", "8"))
+# Chunk per ogni richiesta di embedding e richieste di embedding in volo contemporaneamente
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+EMBEDDING_MAX_IN_FLIGHT = int(os.getenv("EMBEDDING_MAX_IN_FLIGHT", "4"))
+# Cartella in cui vengono salvati i job di indicizzazione. È condivisa dai worker
+# di Gunicorn dello stesso pod; con più repliche va montata su un volume comune.
+JOBS_DIR = os.getenv("JOBS_DIR", "/tmp/ingest-jobs")
+# Un job che non aggiorna il proprio stato da più di questi secondi è considerato interrotto
+JOB_STALE_AFTER = int(os.getenv("JOB_STALE_AFTER", "600"))
+# I file dei job conclusi (o interrotti) vengono eliminati dal sweeper dopo questi secondi
+JOB_RETENTION = int(os.getenv("JOB_RETENTION", "3600"))
+# Collection globale con i vettori già calcolati, indicizzati per hash del testo del chunk
+CHUNK_REGISTRY_COLLECTION = os.getenv("CHUNK_REGISTRY_COLLECTION", "chunk-registry")
+# Identifica il modello di embedding: cambiandolo, i vettori salvati non vengono più riusati
+EMBEDDING_MODEL_ID = os.getenv("EMBEDDING_MODEL_ID", "clip-ViT-B-32")
+
+CHUNK_SIZE, CHUNK_OVERLAP = 3, 1
+
+def iter_page_texts(pdf_bytes, num_pages):
+    """Restituisce il testo delle pagine in ordine, estraendolo in parallelo.
+
+    Le pagine vengono divise in gruppi di PDF_PAGES_PER_TASK ed estratte da un pool
+    di processi; i PDF piccoli vengono letti direttamente, senza avviare il pool.
+    I processi partono da un forkserver e non con fork: questo worker ha altri thread
+    attivi, e un figlio creato mentre uno di loro tiene un lock potrebbe bloccarsi.
+    """
+    if PDF_EXTRACT_WORKERS <= 1 or num_pages <= PDF_PAGES_PER_TASK:
+        reader = PdfReader(io.BytesIO(pdf_bytes))
+        for page in reader.pages:
+            yield page.extract_text() or ""
+        return
+
+    with ProcessPoolExecutor(
+        max_workers=PDF_EXTRACT_WORKERS,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=pdf_worker.init_pdf_worker,
+        initargs=(pdf_bytes,)
+    ) as pool:
+        futures = [
+            pool.submit(pdf_worker.extract_page_range, start, min(start + PDF_PAGES_PER_TASK, num_pages))
+            for start in range(0, num_pages, PDF_PAGES_PER_TASK)
+        ]
+        for future in futures:
+            yield from future.result()
+
+
+class StreamingChunker:
+    """Divide in chunk il testo man mano che arrivano le pagine.
+
+    Produce esattamente gli stessi chunk della suddivisione sul testo completo:
+    paragrafi separati da una riga vuota, raggruppati a CHUNK_SIZE con
+    CHUNK_OVERLAP paragrafi in comune tra chunk consecutivi. Un chunk viene emesso
+    appena tutti i suoi paragrafi sono completi.
+    """
+
+    def __init__(self):
+        self.stride = CHUNK_SIZE - CHUNK_OVERLAP
+        self.buffer = ""
+        self.paragraphs = []
+        self.next_start = 0
+
+    def _add_paragraphs(self, pieces):
+        self.paragraphs.extend(p.strip() for p in pieces if p.strip())
+
+    def feed(self, page_text):
+        # L'ultimo pezzo potrebbe continuare nella pagina successiva: resta nel buffer
+        pieces = (self.buffer + page_text).split('\n\n')
+        self.buffer = pieces.pop()
+        self._add_paragraphs(pieces)
+        chunks = []
+        while self.next_start + CHUNK_SIZE <= len(self.paragraphs):
+            chunks.append("\n\n".join(self.paragraphs[self.next_start:self.next_start + CHUNK_SIZE]))
+            self.next_start += self.stride
+        return chunks
+
+    def finish(self):
+        self._add_paragraphs([self.buffer])
+        self.buffer = ""
+        chunks = []
+        for i in range(self.next_start, len(self.paragraphs), self.stride):
+            chunks.append("\n\n".join(self.paragraphs[i:i + CHUNK_SIZE]))
+            if i + self.stride >= len(self.paragraphs): break
+        self.next_start = len(self.paragraphs)
+        return chunks
+
+
+class JobStore:
+    """Stato dei job di indicizzazione, salvato come file JSON (uno per job)."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def create(self, **fields):
+        job_id = str(uuid.uuid4())
+        now = time.time()
+        self._write(job_id, dict(fields, job_id=job_id, status="queued", created_at=now, updated_at=now))
+        return job_id
+
+    def delete(self, job_id):
+        try:
+            os.remove(self._path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def is_active(self, job):
+        return job is not None and job["status"] in ("queued", "running") and time.time() - job["updated_at"] < JOB_STALE_AFTER
+
+    def claim(self, key, job_id):
+        """Assegna la chiave al job, se nessun altro job attivo la possiede già.
+
+        Restituisce l'ID del job proprietario: job_id se l'assegnazione è riuscita,
+        altrimenti quello del job attivo che sta già lavorando sulla stessa chiave.
+        """
+        path = os.path.join(self.directory, f"{key}.owner")
+        while True:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    with open(path, encoding="utf-8") as f:
+                        owner = f.read().strip()
+                except FileNotFoundError:
+                    continue
+                if self.is_active(self.get(owner)):
+                    return owner
+                # Il proprietario è terminato o interrotto: la chiave si può riassegnare
+                self.release(key, owner)
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(job_id)
+            return job_id
+
+    def release(self, key, job_id):
+        path = os.path.join(self.directory, f"{key}.owner")
+        try:
+            with open(path, encoding="utf-8") as f:
+                if f.read().strip() == job_id:
+                    os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def owner(self, key):
+        # ID del job che possiede la chiave, oppure None
+        try:
+            with open(os.path.join(self.directory, f"{key}.owner"), encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def purge(self, retention):
+        """Elimina i job non più attivi da più di retention secondi e le assegnazioni
+        (file .owner) rimaste a job non più attivi. Restituisce i job eliminati."""
+        now = time.time()
+        removed = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                job = self.get(name[:-len(".json")])
+                if job is not None and not self.is_active(job) and now - job["updated_at"] > retention:
+                    self.delete(job["job_id"])
+                    removed += 1
+            elif name.endswith(".owner"):
+                try:
+                    with open(os.path.join(self.directory, name), encoding="utf-8") as f:
+                        owner = f.read().strip()
+                except FileNotFoundError:
+                    continue
+                # Un file ancora vuoto è un'assegnazione in corso: non va toccato
+                if owner and not self.is_active(self.get(owner)):
+                    self.release(name[:-len(".owner")], owner)
+        return removed
+
+    def wait(self, job_id, timeout, poll_interval=0.5):
+        # Attende che il job termini e ne restituisce lo stato finale
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            if not self.is_active(job) or time.monotonic() >= deadline:
+                return job
+            time.sleep(poll_interval)
+
+    def get(self, job_id):
+        try:
+            with open(self._path(job_id), encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            job = self.get(job_id) or {"job_id": job_id}
+            job.update(fields, updated_at=time.time())
+            self._write(job_id, job)
+
+    def _write(self, job_id, job):
+        # Scrittura atomica: chi legge vede sempre un file completo
+        tmp_path = f"{self._path(job_id)}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, self._path(job_id))
+
+
+jobs = JobStore(JOBS_DIR)
+
+
+def file_collection_name(file_hash):
+    # Il nome della collection deriva dal contenuto del file: lo stesso PDF
+    # caricato di nuovo, anche da un altro utente, ritrova la stessa collection.
+    return f"doc-{uuid.UUID(hex=file_hash[:32])}"
+
+
+def find_indexed_collection(collection_name):
+    # Restituisce la collection solo se la sua indicizzazione è stata completata
+    try:
+        collection = vector_store.get_collection(name=collection_name)
+    except Exception:
+        return None
+    return collection if (collection.metadata or {}).get("status") == "ready" else None
+
+
+def stored_bytes(documents, embedding_dim):
+    # Stima dello spazio occupato nell'indice: testo dei chunk più vettori float32
+    return sum(len(document.encode("utf-8")) for document in documents) + len(documents) * embedding_dim * 4
+
+
+def chunk_hash(chunk):
+    return hashlib.sha256(f"{EMBEDDING_MODEL_ID}\0{chunk}".encode("utf-8")).hexdigest()
+
+
+def embed_chunks(chunks, timer):
+    """Restituisce gli embedding dei chunk, calcolando solo quelli mai visti prima.
+
+    I vettori di ogni chunk sono salvati nella collection CHUNK_REGISTRY_COLLECTION
+    con l'hash del testo come ID: una versione modificata di un documento già
+    indicizzato riusa i vettori dei chunk invariati. Restituisce (embeddings, riusati).
+    """
+    with timer.stage("registry"):
+        registry = vector_store.get_or_create_collection(name=CHUNK_REGISTRY_COLLECTION)
+        hashes = [chunk_hash(chunk) for chunk in chunks]
+        unique_hashes = list(dict.fromkeys(hashes))
+        found = registry.get(ids=unique_hashes, include=["embeddings"])
+    vectors = {
+        key: np.asarray(vector, dtype=np.float32)
+        for key, vector in zip(found["ids"], found["embeddings"])
+    }
+
+    missing = {key: chunk for key, chunk in zip(hashes, chunks) if key not in vectors}
+    if missing:
+        with timer.stage("embed"):
+            new_vectors = create_embeddings(list(missing.values()), timer.request_id)
+        with timer.stage("registry"):
+            registry.upsert(ids=list(missing.keys()), embeddings=new_vectors)
+        vectors.update(zip(missing.keys(), new_vectors))
+
+    reused = sum(1 for key in hashes if key not in missing)
+    return np.stack([vectors[key] for key in hashes]), reused
+
+
+def run_ingestion(job_id, filename, pdf_bytes, collection_name, file_hash, request_id=None):
+    """Indicizza il PDF aggiornando lo stato del job a ogni passo.
+
+    Estrazione delle pagine, chunking, embedding e inserimento nell'indice avvengono
+    in pipeline: i chunk vengono inviati al servizio di embedding a gruppi di
+    EMBEDDING_BATCH_SIZE, con al più EMBEDDING_MAX_IN_FLIGHT richieste in corso,
+    e inseriti nella collection appena i loro vettori sono pronti. La collection
+    viene marcata "ready" solo alla fine, così un'indicizzazione interrotta non
+    viene mai riusata.
+    """
+    timer = StageTimer("index_pdf", request_id or job_id)
+    try:
+        num_pages = len(PdfReader(io.BytesIO(pdf_bytes)).pages)
+        jobs.update(job_id, status="running", pages_total=num_pages, pages_done=0, chunks_done=0, chunks_indexed=0, chunks_reused=0)
+
+        # Un altro job può aver completato lo stesso file nel frattempo: la collection
+        # "ready" è già in uso e non va ricreata
+        if find_indexed_collection(collection_name) is not None:
+            result = {
+                "message": f"File '{filename}' già indicizzato: riutilizzo l'indice esistente.",
+                "collection_name": collection_name,
+                "deduplicated": True
+            }
+            jobs.update(job_id, status="done", **result)
+            timer.finish("deduplicated")
+            return result
+
+        # Una collection con lo stesso nome ma non "ready" è il resto di un tentativo fallito
+        try:
+            vector_store.delete_collection(name=collection_name)
+        except Exception:
+            pass
+        print(f"Creazione di una nuova collection: {collection_name}")
+        metadata = {"file_sha256": file_hash, "filename": filename, "status": "indexing", "created_at": time.time()}
+        collection = vector_store.create_collection(name=collection_name, metadata=metadata)
+
+        chunker = StreamingChunker()
+        pending = []
+        in_flight = deque()
+        counters = {"chunks_done": 0, "chunks_indexed": 0, "chunks_reused": 0, "bytes_indexed": 0}
+
+        with ThreadPoolExecutor(max_workers=EMBEDDING_MAX_IN_FLIGHT) as embedding_pool:
+            def submit(batch):
+                start = counters["chunks_done"]
+                counters["chunks_done"] += len(batch)
+                in_flight.append((start, batch, embedding_pool.submit(embed_chunks, batch, timer)))
+
+            def drain(max_in_flight):
+                # Inserisce, in ordine, i batch già inviati finché ne restano al più max_in_flight
+                while len(in_flight) > max_in_flight:
+                    start, batch, future = in_flight.popleft()
+                    with timer.stage("embed_wait"):
+                        embeddings, reused = future.result()
+                    ids = [f"{filename}_chunk_{start + i}" for i in range(len(batch))]
+                    with timer.stage("store"):
+                        collection.add(embeddings=embeddings, documents=batch, ids=ids)
+                    counters["chunks_indexed"] += len(batch)
+                    counters["bytes_indexed"] += stored_bytes(batch, embeddings.shape[1])
+                    counters["chunks_reused"] += reused
+
+            def add_chunks(chunks):
+                pending.extend(chunks)
+                while len(pending) >= EMBEDDING_BATCH_SIZE:
+                    submit(pending[:EMBEDDING_BATCH_SIZE])
+                    del pending[:EMBEDDING_BATCH_SIZE]
+                    drain(EMBEDDING_MAX_IN_FLIGHT)
+
+            # "extract" è l'attesa del testo di ogni pagina (estratto in parallelo)
+            waiting_since = time.perf_counter()
+            for page_number, page_text in enumerate(iter_page_texts(pdf_bytes, num_pages), start=1):
+                timer.since("extract", waiting_since)
+                with timer.stage("chunk"):
+                    chunks = chunker.feed(page_text)
+                add_chunks(chunks)
+                jobs.update(job_id, pages_done=page_number, **counters)
+                waiting_since = time.perf_counter()
+            add_chunks(chunker.finish())
+            if pending:
+                submit(pending)
+            drain(0)
+
+        if counters["chunks_done"] == 0:
+            vector_store.delete_collection(name=collection_name)
+            result = {"message": "Il PDF non contiene testo estraibile.", "collection_name": None}
+        else:
+            now = time.time()
+            collection.modify(metadata=dict(
+                metadata, status="ready", indexed_at=now, last_access=now,
+                chunks=counters["chunks_done"], bytes=counters["bytes_indexed"]
+            ))
+            result = {
+                "message": f"File '{filename}' indicizzato con successo.",
+                "collection_name": collection_name
+            }
+        jobs.update(job_id, status="done", **counters, **result)
+        timer.finish("ok" if result["collection_name"] else "empty")
+        return result
+
+    except Exception as e:
+        print(f"[{timer.request_id}] Errore durante l'indicizzazione: {e}")
+        jobs.update(job_id, status="failed", error=str(e))
+        timer.finish("error")
+        raise
+    finally:
+        jobs.release(f"sha256-{file_hash}", job_id)
+
+
+def run_ingestion_in_background(*args):
+    try:
+        run_ingestion(*args)
+    except Exception:
+        pass  # l'errore è già registrato nello stato del job
+
+
+def job_result(job):
+    # Converte lo stato finale di un job nella risposta di /index-pdf
+    if job is None or job["status"] != "done":
+        error = "Indicizzazione non completata." if job is None else job.get("error", "Indicizzazione non completata.")
+        return jsonify({"error": f"Errore interno del server: {error}"}), 500
+    if job.get("collection_name") is None:
+        return jsonify({"message": job["message"]})
+    result = {"message": job["message"], "collection_name": job["collection_name"]}
+    if job.get("deduplicated"):
+        result["deduplicated"] = True
+    return jsonify(result)
+
+
+# ==============================================================================
+# 3. CICLO DI VITA DELLE COLLECTION
+# ==============================================================================
+# Le collection dei documenti (doc-*) non usate da più di questi secondi vengono
+# eliminate (0 = mai). L'ultimo accesso è aggiornato da /chat e dai ricaricamenti.
+COLLECTION_IDLE_TTL = int(os.getenv("COLLECTION_IDLE_TTL", str(7 * 24 * 3600)))
+# Spazio massimo (in byte, stimato) occupato da tutte le collection doc-*: oltre
+# il limite si eliminano le meno usate di recente (0 = nessun limite)
+COLLECTION_MAX_BYTES = int(os.getenv("COLLECTION_MAX_BYTES", "0"))
+# Secondi tra due passate del sweeper (0 = nessuna pulizia automatica)
+COLLECTION_SWEEP_INTERVAL = int(os.getenv("COLLECTION_SWEEP_INTERVAL", "300"))
+# L'ultimo accesso di una collection viene salvato al più una volta ogni tanti secondi
+COLLECTION_ACCESS_UPDATE_INTERVAL = int(os.getenv("COLLECTION_ACCESS_UPDATE_INTERVAL", "60"))
+# Se impostato, gli endpoint /admin richiedono l'header X-Admin-Token con questo valore
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+DOCUMENT_COLLECTION_PREFIX = "doc-"
+
+# Ultimo salvataggio dell'accesso per ogni collection, in questo processo
+_last_access_saved = {}
+_last_access_lock = threading.Lock()
+
+
+def touch_collection(collection):
+    """Registra l'uso della collection nei suoi metadata, al più una volta ogni
+    COLLECTION_ACCESS_UPDATE_INTERVAL secondi per processo."""
+    now = time.time()
+    with _last_access_lock:
+        if now - _last_access_saved.get(collection.name, 0) < COLLECTION_ACCESS_UPDATE_INTERVAL:
+            return
+        _last_access_saved[collection.name] = now
+    try:
+        collection.modify(metadata=dict(collection.metadata or {}, last_access=now))
+    except Exception as e:
+        print(f"Impossibile aggiornare l'ultimo accesso di {collection.name}: {e}")
+
+
+def list_document_collections():
+    # Le versioni di chromadb restituiscono oggetti Collection oppure solo i nomi
+    names = [c if isinstance(c, str) else c.name for c in vector_store.list_collections()]
+    return [vector_store.get_collection(name=name) for name in names if name.startswith(DOCUMENT_COLLECTION_PREFIX)]
+
+
+def describe_collection(collection, now):
+    """Metadata di ciclo di vita di una collection.
+
+    Le collection create prima del tracciamento non hanno created_at e bytes: al
+    primo passaggio vengono misurate e considerate create in quel momento.
+    """
+    metadata = dict(collection.metadata or {})
+    if "created_at" not in metadata:
+        stored = collection.get(include=["documents", "embeddings"])
+        embedding_dim = len(stored["embeddings"][0]) if len(stored["ids"]) else 0
+        metadata.update(created_at=now, chunks=len(stored["ids"]), bytes=stored_bytes(stored["documents"], embedding_dim))
+        metadata.setdefault("status", "ready")
+        collection.modify(metadata=metadata)
+    last_access = metadata.get("last_access", metadata.get("indexed_at", metadata["created_at"]))
+    ingesting = False
+    if metadata["status"] == "indexing":
+        # Un'indicizzazione lunga non è inattiva: conta l'ultimo avanzamento del suo job
+        job = jobs.get(jobs.owner(f"sha256-{metadata.get('file_sha256')}") or "")
+        if jobs.is_active(job) and job.get("collection_name") == collection.name:
+            last_access = max(last_access, job["updated_at"])
+            ingesting = True
+    return {
+        "name": collection.name,
+        "filename": metadata.get("filename"),
+        "status": metadata["status"],
+        "created_at": metadata["created_at"],
+        "last_access": last_access,
+        "idle_seconds": round(now - last_access, 1),
+        "chunks": metadata.get("chunks", 0),
+        "bytes": metadata.get("bytes", 0),
+        "ingesting": ingesting,
+    }
+
+
+def delete_collection(name):
+    vector_store.delete_collection(name=name)
+    with _last_access_lock:
+        _last_access_saved.pop(name, None)
+    print(f"Collection eliminata: {name}")
+
+
+def chunk_registry_usage(live_names):
+    """Stato del registro dei chunk rispetto alle collection ancora presenti.
+
+    Restituisce (registro o None, ID nel registro, {collection: hash usati}, byte
+    stimati per hash: vettore float32 più l'ID di 64 caratteri).
+    """
+    try:
+        registry = vector_store.get_collection(name=CHUNK_REGISTRY_COLLECTION)
+    except Exception:
+        return None, set(), {}, 0
+    # Prima gli ID del registro e poi i chunk: un hash aggiunto nel frattempo da
+    # un'indicizzazione in corso non risulta inutilizzato
+    ids = set(registry.get(include=[])["ids"])
+    hashes_by_collection = {}
+    for name in live_names:
+        try:
+            documents = vector_store.get_collection(name=name).get(include=["documents"])["documents"]
+        except Exception:
+            continue  # eliminata nel frattempo
+        hashes_by_collection[name] = {chunk_hash(document) for document in documents if document}
+    sample = registry.get(ids=list(ids)[:1], include=["embeddings"])["embeddings"] if ids else []
+    return registry, ids, hashes_by_collection, (len(sample[0]) * 4 + 64) if len(sample) else 0
+
+
+def sweep_collections(idle_ttl=None, max_bytes=None):
+    """Elimina le collection doc-* scadute e, se serve, le meno usate oltre il budget.
+
+    Le collection ancora in indicizzazione non contano nel budget e vengono
+    eliminate solo se ferme (senza avanzamenti del job) da più di idle_ttl: sono i
+    resti di un tentativo interrotto. Il registro dei chunk conta nel budget: gli
+    hash che nessuna collection rimasta usa vengono eliminati, ma non mentre
+    un'indicizzazione è in corso. Restituisce la lista
+    delle collection eliminate con il motivo.
+    """
+    idle_ttl = COLLECTION_IDLE_TTL if idle_ttl is None else idle_ttl
+    max_bytes = COLLECTION_MAX_BYTES if max_bytes is None else max_bytes
+    now = time.time()
+    evicted = []
+    live = []
+    for collection in list_document_collections():
+        try:
+            info = describe_collection(collection, now)
+        except Exception as e:
+            print(f"Impossibile leggere i metadata di {collection.name}: {e}")
+            continue
+        if idle_ttl and info["idle_seconds"] > idle_ttl:
+            delete_collection(info["name"])
+            evicted.append(dict(info, reason="idle_ttl"))
+        else:
+            live.append(info)
+
+    # Leggere tutti i chunk costa: il registro si controlla solo se qualche collection
+    # è stata eliminata o se c'è un budget da rispettare
+    if not evicted and not max_bytes:
+        return evicted
+    registry, registry_ids, hashes_by_collection, entry_bytes = chunk_registry_usage([info["name"] for info in live])
+    # Hash del registro -> numero di collection che lo usano
+    references = {}
+    for hashes in hashes_by_collection.values():
+        for key in hashes & registry_ids:
+            references[key] = references.get(key, 0) + 1
+
+    ready = [info for info in live if info["status"] == "ready"]
+    total_bytes = sum(info["bytes"] for info in ready) + len(references) * entry_bytes
+    if max_bytes and total_bytes > max_bytes:
+        for info in sorted(ready, key=lambda info: info["last_access"]):
+            if total_bytes <= max_bytes:
+                break
+            delete_collection(info["name"])
+            total_bytes -= info["bytes"]
+            evicted.append(dict(info, reason="size_budget"))
+            # Gli hash usati solo dalla collection eliminata liberano altro spazio
+            for key in hashes_by_collection.pop(info["name"], ()):
+                if key in references:
+                    references[key] -= 1
+                    if not references[key]:
+                        del references[key]
+                        total_bytes -= entry_bytes
+
+    # Un'indicizzazione in corso aggiunge gli hash al registro prima di inserire i
+    # chunk nella sua collection: finché è attiva, nessun hash si può dire inutilizzato
+    if any(info["ingesting"] for info in live):
+        stale = []
+        print("Registro dei chunk: pulizia rinviata, indicizzazione in corso.")
+    else:
+        stale = [key for key in registry_ids if key not in references]
+    if stale:
+        registry.delete(ids=stale)
+        print(f"Registro dei chunk: eliminati {len(stale)} hash non più usati.")
+        evicted.append({"name": CHUNK_REGISTRY_COLLECTION, "reason": "unreferenced_chunks", "chunks": len(stale)})
+    return evicted
+
+
+def run_sweeper():
+    # Un solo processo alla volta esegue la pulizia (lock sul file condiviso dai worker)
+    lock_path = os.path.join(JOBS_DIR, "collection-sweeper.lock")
+    while True:
+        time.sleep(COLLECTION_SWEEP_INTERVAL)
+        try:
+            with open(lock_path, "w") as lock_file:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                evicted = sweep_collections()
+                if evicted:
+                    print(f"Sweeper: eliminate {len(evicted)} collection: {[info['name'] for info in evicted]}")
+                purged = jobs.purge(JOB_RETENTION)
+                if purged:
+                    print(f"Sweeper: eliminati {purged} job conclusi.")
+        except Exception as e:
+            print(f"Errore durante la pulizia delle collection: {e}")
+
+
+if COLLECTION_SWEEP_INTERVAL > 0 and vector_store is not None:
+    threading.Thread(target=run_sweeper, name="collection-sweeper", daemon=True).start()
+
+
+def admin_unauthorized():
+    if ADMIN_TOKEN and request.headers.get("X-Admin-Token") != ADMIN_TOKEN:
+        return jsonify({"error": "Token di amministrazione mancante o non valido."}), 401
+    return None
+
+
+@app.route('/admin/collections', methods=['GET'])
+def admin_list_collections():
+    if (error := admin_unauthorized()) is not None:
+        return error
+    now = time.time()
+    collections = []
+    for collection in list_document_collections():
+        try:
+            collections.append(describe_collection(collection, now))
+        except Exception as e:
+            collections.append({"name": collection.name, "error": str(e)})
+    collections.sort(key=lambda info: info.get("last_access", 0), reverse=True)
+    return jsonify({
+        "collections": collections,
+        "total_bytes": sum(info.get("bytes", 0) for info in collections),
+        "idle_ttl": COLLECTION_IDLE_TTL,
+        "max_bytes": COLLECTION_MAX_BYTES
+    })
+
+
+@app.route('/admin/collections/<name>', methods=['DELETE'])
+def admin_delete_collection(name):
+    if (error := admin_unauthorized()) is not None:
+        return error
+    if not name.startswith(DOCUMENT_COLLECTION_PREFIX):
+        return jsonify({"error": "Si possono eliminare solo le collection dei documenti (doc-*)."}), 400
+    try:
+        vector_store.get_collection(name=name)
+    except Exception:
+        return jsonify({"error": "Collection non trovata."}), 404
+    delete_collection(name)
+    return jsonify({"deleted": name})
+
+
+@app.route('/admin/collections/purge', methods=['POST'])
+def admin_purge_collections():
+    # Pulizia immediata; idle_ttl e max_bytes nel body sostituiscono i valori configurati
+    if (error := admin_unauthorized()) is not None:
+        return error
+    options = request.get_json(silent=True) or {}
+    try:
+        evicted = sweep_collections(
+            idle_ttl=int(options.get("idle_ttl", COLLECTION_IDLE_TTL)),
+            max_bytes=int(options.get("max_bytes", COLLECTION_MAX_BYTES))
+        )
+    except (TypeError, ValueError):
+        return jsonify({"error": "idle_ttl e max_bytes devono essere numeri interi."}), 400
+    return jsonify({"evicted": evicted})
+
+
+# ==============================================================================
+# 4. ENDPOINT PER L'INDICIZZAZIONE DEL PDF E PER LO STATO DEI JOB
+# ==============================================================================
+def deduplicated_response(filename, collection_name):
+    # Risposta di /index-pdf per un file già indicizzato, oppure None
+    existing = find_indexed_collection(collection_name)
+    if existing is None:
+        return None
+    touch_collection(existing)
+    OPERATIONS.labels("index_pdf", "deduplicated").inc()
+    print(f"[{g.request_id}] File '{filename}' già indicizzato nella collection {collection_name}.")
+    return jsonify({
+        "message": f"File '{filename}' già indicizzato: riutilizzo l'indice esistente.",
+        "collection_name": collection_name,
+        "deduplicated": True
+    })
+
+
 @app.route('/index-pdf', methods=['POST'])
 def index_pdf():
     if 'file' not in request.files:
@@ -39,99 +933,601 @@ def index_pdf():
     if file.filename == '':
         return jsonify({"error": "Nome del file vuoto."}), 400
 
+    # Con async=true la risposta arriva subito con l'ID del job, da interrogare su /jobs/<id>
+    run_async = request.values.get('async', '').lower() in ('1', 'true', 'yes')
+
     try:
-        # --- MODIFICA CHIAVE: Crea una collection con un nome unico ---
-        collection_name = f"doc-{uuid.uuid4()}"
-        print(f"Creazione di una nuova collection: {collection_name}")
-        collection = chroma_client.create_collection(name=collection_name)
-        # -----------------------------------------------------------
-
-        pdf_file = io.BytesIO(file.read())
-        reader = PdfReader(pdf_file)
-        
-        all_text = "".join(page.extract_text() for page in reader.pages if page.extract_text())
-        paragraphs = [p.strip() for p in all_text.split('\n\n') if p.strip()]
-        
-        CHUNK_SIZE, CHUNK_OVERLAP = 3, 1
-        chunks = []
-        stride = CHUNK_SIZE - CHUNK_OVERLAP
-        for i in range(0, len(paragraphs), stride):
-            chunk = "\n\n".join(paragraphs[i:i + CHUNK_SIZE])
-            chunks.append(chunk)
-            if i + stride >= len(paragraphs): break
-        
-        if not chunks:
-            return jsonify({"message": "Il PDF non contiene testo estraibile."})
-
-        response = requests.post(EMBEDDING_API_URL, json={"text": chunks})
-        response.raise_for_status()
-        embeddings = response.json()['embedding']
-        
-        ids = [f"{file.filename}_chunk_{i}" for i in range(len(chunks))]
-        collection.add(embeddings=embeddings, documents=chunks, ids=ids)
-        
-        # --- MODIFICA CHIAVE: Restituisce il nome della collection creata ---
-        return jsonify({
-            "message": f"File '{file.filename}' indicizzato con successo in una sessione isolata.",
-            "collection_name": collection_name
-        })
+        pdf_bytes = file.read()
+        file_hash = hashlib.sha256(pdf_bytes).hexdigest()
+        collection_name = file_collection_name(file_hash)
+
+        # Stesso file già indicizzato: si restituisce subito la collection esistente
+        response = deduplicated_response(file.filename, collection_name)
+        if response is not None:
+            return response
+
+        # Stesso file in corso di indicizzazione: ci si aggancia al job già avviato
+        job_id = jobs.create(filename=file.filename, collection_name=collection_name, file_sha256=file_hash, request_id=g.request_id)
+        claim_key = f"sha256-{file_hash}"
+        owner = jobs.claim(claim_key, job_id)
+        if owner != job_id:
+            jobs.delete(job_id)
+            job_id = owner
+        elif (response := deduplicated_response(file.filename, collection_name)) is not None:
+            # Il job precedente ha finito tra il primo controllo e l'assegnazione della chiave
+            jobs.release(claim_key, job_id)
+            jobs.delete(job_id)
+            return response
+        elif run_async:
+            threading.Thread(
+                target=run_ingestion_in_background,
+                args=(job_id, file.filename, pdf_bytes, collection_name, file_hash, g.request_id),
+                name=f"ingest-{job_id}",
+                daemon=True
+            ).start()
+        else:
+            run_ingestion(job_id, file.filename, pdf_bytes, collection_name, file_hash, g.request_id)
+
+        if run_async:
+            return jsonify({
+                "message": f"Indicizzazione di '{file.filename}' avviata.",
+                "job_id": job_id,
+                "status_url": f"/jobs/{job_id}"
+            }), 202
+        return job_result(jobs.wait(job_id, timeout=JOB_STALE_AFTER))
 
     except Exception as e:
-        print(f"Errore durante l'indicizzazione: {e}")
         return jsonify({"error": f"Errore interno del server: {e}"}), 500
 
 
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    # Avanzamento di un job: pagine estratte, chunk creati e chunk già indicizzati
+    job = jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": "Job non trovato."}), 404
+    return jsonify(job)
+
+
 # ==============================================================================
-# 3. ENDPOINT PER LA CHAT
+# 5. ENDPOINT PER LA CHAT
 # ==============================================================================
-@app.route('/chat', methods=['POST'])
-def chat():
-    json_data = request.get_json()
-    messages = json_data.get('messages')
-    max_tokens = json_data.get('max_tokens', 512)
-    user_system_prompt = json_data.get('system_prompt', "Sei un assistente AI utile.")
-    # --- MODIFICA CHIAVE: Riceve il nome della collection da usare ---
-    collection_name = json_data.get('collection_name')
-    # -------------------------------------------------------------
+def relay_stream(llm_response, timer, llm_started, recorder=None):
+    # Inoltra i byte appena arrivano (chunk_size=None) e chiude la connessione a monte
+    # anche se il client si disconnette prima della fine. Anche senza cache gli eventi
+    # passano da un AnswerStreamRecorder, che riconosce gli errori inviati dall'LLM.
+    recorder = recorder or AnswerStreamRecorder(None)
+    outcome = "cancelled"
+    try:
+        for data in llm_response.iter_content(chunk_size=None):
+            if "llm_first_token" not in timer.durations:
+                timer.since("llm_first_token", llm_started)
+            yield recorder.feed(data)
+        if recorder.buffer:
+            yield recorder.buffer
+        outcome = "error" if recorder.failed else "ok"
+    finally:
+        llm_response.close()
+        timer.since("llm", llm_started)
+        timer.finish(outcome)
+
+
+LLM_ERROR_MESSAGE = 'Servizio LLM non disponibile.'
+POOL_EXHAUSTED_MESSAGE = 'Troppe richieste in corso verso il servizio LLM, riprova più tardi.'
+
+
+def is_relayed_llm_status(status_code):
+    # Errori dell'LLM restituiti tali e quali al client: richiesta non valida (4xx),
+    # servizio sovraccarico (503) o richiesta scaduta (504). Gli altri diventano un 500.
+    return 400 <= status_code < 500 or status_code in (503, 504)
+
+
+def relay_llm_error(llm_response):
+    # Si restituisce lo stesso codice dell'LLM, con il Retry-After suggerito,
+    # invece di un errore 500; la connessione torna subito nel pool.
+    try:
+        error = llm_response.json().get('error', LLM_ERROR_MESSAGE)
+    except ValueError:
+        error = LLM_ERROR_MESSAGE
+    finally:
+        llm_response.close()
+    response = jsonify({"error": error})
+    if 'Retry-After' in llm_response.headers:
+        response.headers['Retry-After'] = llm_response.headers['Retry-After']
+    return response, llm_response.status_code
+
+
+def parse_chat_request(json_data):
+    """Estrae i parametri di /chat; restituisce (parametri, messaggio di errore)."""
+    if not json_data or not json_data.get('messages'):
+        return None, "La chiave 'messages' è obbligatoria."
+    return {
+        "question": json_data['messages'][-1]['content'],
+        "max_tokens": json_data.get('max_tokens', 512),
+        "stream": bool(json_data.get('stream', False)),
+        "system_prompt": json_data.get('system_prompt', "Sei un assistente AI utile."),
+        # Nome della collection da usare per il RAG (None per una chat generica)
+        "collection_name": json_data.get('collection_name'),
+    }, None
+
+
+# Chunk recuperati come candidati per il contesto e token massimi del contesto
+# (0 = tutto lo spazio lasciato libero da prompt, domanda e max_tokens)
+CONTEXT_CANDIDATES = int(os.getenv("CONTEXT_CANDIDATES", "8"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "2048"))
+# Token riservati al template della chat e al testo fisso intorno al contesto
+CONTEXT_PROMPT_OVERHEAD = int(os.getenv("CONTEXT_PROMPT_OVERHEAD", "64"))
+CONTEXT_SEPARATOR_TOKENS = 2
+# Quota minima di n_ctx riservata al contesto: max_tokens viene ridotto se non la lascia libera
+CONTEXT_MIN_SHARE = float(os.getenv("CONTEXT_MIN_SHARE", "0.25"))
+
+
+class CollectionNotFoundError(Exception):
+    """La collection della sessione non esiste più (ad esempio perché scaduta)."""
+
+
+COLLECTION_NOT_FOUND_MESSAGE = "Il documento di questa sessione non è più disponibile: caricalo di nuovo."
+
+
+def open_collection(collection_name):
+    # Apre la collection della sessione e ne registra l'uso
+    try:
+        collection = vector_store.get_collection(name=collection_name)
+    except Exception:
+        raise CollectionNotFoundError(collection_name) from None
+    touch_collection(collection)
+    return collection
+
+
+def retrieve_documents(collection, query_embedding):
+    # Recupera i chunk più vicini alla domanda nella collection della sessione,
+    # dal più al meno rilevante: (ID, testi)
+    results = collection.query(query_embeddings=[query_embedding], n_results=CONTEXT_CANDIDATES)
+    return results['ids'][0], results['documents'][0]
+
 
-    if not messages:
-        return jsonify({"error": "La chiave 'messages' è obbligatoria."}), 400
+def count_tokens(texts, request_id=None):
+    """Conta i token dei testi con il tokenizer del modello (endpoint /tokenize).
 
-    user_question = messages[-1]['content']
+    Restituisce (conteggi, n_ctx). Se il servizio LLM non risponde si usa una stima
+    prudente di un token ogni tre caratteri e LLM_CONTEXT_WINDOW come contesto.
+    """
+    try:
+        with UPSTREAM_SECONDS.labels("tokenize").time():
+            response = llm_session.post(
+                LLM_TOKENIZE_URL, json={"texts": texts}, timeout=(LLM_CONNECT_TIMEOUT, 30),
+                headers={REQUEST_ID_HEADER: request_id} if request_id else None
+            )
+        response.raise_for_status()
+        data = response.json()
+        return data["counts"], data.get("n_ctx", LLM_CONTEXT_WINDOW)
+    except Exception as e:
+        print(f"Conteggio dei token non disponibile, uso una stima: {e}")
+        return [len(text) // 3 + 1 for text in texts], LLM_CONTEXT_WINDOW
+
+
+def chunk_paragraphs(chunk_id, document):
+    """Divide un chunk nei suoi paragrafi, ciascuno con la sua posizione nel documento.
+
+    Gli ID hanno la forma "<file>_chunk_<i>" e il chunk i inizia dal paragrafo
+    i * (CHUNK_SIZE - CHUNK_OVERLAP): i paragrafi in comune tra chunk vicini
+    ricevono la stessa posizione. Con ID di altra forma la posizione è None.
+    """
+    paragraphs = [p for p in document.split("\n\n") if p.strip()]
+    source, _, index = chunk_id.rpartition("_chunk_")
+    if not source or not index.isdigit():
+        return [(None, paragraph) for paragraph in paragraphs]
+    first = int(index) * (CHUNK_SIZE - CHUNK_OVERLAP)
+    return [((source, first + i), paragraph) for i, paragraph in enumerate(paragraphs)]
+
+
+def context_candidates(ids, documents):
+    """Paragrafi dei chunk recuperati, deduplicati per posizione e per testo.
+
+    Restituisce una lista di (rango del chunk, posizione, paragrafo) in ordine di
+    rilevanza.
+    """
+    candidates = []
+    seen_positions, seen_texts = set(), set()
+    for rank, (chunk_id, document) in enumerate(zip(ids, documents)):
+        for position, paragraph in chunk_paragraphs(chunk_id, document):
+            text_key = " ".join(paragraph.split())
+            if position in seen_positions or text_key in seen_texts:
+                continue
+            if position is not None:
+                seen_positions.add(position)
+            seen_texts.add(text_key)
+            candidates.append((rank, position, paragraph))
+    return candidates
+
+
+def context_token_texts(candidates, params):
+    # Testi di cui contare i token: system prompt, domanda e poi i paragrafi candidati
+    return [params['system_prompt'], params['question']] + [c[2] for c in candidates]
+
+
+def select_context(candidates, counts, n_ctx, params):
+    """Aggiunge i paragrafi candidati in ordine di rilevanza finché c'è spazio.
+
+    counts sono i token dei testi di context_token_texts. Il budget è
+    CONTEXT_TOKEN_BUDGET, ridotto se necessario perché n_ctx contenga anche system
+    prompt, domanda e max_tokens. max_tokens (in params) viene abbassato se non
+    lascia al contesto almeno CONTEXT_MIN_SHARE di n_ctx, e il paragrafo più
+    rilevante viene troncato se da solo supera il budget. I paragrafi scelti vengono
+    poi ricomposti in passaggi contigui, in ordine di documento. Restituisce
+    (passaggi, token usati).
+    """
+    request_id = params.get('request_id')
+    prompt_tokens = counts[0] + counts[1] + CONTEXT_PROMPT_OVERHEAD
+    # Con max_tokens vicino a n_ctx non resterebbe spazio per il contesto
+    max_answer_tokens = n_ctx - prompt_tokens - int(n_ctx * CONTEXT_MIN_SHARE)
+    if 0 < max_answer_tokens < params['max_tokens']:
+        print(f"[{request_id}] max_tokens ridotto da {params['max_tokens']} a {max_answer_tokens} per lasciare spazio al contesto.")
+        params['max_tokens'] = max_answer_tokens
+    available = n_ctx - params['max_tokens'] - prompt_tokens
+    budget = min(CONTEXT_TOKEN_BUDGET, available) if CONTEXT_TOKEN_BUDGET > 0 else available
+    if budget <= 0:
+        print(f"[{request_id}] Attenzione: nessuno spazio per il contesto (n_ctx {n_ctx}, "
+              f"prompt e domanda {prompt_tokens} token): la risposta sarà senza documento.")
+        return [], 0
+
+    selected, used = [], 0
+    for (rank, position, paragraph), tokens in zip(candidates, counts[2:]):
+        # Ogni paragrafo costa anche il separatore che lo unisce agli altri
+        cost = tokens + CONTEXT_SEPARATOR_TOKENS
+        if used + cost <= budget:
+            selected.append((rank, position, paragraph))
+            used += cost
+        elif not selected:
+            # Il paragrafo più rilevante non entra (con pypdf spesso un chunk è un solo
+            # paragrafo): se ne tiene l'inizio, stimando i caratteri in proporzione ai token
+            keep = budget - CONTEXT_SEPARATOR_TOKENS
+            if keep <= 0:
+                continue
+            truncated = paragraph[:len(paragraph) * keep * 9 // (tokens * 10)]
+            truncated = truncated.rsplit(" ", 1)[0] if " " in truncated else truncated
+            if truncated.strip():
+                selected.append((rank, position, truncated))
+                used += keep + CONTEXT_SEPARATOR_TOKENS
+
+    # Paragrafi consecutivi dello stesso file diventano un unico passaggio
+    passages = []
+    for rank, position, paragraph in sorted(selected, key=lambda c: (c[1] is None, c[1] or ("", 0), c[0])):
+        previous = passages[-1] if passages else None
+        if (previous and position is not None and previous["end"] is not None
+                and position[0] == previous["end"][0] and position[1] == previous["end"][1] + 1):
+            previous["paragraphs"].append(paragraph)
+            previous["end"] = position
+            previous["rank"] = min(previous["rank"], rank)
+        else:
+            passages.append({"rank": rank, "end": position, "paragraphs": [paragraph]})
+    passages.sort(key=lambda passage: passage["rank"])
+    return ["\n\n".join(passage["paragraphs"]) for passage in passages], used
+
+
+def assemble_context(collection, query_embedding, params, timer):
+    # Recupero dei chunk candidati e scelta del contesto: (passaggi, token del contesto)
+    with timer.stage("retrieve"):
+        ids, documents = retrieve_documents(collection, query_embedding)
+    candidates = context_candidates(ids, documents)
+    documents, context_tokens = [], 0
+    if candidates:
+        with timer.stage("tokenize"):
+            counts, n_ctx = count_tokens(context_token_texts(candidates, params), params['request_id'])
+        with timer.stage("pack_context"):
+            documents, context_tokens = select_context(candidates, counts, n_ctx, params)
+    CONTEXT_TOKENS.observe(context_tokens)
+    return documents, context_tokens
+
+
+def build_llm_request(params, documents):
+    """Costruisce payload e header della richiesta al servizio LLM.
+
+    documents è la lista dei chunk recuperati (CASO RAG) oppure None (CASO GENERICO).
+    """
+    if documents is not None:
+        context = "\n---\n".join(documents)
+        system_prompt = f"{params['system_prompt']}\n\nUsa il seguente contesto per formulare la tua risposta:\n\nCONTESTO:\n{context}"
+    else:
+        system_prompt = params['system_prompt']
+    payload = {
+        "messages": [{"role": "system", "content": system_prompt}, {"role": "user", "content": params['question']}],
+        "max_tokens": params['max_tokens']
+    }
+    if params['stream']:
+        payload["stream"] = True
+    headers = {"X-Request-Timeout": str(LLM_TIMEOUT)}
+    if params.get('request_id'):
+        headers[REQUEST_ID_HEADER] = params['request_id']
+    return payload, headers
+
+
+# Cache semantica delle risposte: una domanda molto simile (coseno degli embedding
+# >= ANSWER_CACHE_THRESHOLD) a una già posta sulla stessa collection, con lo stesso
+# system prompt e max_tokens, riceve la risposta salvata senza chiamare l'LLM.
+# Gli embedding CLIP di testi diversi sono spesso vicini: la soglia va tenuta alta.
+ANSWER_CACHE_ENTRIES = int(os.getenv("ANSWER_CACHE_ENTRIES", "2000"))  # 0 = cache disattivata
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL", str(24 * 3600)))
+ANSWER_CACHE_THRESHOLD = float(os.getenv("ANSWER_CACHE_THRESHOLD", "0.97"))
+
+
+class AnswerCache:
+    """Cache LRU con scadenza delle risposte RAG, in memoria (una per worker).
+
+    Le voci sono raggruppate per chiave (collection, hash del system prompt,
+    max_tokens) e per versione della collection (il suo indexed_at): una collection
+    reindicizzata o eliminata non restituisce più le risposte calcolate prima.
+    """
+
+    def __init__(self, max_entries, ttl, threshold):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries = OrderedDict()  # id -> voce, dalla meno alla più usata di recente
+        self.buckets = {}             # chiave -> ID delle voci
+        self.expiry = deque()         # (created_at, id) in ordine di inserimento
+        self.next_id = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0, "expired": 0, "invalidated": 0}
+
+    @staticmethod
+    def _normalize(embedding):
+        embedding = np.asarray(embedding, dtype=np.float32).ravel()
+        return embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+    def _remove(self, entry_id, reason):
+        entry = self.entries.pop(entry_id)
+        bucket = self.buckets[entry["key"]]
+        bucket.remove(entry_id)
+        if not bucket:
+            del self.buckets[entry["key"]]
+        self.stats[reason] += 1
+
+    def _purge_expired(self, now):
+        # Le voci scadute di chiavi mai più cercate resterebbero in memoria fino
+        # all'espulsione LRU: si eliminano dalla più vecchia a ogni inserimento
+        while self.expiry and now - self.expiry[0][0] > self.ttl:
+            _, entry_id = self.expiry.popleft()
+            if entry_id in self.entries:
+                self._remove(entry_id, "expired")
+        # ID di voci già espulse o invalidate: si ricostruisce la coda dalle voci rimaste
+        if len(self.expiry) > 2 * self.max_entries:
+            self.expiry = deque(sorted((entry["created_at"], entry_id) for entry_id, entry in self.entries.items()))
+
+    def lookup(self, key, version, embedding, question):
+        """Restituisce (risposta, similarità) della voce più simile, oppure None."""
+        if self.max_entries <= 0:
+            return None
+        query = self._normalize(embedding)
+        now = time.time()
+        with self.lock:
+            candidates = []
+            for entry_id in list(self.buckets.get(key, ())):
+                entry = self.entries[entry_id]
+                if entry["version"] != version:
+                    self._remove(entry_id, "invalidated")
+                elif now - entry["created_at"] > self.ttl:
+                    self._remove(entry_id, "expired")
+                else:
+                    candidates.append(entry_id)
+            if candidates:
+                similarities = np.stack([self.entries[i]["embedding"] for i in candidates]) @ query
+                for i, entry_id in enumerate(candidates):
+                    # La stessa domanda, a meno di spazi e maiuscole, è sempre un successo
+                    if self.entries[entry_id]["question"] == question:
+                        similarities[i] = 1.0
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.threshold:
+                    self.entries.move_to_end(candidates[best])
+                    self.stats["hits"] += 1
+                    return self.entries[candidates[best]]["answer"], float(similarities[best])
+            self.stats["misses"] += 1
+            return None
+
+    def store(self, key, version, embedding, question, answer):
+        if self.max_entries <= 0 or not answer:
+            return
+        now = time.time()
+        with self.lock:
+            self._purge_expired(now)
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = {
+                "key": key, "version": version, "embedding": self._normalize(embedding),
+                "question": question, "answer": answer, "created_at": now
+            }
+            self.buckets.setdefault(key, []).append(entry_id)
+            self.expiry.append((now, entry_id))
+            self.stats["stores"] += 1
+            while len(self.entries) > self.max_entries:
+                self._remove(next(iter(self.entries)), "evictions")
+
+    def snapshot(self):
+        with self.lock:
+            lookups = self.stats["hits"] + self.stats["misses"]
+            return dict(
+                self.stats, entries=len(self.entries), max_entries=self.max_entries,
+                threshold=self.threshold, ttl=self.ttl,
+                hit_rate=round(self.stats["hits"] / lookups, 4) if lookups else None
+            )
+
+
+answer_cache = AnswerCache(ANSWER_CACHE_ENTRIES, ANSWER_CACHE_TTL, ANSWER_CACHE_THRESHOLD)
+
+
+def answer_cache_key(params):
+    system_prompt_hash = hashlib.sha256(params['system_prompt'].encode("utf-8")).hexdigest()
+    return (params['collection_name'], system_prompt_hash, params['max_tokens'])
+
+
+def normalize_question(question):
+    return " ".join(question.lower().split())
+
+
+def collection_version(collection):
+    # Cambia ogni volta che la collection viene (re)indicizzata
+    return (collection.metadata or {}).get("indexed_at")
+
+
+def cached_answer_events(answer, similarity):
+    # Una risposta in cache inviata in streaming: un solo token con tutto il testo
+    yield f"data: {json.dumps({'token': answer}, ensure_ascii=False)}\n\n".encode("utf-8")
+    yield f"data: {json.dumps({'done': True, 'cached': True, 'similarity': similarity})}\n\n".encode("utf-8")
+
+
+class AnswerStreamRecorder:
+    """Inoltra gli eventi SSE del servizio LLM ricostruendo la risposta completa.
+
+    L'evento finale {"done": true} riceve il flag "cached": false e gli eventuali
+    campi di extra_fields; se lo stream termina senza errori, la risposta viene
+    passata a on_complete (None se non va salvata in cache). failed diventa True
+    se l'LLM invia un evento {"error": ...}.
+    """
+
+    def __init__(self, on_complete, extra_fields=None):
+        self.on_complete = on_complete
+        self.extra_fields = extra_fields or {}
+        self.buffer = b""
+        self.tokens = []
+        self.failed = False
+
+    def feed(self, data):
+        # Restituisce i byte da inoltrare al client: solo eventi completi
+        self.buffer += data
+        *events, self.buffer = self.buffer.split(b"\n\n")
+        return b"".join(self._relay(event) for event in events)
+
+    def _relay(self, event):
+        if not event.startswith(b"data:"):
+            return event + b"\n\n"
+        payload = json.loads(event[len(b"data:"):])
+        if "token" in payload:
+            self.tokens.append(payload["token"])
+        elif "error" in payload:
+            self.failed = True
+        elif payload.get("done"):
+            payload.update(self.extra_fields, cached=False)
+            if not self.failed and self.on_complete:
+                self.on_complete("".join(self.tokens))
+            event = f"data: {json.dumps(payload, ensure_ascii=False)}".encode("utf-8")
+        return event + b"\n\n"
+
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    params, error = parse_chat_request(request.get_json())
+    if error:
+        return jsonify({"error": error}), 400
+    params['request_id'] = g.request_id
+    timer = StageTimer("chat", g.request_id)
 
     try:
-        # --- MODIFICA CHIAVE: Logica condizionale basata sulla collection ---
-        if collection_name:
+        documents = None
+        store_answer = None
+        context_tokens = None
+        if params['collection_name']:
             # CASO RAG: Usa la collection specificata
-            print(f"Esecuzione chat RAG sulla collection: {collection_name}")
-            collection = chroma_client.get_collection(name=collection_name)
-            
-            response = requests.post(EMBEDDING_API_URL, json={"text": user_question})
-            query_embedding = response.json()['embedding']
-            
-            results = collection.query(query_embeddings=[query_embedding], n_results=3)
-            context = "\n---\n".join(results['documents'][0])
-            
-            final_system_prompt = f"{user_system_prompt}\n\nUsa il seguente contesto per formulare la tua risposta:\n\nCONTESTO:\n{context}"
-            final_messages = [{"role": "system", "content": final_system_prompt}, {"role": "user", "content": user_question}]
+            print(f"[{g.request_id}] Esecuzione chat RAG sulla collection: {params['collection_name']}")
+            with timer.stage("embed_query"):
+                query_embedding = create_embeddings(params['question'], g.request_id)
+            collection = open_collection(params['collection_name'])
+
+            # Domanda già vista (o quasi) su questa versione della collection: niente LLM
+            with timer.stage("cache_lookup"):
+                cache_key, version = answer_cache_key(params), collection_version(collection)
+                question = normalize_question(params['question'])
+                cached = answer_cache.lookup(cache_key, version, query_embedding, question)
+            if cached is not None:
+                answer, similarity = cached
+                print(f"[{g.request_id}] Risposta trovata nella cache (similarità {similarity:.3f}).")
+                timer.finish("cached")
+                if params['stream']:
+                    return Response(
+                        cached_answer_events(answer, similarity),
+                        mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+                    )
+                return jsonify({"response": answer, "cached": True, "similarity": similarity})
+
+            def store_answer(answer):
+                answer_cache.store(cache_key, version, query_embedding, question, answer)
+
+            documents, context_tokens = assemble_context(collection, query_embedding, params, timer)
+            print(f"[{g.request_id}] Contesto: {len(documents)} passaggi, {context_tokens} token.")
         else:
             # CASO GENERICO: Nessuna collection, chat diretta
-            print("Esecuzione chat generica (nessuna collection specificata).")
-            final_messages = [{"role": "system", "content": user_system_prompt}, {"role": "user", "content": user_question}]
-        # -------------------------------------------------------------------
+            print(f"[{g.request_id}] Esecuzione chat generica (nessuna collection specificata).")
+
+        llm_payload, llm_headers = build_llm_request(params, documents)
+        llm_started = time.perf_counter()
+        if params['stream']:
+            # CASO STREAMING: inoltra gli eventi SSE del servizio LLM senza bufferizzarli.
+            # Il timeout di lettura vale tra un token e il successivo, non sull'intera risposta.
+            llm_response = llm_session.post(
+                LLM_API_URL, json=llm_payload, headers=llm_headers,
+                timeout=(LLM_CONNECT_TIMEOUT, LLM_TIMEOUT), stream=True
+            )
+            if is_relayed_llm_status(llm_response.status_code):
+                timer.finish("unavailable" if llm_response.status_code >= 500 else "rejected")
+                return relay_llm_error(llm_response)
+            if not llm_response.ok:
+                llm_response.close()
+            llm_response.raise_for_status()
+            recorder = AnswerStreamRecorder(store_answer, {"context_tokens": context_tokens}) if store_answer else None
+            # Le fasi dell'LLM e la chiusura del timer avvengono durante lo streaming
+            return Response(
+                relay_stream(llm_response, timer, llm_started, recorder),
+                mimetype='text/event-stream',
+                headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+            )
 
-        llm_payload = {"messages": final_messages, "max_tokens": max_tokens}
-        llm_response = requests.post(LLM_API_URL, json=llm_payload, timeout=300)
+        llm_response = llm_session.post(
+            LLM_API_URL, json=llm_payload, headers=llm_headers, timeout=(LLM_CONNECT_TIMEOUT, LLM_TIMEOUT)
+        )
+        timer.since("llm", llm_started)
+        if is_relayed_llm_status(llm_response.status_code):
+            timer.finish("unavailable" if llm_response.status_code >= 500 else "rejected")
+            return relay_llm_error(llm_response)
         llm_response.raise_for_status()
-        
-        return jsonify(llm_response.json())
 
+        result = llm_response.json()
+        result['cached'] = False
+        if store_answer:
+            store_answer(result.get('response'))
+            result['context_tokens'] = context_tokens
+        timer.finish("ok")
+        return jsonify(result)
+
+    except CollectionNotFoundError:
+        timer.finish("not_found")
+        return jsonify({"error": COLLECTION_NOT_FOUND_MESSAGE}), 404
+    except urllib3.exceptions.EmptyPoolError:
+        # Nessuna connessione verso l'LLM si è liberata entro HTTP_POOL_TIMEOUT
+        timer.finish("unavailable")
+        return jsonify({"error": POOL_EXHAUSTED_MESSAGE}), 503, {'Retry-After': '1'}
     except Exception as e:
-        print(f"Errore durante la chat: {e}")
+        print(f"[{g.request_id}] Errore durante la chat: {e}")
+        timer.finish("error")
         return jsonify({"error": f"Errore interno del server: {e}"}), 500
 
+
+@app.route('/answer-cache', methods=['GET'])
+def answer_cache_stats():
+    # Statistiche della cache delle risposte di questo worker
+    return jsonify(answer_cache.snapshot())
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Metriche Prometheus: con più worker si aggregano i file di PROMETHEUS_MULTIPROC_DIR
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
 # ==============================================================================
-# 4. AVVIO DELL'APPLICAZIONE
+# 6. AVVIO DELL'APPLICAZIONE
 # ==============================================================================
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080)
@@ -0,0 +1,248 @@
+# ==============================================================================
+# ORCHESTRATORE IN MODALITÀ ASINCRONA (ASGI)
+#
+# Stessi endpoint e stessi contratti di app.py, ma /chat è servito da un event
+# loop: una richiesta che attende l'LLM non occupa un worker, e migliaia di chat
+# in attesa possono condividere pochi processi. Le chiamate verso i servizi di
+# embedding e LLM (compreso il conteggio dei token) usano client httpx asincroni
+# con connessioni keep-alive, timeout e limiti di connessioni per ciascun
+# servizio; le chiamate all'indice vettoriale, sincrone, passano da un pool di
+# thread limitato. Gli altri endpoint (indicizzazione, job, ...) sono quelli
+# dell'app Flask, montata come WSGI.
+#
+# Avvio: gunicorn -k uvicorn.workers.UvicornWorker asgi:app
+# ==============================================================================
+import contextlib
+import os
+import time
+
+import anyio
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from app import (
+    CHROMA_MAX_CONNECTIONS, COLLECTION_NOT_FOUND_MESSAGE, CONTEXT_TOKENS, EMBEDDING_API_URL, EMBEDDING_MAX_CONNECTIONS,
+    EMBEDDING_REQUEST_ITEMS, EMBEDDING_TIMEOUT, HTTP_POOL_TIMEOUT, LLM_API_URL, LLM_CONNECT_TIMEOUT, LLM_CONTEXT_WINDOW,
+    LLM_ERROR_MESSAGE, LLM_MAX_CONNECTIONS, LLM_TIMEOUT, LLM_TOKENIZE_URL, POOL_EXHAUSTED_MESSAGE, REQUEST_ID_HEADER,
+    UPSTREAM_SECONDS,
+    AnswerStreamRecorder, CollectionNotFoundError, StageTimer, answer_cache, answer_cache_key, app as flask_app,
+    build_llm_request, cached_answer_events, collection_version, context_candidates, context_token_texts,
+    decode_embeddings, embedding_request_headers, is_relayed_llm_status, normalize_question, open_collection, parse_chat_request,
+    request_id_from, retrieve_documents, select_context,
+)
+
+# Thread usati per servire gli endpoint Flask montati sotto l'app ASGI
+WSGI_THREADS = int(os.getenv("WSGI_THREADS", "8"))
+
+# Client HTTP e limitatori condivisi, creati all'avvio del worker (vedi lifespan)
+clients = {}
+limiters = {}
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    clients["embedding"] = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=EMBEDDING_MAX_CONNECTIONS, max_keepalive_connections=EMBEDDING_MAX_CONNECTIONS),
+        timeout=httpx.Timeout(EMBEDDING_TIMEOUT, pool=HTTP_POOL_TIMEOUT)
+    )
+    clients["llm"] = httpx.AsyncClient(
+        limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS),
+        # Il timeout di lettura vale tra un chunk e il successivo, come nella versione sincrona
+        timeout=httpx.Timeout(LLM_TIMEOUT, connect=LLM_CONNECT_TIMEOUT, pool=HTTP_POOL_TIMEOUT)
+    )
+    # Chiamate all'indice vettoriale in corso contemporaneamente (una per thread)
+    limiters["vector_store"] = anyio.CapacityLimiter(CHROMA_MAX_CONNECTIONS)
+    try:
+        yield
+    finally:
+        for client in clients.values():
+            await client.aclose()
+        clients.clear()
+        limiters.clear()
+
+
+async def create_embeddings(text, request_id=None):
+    EMBEDDING_REQUEST_ITEMS.observe(len(text) if isinstance(text, list) else 1)
+    with UPSTREAM_SECONDS.labels("embedding").time():
+        response = await clients["embedding"].post(
+            EMBEDDING_API_URL, json={"text": text}, headers=embedding_request_headers(request_id)
+        )
+    response.raise_for_status()
+    return decode_embeddings(response.headers, response.content)
+
+
+async def run_vector_store(function, *args):
+    # Il client dell'indice vettoriale è sincrono: le chiamate vanno nel pool di thread,
+    # al più CHROMA_MAX_CONNECTIONS alla volta per worker
+    return await anyio.to_thread.run_sync(function, *args, limiter=limiters["vector_store"])
+
+
+async def count_tokens(texts, request_id=None):
+    # Come count_tokens di app.py, ma con il client asincrono del servizio LLM
+    try:
+        with UPSTREAM_SECONDS.labels("tokenize").time():
+            response = await clients["llm"].post(
+                LLM_TOKENIZE_URL, json={"texts": texts}, timeout=httpx.Timeout(30, connect=LLM_CONNECT_TIMEOUT, pool=HTTP_POOL_TIMEOUT),
+                headers={REQUEST_ID_HEADER: request_id} if request_id else None
+            )
+        response.raise_for_status()
+        data = response.json()
+        return data["counts"], data.get("n_ctx", LLM_CONTEXT_WINDOW)
+    except Exception as e:
+        print(f"Conteggio dei token non disponibile, uso una stima: {e}")
+        return [len(text) // 3 + 1 for text in texts], LLM_CONTEXT_WINDOW
+
+
+async def assemble_context(collection, query_embedding, params, timer):
+    # Come assemble_context di app.py: (passaggi, token del contesto)
+    with timer.stage("retrieve"):
+        ids, documents = await run_vector_store(retrieve_documents, collection, query_embedding)
+    candidates = context_candidates(ids, documents)
+    documents, context_tokens = [], 0
+    if candidates:
+        with timer.stage("tokenize"):
+            counts, n_ctx = await count_tokens(context_token_texts(candidates, params), params['request_id'])
+        with timer.stage("pack_context"):
+            documents, context_tokens = select_context(candidates, counts, n_ctx, params)
+    CONTEXT_TOKENS.observe(context_tokens)
+    return documents, context_tokens
+
+
+async def relay_llm_error(llm_response):
+    # Stesso comportamento della versione sincrona: 4xx, 503/504 e Retry-After passano al client
+    try:
+        await llm_response.aread()
+        error = llm_response.json().get('error', LLM_ERROR_MESSAGE)
+    except ValueError:
+        error = LLM_ERROR_MESSAGE
+    finally:
+        await llm_response.aclose()
+    headers = {'Retry-After': llm_response.headers['Retry-After']} if 'Retry-After' in llm_response.headers else None
+    return JSONResponse({"error": error}, status_code=llm_response.status_code, headers=headers)
+
+
+async def relay_stream(llm_response, timer, llm_started, recorder=None):
+    # Come in app.py, gli errori inviati dall'LLM si riconoscono anche senza cache.
+    # La risposta a monte si chiude qui: se il client si disconnette Starlette non
+    # esegue i background task, e la connessione resterebbe occupata nel pool.
+    recorder = recorder or AnswerStreamRecorder(None)
+    outcome = "cancelled"
+    try:
+        async for data in llm_response.aiter_raw():
+            if "llm_first_token" not in timer.durations:
+                timer.since("llm_first_token", llm_started)
+            yield recorder.feed(data)
+        if recorder.buffer:
+            yield recorder.buffer
+        outcome = "error" if recorder.failed else "ok"
+    finally:
+        await llm_response.aclose()
+        timer.since("llm", llm_started)
+        timer.finish(outcome)
+
+
+async def chat(request):
+    request_id = request_id_from(request.headers)
+    response_headers = {REQUEST_ID_HEADER: request_id}
+    try:
+        json_data = await request.json()
+    except ValueError:
+        json_data = None
+    params, error = parse_chat_request(json_data)
+    if error:
+        return JSONResponse({"error": error}, status_code=400, headers=response_headers)
+    params['request_id'] = request_id
+    timer = StageTimer("chat", request_id)
+    stream_headers = dict(response_headers, **{'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    try:
+        documents = None
+        store_answer = None
+        context_tokens = None
+        if params['collection_name']:
+            # CASO RAG: la ricerca nell'indice vettoriale passa dal client condiviso di app.py
+            print(f"[{request_id}] Esecuzione chat RAG sulla collection: {params['collection_name']}")
+            with timer.stage("embed_query"):
+                query_embedding = await create_embeddings(params['question'], request_id)
+            collection = await run_vector_store(open_collection, params['collection_name'])
+
+            # Domanda già vista (o quasi) su questa versione della collection: niente LLM
+            with timer.stage("cache_lookup"):
+                cache_key, version = answer_cache_key(params), collection_version(collection)
+                question = normalize_question(params['question'])
+                cached = answer_cache.lookup(cache_key, version, query_embedding, question)
+            if cached is not None:
+                answer, similarity = cached
+                print(f"[{request_id}] Risposta trovata nella cache (similarità {similarity:.3f}).")
+                timer.finish("cached")
+                if params['stream']:
+                    return StreamingResponse(
+                        cached_answer_events(answer, similarity),
+                        media_type='text/event-stream',
+                        headers=stream_headers
+                    )
+                return JSONResponse({"response": answer, "cached": True, "similarity": similarity}, headers=response_headers)
+
+            def store_answer(answer):
+                answer_cache.store(cache_key, version, query_embedding, question, answer)
+
+            documents, context_tokens = await assemble_context(collection, query_embedding, params, timer)
+            print(f"[{request_id}] Contesto: {len(documents)} passaggi, {context_tokens} token.")
+        else:
+            print(f"[{request_id}] Esecuzione chat generica (nessuna collection specificata).")
+
+        llm_payload, llm_headers = build_llm_request(params, documents)
+        llm_started = time.perf_counter()
+        llm_request = clients["llm"].build_request("POST", LLM_API_URL, json=llm_payload, headers=llm_headers)
+        llm_response = await clients["llm"].send(llm_request, stream=params['stream'])
+        if is_relayed_llm_status(llm_response.status_code):
+            timer.finish("unavailable" if llm_response.status_code >= 500 else "rejected")
+            response = await relay_llm_error(llm_response)
+            response.headers[REQUEST_ID_HEADER] = request_id
+            return response
+        if llm_response.is_error:
+            await llm_response.aclose()
+        llm_response.raise_for_status()
+
+        if params['stream']:
+            # CASO STREAMING: gli eventi SSE vengono inoltrati appena arrivano
+            recorder = AnswerStreamRecorder(store_answer, {"context_tokens": context_tokens}) if store_answer else None
+            return StreamingResponse(
+                relay_stream(llm_response, timer, llm_started, recorder),
+                media_type='text/event-stream',
+                headers=stream_headers
+            )
+
+        timer.since("llm", llm_started)
+        result = llm_response.json()
+        result['cached'] = False
+        if store_answer:
+            store_answer(result.get('response'))
+            result['context_tokens'] = context_tokens
+        timer.finish("ok")
+        return JSONResponse(result, headers=response_headers)
+
+    except CollectionNotFoundError:
+        timer.finish("not_found")
+        return JSONResponse({"error": COLLECTION_NOT_FOUND_MESSAGE}, status_code=404, headers=response_headers)
+    except httpx.PoolTimeout:
+        timer.finish("unavailable")
+        return JSONResponse(
+            {"error": POOL_EXHAUSTED_MESSAGE}, status_code=503, headers=dict(response_headers, **{'Retry-After': '1'})
+        )
+    except Exception as e:
+        print(f"[{request_id}] Errore durante la chat: {e}")
+        timer.finish("error")
+        return JSONResponse({"error": f"Errore interno del server: {e}"}, status_code=500, headers=response_headers)
+
+
+app = Starlette(
+    routes=[
+        Route('/chat', chat, methods=['POST']),
+        Mount('/', app=WSGIMiddleware(flask_app, workers=WSGI_THREADS)),
+    ],
+    lifespan=lifespan
+)
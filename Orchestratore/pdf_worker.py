@@ -0,0 +1,23 @@
+# ==============================================================================
+# ESTRAZIONE DEL TESTO DEI PDF NEI PROCESSI DEL POOL
+#
+# Funzioni eseguite dai processi di ProcessPoolExecutor avviati da iter_page_texts.
+# Il pool usa "forkserver": i processi non ereditano i thread né i lock del worker
+# Gunicorn, e importano solo questo modulo (non app.py, che aprirebbe l'indice
+# vettoriale e avvierebbe lo sweeper). Il PDF arriva tramite initargs.
+# ==============================================================================
+import io
+
+from pypdf import PdfReader
+
+# Lettore PDF del processo di estrazione, creato una sola volta per processo
+_worker_reader = None
+
+
+def init_pdf_worker(pdf_bytes):
+    global _worker_reader
+    _worker_reader = PdfReader(io.BytesIO(pdf_bytes))
+
+
+def extract_page_range(start, end):
+    return [_worker_reader.pages[i].extract_text() or "" for i in range(start, end)]
@@ -0,0 +1,426 @@
+# ==============================================================================
+# INDICE VETTORIALE LOCALE (BACKEND "numpy")
+#
+# Alternativa in-process a ChromaDB per collection piccole, come quelle create per
+# ogni documento caricato. Ogni collection è una cartella sotto il percorso
+# indicato, con:
+#   - vectors.f32    matrice float32 contigua (una riga per chunk), in sola aggiunta
+#   - records.jsonl  ID e testo di ogni riga, nello stesso ordine della matrice
+#   - meta.json      metadata della collection, dimensione dei vettori e un nonce
+#                    di creazione (distingue una collection ricreata con lo stesso nome)
+# La ricerca è un solo prodotto matrice-vettore seguito da np.argpartition.
+#
+# Espone lo stesso sottoinsieme dell'API di chromadb usato dall'orchestratore
+# (get_collection, create_collection, add, get, upsert, delete, query, modify, ...), così
+# il resto del codice non dipende dal backend scelto. I file sono condivisi dai
+# worker di Gunicorn: ogni processo ricarica una collection quando i file cambiano.
+# ==============================================================================
+import fcntl
+import json
+import os
+import shutil
+import threading
+import uuid
+
+import numpy as np
+
+VECTORS_FILE = "vectors.f32"
+RECORDS_FILE = "records.jsonl"
+META_FILE = "meta.json"
+LOCK_FILE = ".lock"
+
+
+class _Index:
+    """Contenuto di una collection caricato in memoria (o mappato dal disco).
+
+    Le righe aggiunte dopo il caricamento vengono lette in modo incrementale: si
+    leggono solo i record nuovi e si calcolano le norme solo dei vettori nuovi.
+    """
+
+    def __init__(self, path, meta, use_mmap):
+        self.path = path
+        self.dim = meta["dim"] or 0
+        self.rewrites = meta.get("rewrites", 0)
+        self.nonce = meta.get("nonce")
+        self.use_mmap = use_mmap
+        self.signature = None
+        self.records_offset = 0
+        self.ids = []
+        self.documents = []
+        self.rows = {}
+        self.matrix = np.empty((0, self.dim), dtype=np.float32)
+        self.norms = np.empty(0, dtype=np.float32)
+
+    def refresh(self, signature):
+        vectors_path = os.path.join(self.path, VECTORS_FILE)
+        with open(os.path.join(self.path, RECORDS_FILE), "rb") as f:
+            f.seek(self.records_offset)
+            data = f.read()
+        # Solo le righe complete: un'aggiunta in corso in un altro processo viene ignorata
+        lines = data[:data.rfind(b"\n") + 1].splitlines(keepends=True)
+        available = os.path.getsize(vectors_path) // (4 * self.dim) if self.dim else 0
+        lines = lines[:max(0, available - len(self.ids))]
+        self.signature = signature
+        if not lines:
+            return
+
+        start, count = len(self.ids), len(self.ids) + len(lines)
+        for row, line in enumerate(lines, start=start):
+            record = json.loads(line)
+            self.ids.append(record["id"])
+            self.documents.append(record.get("document"))
+            self.rows[record["id"]] = row
+        self.records_offset += sum(len(line) for line in lines)
+
+        if self.use_mmap:
+            self.matrix = np.memmap(vectors_path, dtype="<f4", mode="r", shape=(count, self.dim))
+            new_rows = self.matrix[start:]
+        else:
+            new_rows = np.fromfile(vectors_path, dtype="<f4", count=(count - start) * self.dim, offset=start * self.dim * 4)
+            new_rows = new_rows.reshape(-1, self.dim)
+            self.matrix = np.concatenate([self.matrix, new_rows])
+        norms = np.linalg.norm(new_rows, axis=1).astype(np.float32)
+        norms[norms == 0] = 1.0
+        self.norms = np.concatenate([self.norms, norms])
+
+
+def _signature(path):
+    # Cambia a ogni scrittura: dimensione dei file e istante dell'ultima modifica
+    signature = []
+    for name in (VECTORS_FILE, RECORDS_FILE, META_FILE):
+        try:
+            stat = os.stat(os.path.join(path, name))
+            signature.append((stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+
+class NumpyCollection:
+    def __init__(self, store, name):
+        self._store = store
+        self.name = name
+        self._path = store._path(name)
+
+    @property
+    def metadata(self):
+        return self._store._read_meta(self.name)["metadata"]
+
+    def count(self):
+        return len(self._store._index(self.name).ids)
+
+    def modify(self, metadata=None):
+        if metadata is None:
+            return
+        with self._store._locked(self.name):
+            meta = self._store._read_meta(self.name)
+            meta["metadata"] = metadata
+            self._store._write_meta(self.name, meta)
+
+    def add(self, ids, embeddings, documents=None):
+        # Controllo dei duplicati e scrittura sotto lo stesso lock, come in upsert
+        with self._store._locked(self.name):
+            index = self._store._index(self.name, locked=True)
+            duplicates = [record_id for record_id in ids if record_id in index.rows]
+            if duplicates:
+                raise ValueError(f"ID già presenti nella collection {self.name}: {duplicates[:3]}")
+            self._append(ids, embeddings, documents, locked=True)
+
+    def upsert(self, ids, embeddings, documents=None):
+        """Aggiorna i vettori degli ID già presenti e aggiunge gli altri.
+
+        Le righe esistenti vengono riscritte sul posto nel file dei vettori.
+        """
+        embeddings = np.asarray(embeddings, dtype="<f4")
+        documents = documents if documents is not None else [None] * len(ids)
+        with self._store._locked(self.name):
+            index = self._store._index(self.name, locked=True)
+            new = [i for i, record_id in enumerate(ids) if record_id not in index.rows]
+            existing = [i for i, record_id in enumerate(ids) if record_id in index.rows]
+            if existing:
+                with open(os.path.join(self._path, VECTORS_FILE), "r+b") as f:
+                    for i in existing:
+                        f.seek(index.rows[ids[i]] * index.dim * 4)
+                        f.write(embeddings[i].tobytes())
+                # Le righe riscritte invalidano le norme già calcolate negli altri processi
+                meta = self._store._read_meta(self.name)
+                meta["rewrites"] = meta.get("rewrites", 0) + 1
+                self._store._write_meta(self.name, meta)
+            if new:
+                self._append([ids[i] for i in new], embeddings[new], [documents[i] for i in new], locked=True)
+
+    def delete(self, ids):
+        """Elimina gli ID indicati riscrivendo (compattando) i file della collection.
+
+        Tutto avviene sotto il lock esclusivo; il nonce nuovo obbliga gli altri
+        processi a ricostruire l'indice invece di leggerlo in modo incrementale.
+        """
+        with self._store._locked(self.name):
+            index = self._store._index(self.name, locked=True)
+            drop = {record_id for record_id in ids if record_id in index.rows}
+            if not drop:
+                return
+            keep = [row for row, record_id in enumerate(index.ids) if record_id not in drop]
+            vectors = np.ascontiguousarray(index.matrix[keep], dtype="<f4")
+            suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+            vectors_path = os.path.join(self._path, VECTORS_FILE)
+            records_path = os.path.join(self._path, RECORDS_FILE)
+            with open(vectors_path + suffix, "wb") as f:
+                f.write(vectors.tobytes())
+            with open(records_path + suffix, "w", encoding="utf-8") as f:
+                f.write("".join(
+                    json.dumps({"id": index.ids[row], "document": index.documents[row]}, ensure_ascii=False) + "\n"
+                    for row in keep
+                ))
+            os.replace(vectors_path + suffix, vectors_path)
+            os.replace(records_path + suffix, records_path)
+            meta = self._store._read_meta(self.name)
+            meta.update(nonce=uuid.uuid4().hex, rewrites=0)
+            self._store._write_meta(self.name, meta)
+
+    def _append(self, ids, embeddings, documents, locked=False):
+        embeddings = np.ascontiguousarray(embeddings, dtype="<f4")
+        documents = documents if documents is not None else [None] * len(ids)
+        lock = self._store._locked(self.name) if not locked else _NoLock()
+        with lock:
+            meta = self._store._read_meta(self.name)
+            if meta["dim"] is None:
+                meta["dim"] = int(embeddings.shape[1])
+                self._store._write_meta(self.name, meta)
+            elif meta["dim"] != embeddings.shape[1]:
+                raise ValueError(f"Dimensione dei vettori {embeddings.shape[1]} diversa da quella della collection ({meta['dim']}).")
+            # Prima i vettori e poi i record: chi legge considera solo le righe presenti in entrambi
+            with open(os.path.join(self._path, VECTORS_FILE), "ab") as f:
+                f.write(embeddings.tobytes())
+            with open(os.path.join(self._path, RECORDS_FILE), "a", encoding="utf-8") as f:
+                f.write("".join(
+                    json.dumps({"id": record_id, "document": document}, ensure_ascii=False) + "\n"
+                    for record_id, document in zip(ids, documents)
+                ))
+
+    def get(self, ids=None, include=("documents",)):
+        index = self._store._index(self.name)
+        rows = range(len(index.ids)) if ids is None else [index.rows[i] for i in ids if i in index.rows]
+        result = {"ids": [index.ids[row] for row in rows]}
+        if "documents" in include:
+            result["documents"] = [index.documents[row] for row in rows]
+        if "embeddings" in include:
+            result["embeddings"] = [np.array(index.matrix[row]) for row in rows]
+        return result
+
+    def query(self, query_embeddings, n_results=10):
+        """Restituisce i chunk più simili (similarità del coseno) per ogni vettore di query.
+
+        Il risultato ha la stessa forma di quello di ChromaDB; la distanza è 1 - coseno.
+        """
+        index = self._store._index(self.name)
+        queries = np.asarray(query_embeddings, dtype=np.float32).reshape(len(query_embeddings), -1)
+        results = {"ids": [], "documents": [], "distances": []}
+        k = min(n_results, len(index.ids))
+        if k == 0:
+            for _ in range(len(queries)):
+                for values in results.values():
+                    values.append([])
+            return results
+
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        scores = (queries @ index.matrix.T) / index.norms
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        for query_scores, candidates in zip(scores, top):
+            candidates = candidates[np.argsort(-query_scores[candidates])]
+            results["ids"].append([index.ids[row] for row in candidates])
+            results["documents"].append([index.documents[row] for row in candidates])
+            results["distances"].append([float(1.0 - query_scores[row]) for row in candidates])
+        return results
+
+
+class _NoLock:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def acquire(self):
+        return True
+
+    def release(self):
+        pass
+
+
+class _FileLock:
+    """Lock tra processi (flock) e tra thread dello stesso processo.
+
+    In modalità esclusiva serve a chi scrive; in modalità condivisa a chi ricarica
+    l'indice, così non legge mai i file a metà di una compattazione. Il lock
+    condiviso non usa il lock tra thread: flock su descrittori diversi si esclude
+    già anche all'interno dello stesso processo.
+    """
+
+    _thread_locks = {}
+    _guard = threading.Lock()
+
+    def __init__(self, path, shared=False):
+        self.path = path
+        self.shared = shared
+        with self._guard:
+            self.thread_lock = _NoLock() if shared else self._thread_locks.setdefault(path, threading.Lock())
+        self.fd = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        try:
+            self.fd = os.open(self.path, os.O_CREAT | os.O_RDWR)
+        except OSError:
+            self.thread_lock.release()
+            raise
+        fcntl.flock(self.fd, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.thread_lock.release()
+        return False
+
+
+class NumpyVectorStore:
+    """Client con la stessa interfaccia di chromadb.HttpClient, basato su file locali."""
+
+    def __init__(self, directory, use_mmap=True):
+        self.directory = directory
+        self.use_mmap = use_mmap
+        self._indexes = {}
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, name):
+        if not name or "/" in name or name.startswith("."):
+            raise ValueError(f"Nome di collection non valido: {name}")
+        return os.path.join(self.directory, name)
+
+    def _locked(self, name, shared=False):
+        return _FileLock(os.path.join(self._path(name), LOCK_FILE), shared=shared)
+
+    def _read_meta(self, name):
+        try:
+            with open(os.path.join(self._path(name), META_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise ValueError(f"Collection {name} non trovata.") from None
+
+    def _write_meta(self, name, meta):
+        path = os.path.join(self._path(name), META_FILE)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def _index(self, name, locked=False):
+        """Indice in memoria della collection, ricaricato solo se i file sono cambiati.
+
+        Il ricaricamento avviene sotto il lock condiviso della collection (locked=True
+        se il chiamante ha già quello esclusivo): una compattazione in corso in un
+        altro processo viene attesa invece di essere letta a metà.
+        """
+        path = self._path(name)
+        signature = _signature(path)
+        if signature[2] is None:
+            raise ValueError(f"Collection {name} non trovata.")
+        with self._lock:
+            index = self._indexes.get(name)
+            if index is not None and index.signature == signature:
+                return index
+        if locked:
+            return self._reload(name, path, signature)
+        try:
+            lock = self._locked(name, shared=True)
+            with lock:
+                return self._reload(name, path, _signature(path))
+        except FileNotFoundError:
+            raise ValueError(f"Collection {name} non trovata.") from None
+
+    def _reload(self, name, path, signature):
+        if signature[2] is None:
+            raise ValueError(f"Collection {name} non trovata.")
+        with self._lock:
+            index = self._indexes.get(name)
+            if index is not None and index.signature == signature:
+                return index
+            meta = self._read_meta(name)
+            # Il nonce cambia se la collection è stata eliminata e ricreata con lo stesso
+            # nome (anche da un altro processo): l'indice vecchio non va riusato
+            if (index is None or index.nonce != meta.get("nonce") or index.dim != (meta["dim"] or 0)
+                    or index.rewrites != meta.get("rewrites", 0)):
+                index = _Index(path, meta, self.use_mmap)
+                self._indexes[name] = index
+            index.refresh(signature)
+            return index
+
+    def create_collection(self, name, metadata=None):
+        """Crea la collection in una cartella temporanea e la rinomina al suo posto.
+
+        Un processo interrotto durante la creazione lascia solo la cartella temporanea:
+        la collection non resta mai a metà con il suo nome. Una cartella senza
+        meta.json (resto di una versione precedente) viene trattata come assente.
+        """
+        path = self._path(name)
+        staging = os.path.join(self.directory, f".{name}.creating.{os.getpid()}.{threading.get_ident()}")
+        os.makedirs(staging)
+        try:
+            open(os.path.join(staging, VECTORS_FILE), "wb").close()
+            open(os.path.join(staging, RECORDS_FILE), "wb").close()
+            with open(os.path.join(staging, META_FILE), "w", encoding="utf-8") as f:
+                json.dump({"metadata": metadata, "dim": None, "nonce": uuid.uuid4().hex}, f, ensure_ascii=False)
+            for _ in range(2):
+                if os.path.exists(os.path.join(path, META_FILE)):
+                    break
+                if os.path.isdir(path):
+                    self._discard(path)
+                try:
+                    # Riesce solo se la destinazione non esiste o è una cartella vuota
+                    os.rename(staging, path)
+                except OSError:
+                    continue
+                return NumpyCollection(self, name)
+            raise ValueError(f"La collection {name} esiste già.")
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+    def get_collection(self, name):
+        self._read_meta(name)
+        return NumpyCollection(self, name)
+
+    def get_or_create_collection(self, name, metadata=None):
+        try:
+            return self.get_collection(name)
+        except ValueError:
+            try:
+                return self.create_collection(name, metadata=metadata)
+            except ValueError:
+                return self.get_collection(name)
+
+    def delete_collection(self, name):
+        path = self._path(name)
+        if not os.path.exists(os.path.join(path, META_FILE)):
+            # Una cartella senza meta.json non è una collection, ma va comunque rimossa
+            if not os.path.isdir(path):
+                raise ValueError(f"Collection {name} non trovata.")
+        self._discard(path)
+        with self._lock:
+            self._indexes.pop(name, None)
+
+    def _discard(self, path):
+        # Rinomina e poi cancella: gli altri processi non vedono mai una collection a metà
+        trash = os.path.join(self.directory, f".{os.path.basename(path)}.deleted.{os.getpid()}.{threading.get_ident()}")
+        try:
+            os.rename(path, trash)
+        except FileNotFoundError:
+            return
+        shutil.rmtree(trash, ignore_errors=True)
+
+    def list_collections(self):
+        return [
+            NumpyCollection(self, name) for name in sorted(os.listdir(self.directory))
+            if not name.startswith(".") and os.path.exists(os.path.join(self.directory, name, META_FILE))
+        ]
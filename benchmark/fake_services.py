@@ -0,0 +1,173 @@
+# ==============================================================================
+# SERVIZI SOSTITUTIVI PER IL BENCHMARK (EMBEDDING E LLM)
+#
+# Implementano le stesse API di Embeddings/app.py e LLM/app.py senza modelli:
+# - embedding: vettori deterministici (lo stesso testo dà sempre lo stesso
+#   vettore), con un ritardo fisso per richiesta e uno per testo;
+# - LLM: /generate (anche in streaming SSE) e /tokenize, con un ritardo di
+#   prefill per token del prompt e uno di decodifica per token generato. Come
+#   llama.cpp, solo FAKE_LLM_SLOTS generazioni avanzano contemporaneamente.
+#
+# Avvio manuale (server di sviluppo Flask):
+#   python fake_services.py embedding --port 8101
+#   python fake_services.py llm --port 8102
+# Con Gunicorn: fake_services:embedding_app e fake_services:llm_app.
+# ==============================================================================
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+from flask import Flask, Response, request, jsonify, stream_with_context
+
+# ------------------------------------------------------------------------------
+# 1. CONFIGURAZIONE
+# ------------------------------------------------------------------------------
+FAKE_EMBEDDING_DIM = int(os.getenv("FAKE_EMBEDDING_DIM", "512"))
+FAKE_EMBEDDING_MS_PER_REQUEST = float(os.getenv("FAKE_EMBEDDING_MS_PER_REQUEST", "2"))
+FAKE_EMBEDDING_MS_PER_ITEM = float(os.getenv("FAKE_EMBEDDING_MS_PER_ITEM", "5"))
+
+FAKE_LLM_PREFILL_MS_PER_TOKEN = float(os.getenv("FAKE_LLM_PREFILL_MS_PER_TOKEN", "1"))
+FAKE_LLM_DECODE_MS_PER_TOKEN = float(os.getenv("FAKE_LLM_DECODE_MS_PER_TOKEN", "50"))
+# Token generati per risposta (comunque non più di max_tokens della richiesta)
+FAKE_LLM_COMPLETION_TOKENS = int(os.getenv("FAKE_LLM_COMPLETION_TOKENS", "64"))
+FAKE_LLM_SLOTS = int(os.getenv("FAKE_LLM_SLOTS", "1"))
+FAKE_LLM_N_CTX = int(os.getenv("FAKE_LLM_N_CTX", "4096"))
+
+# Parole usate per comporre le risposte del finto LLM
+ANSWER_WORDS = ("il", "documento", "descrive", "una", "procedura", "per", "la", "gestione", "dei", "dati", "e", "del", "sistema")
+
+# ------------------------------------------------------------------------------
+# 2. SERVIZIO DI EMBEDDING
+# ------------------------------------------------------------------------------
+embedding_app = Flask("fake_embedding")
+
+
+def fake_embedding(text):
+    # Vettore normalizzato che dipende solo dal testo
+    seed = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(FAKE_EMBEDDING_DIM).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+@embedding_app.route('/create-embedding', methods=['POST'])
+def create_embedding():
+    json_data = request.get_json()
+    if not json_data or 'text' not in json_data:
+        return jsonify({"error": "Fornire 'text' nel corpo della richiesta."}), 400
+    texts = json_data['text'] if isinstance(json_data['text'], list) else [json_data['text']]
+    time.sleep((FAKE_EMBEDDING_MS_PER_REQUEST + FAKE_EMBEDDING_MS_PER_ITEM * len(texts)) / 1000)
+    embeddings = np.stack([fake_embedding(text) for text in texts])
+    if not isinstance(json_data['text'], list):
+        embeddings = embeddings[0]
+
+    # Stesso formato di risposta del servizio reale: JSON oppure binario
+    if request.accept_mimetypes.best_match(["application/json", "application/octet-stream"]) != "application/octet-stream":
+        return jsonify({"embedding": embeddings.tolist()})
+    dtype_name = request.headers.get("X-Embedding-Dtype", "float32")
+    data = embeddings.astype(np.dtype(dtype_name).newbyteorder("<"))
+    return Response(data.tobytes(), mimetype="application/octet-stream", headers={
+        "X-Embedding-Shape": ",".join(str(dim) for dim in data.shape),
+        "X-Embedding-Dtype": dtype_name,
+    })
+
+
+@embedding_app.route('/ready', methods=['GET'])
+def embedding_ready():
+    return jsonify({"status": "ready", "backend": "fake"})
+
+# ------------------------------------------------------------------------------
+# 3. SERVIZIO LLM
+# ------------------------------------------------------------------------------
+llm_app = Flask("fake_llm")
+llm_app.config['JSON_AS_ASCII'] = False
+generation_slots = threading.BoundedSemaphore(FAKE_LLM_SLOTS)
+
+
+def count_tokens(text):
+    # Stima deterministica: una parola o un segno di punteggiatura per token
+    return len(re.findall(r"\w+|[^\w\s]", text))
+
+
+def sse_event(data):
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def generate_tokens(messages, max_tokens):
+    """Simula una generazione: attende uno slot, poi prefill e un token alla volta.
+
+    Produce gli stessi eventi del servizio reale: {"token": "..."} e infine
+    {"done": true} con le statistiche.
+    """
+    prompt_tokens = sum(count_tokens(message.get('content') or "") for message in messages)
+    completion_tokens = max(min(FAKE_LLM_COMPLETION_TOKENS, max_tokens), 1)
+    enqueued = time.monotonic()
+    with generation_slots:
+        started = time.monotonic()
+        time.sleep(prompt_tokens * FAKE_LLM_PREFILL_MS_PER_TOKEN / 1000)
+        for i in range(completion_tokens):
+            time.sleep(FAKE_LLM_DECODE_MS_PER_TOKEN / 1000)
+            if i == 0:
+                first_token_at = time.monotonic()
+            yield {"token": ANSWER_WORDS[i % len(ANSWER_WORDS)] + " "}
+    yield {
+        "done": True,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "time_to_first_token_s": round(first_token_at - started, 3),
+        "queue_wait_s": round(started - enqueued, 3),
+    }
+
+
+@llm_app.route('/generate', methods=['POST'])
+def generate_text():
+    json_data = request.get_json()
+    messages = (json_data or {}).get('messages')
+    if not messages or not isinstance(messages, list):
+        return jsonify({"error": "La chiave 'messages' è obbligatoria e deve essere una lista."}), 400
+    events = generate_tokens(messages, json_data.get('max_tokens', 512))
+
+    if json_data.get('stream'):
+        return Response(
+            stream_with_context(sse_event(event) for event in events),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+    tokens = []
+    stats = {}
+    for event in events:
+        if "token" in event:
+            tokens.append(event["token"])
+        else:
+            stats = event
+    stats.pop("done", None)
+    return jsonify(dict(stats, response="".join(tokens).strip()))
+
+
+@llm_app.route('/tokenize', methods=['POST'])
+def tokenize_texts():
+    texts = (request.get_json() or {}).get('texts')
+    if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+        return jsonify({"error": "La chiave 'texts' è obbligatoria e deve essere una lista di stringhe."}), 400
+    return jsonify({"counts": [count_tokens(text) for text in texts], "n_ctx": FAKE_LLM_N_CTX})
+
+
+@llm_app.route('/ready', methods=['GET'])
+def llm_ready():
+    return jsonify({"status": "ready", "backend": "fake"})
+
+# ------------------------------------------------------------------------------
+# 4. AVVIO MANUALE
+# ------------------------------------------------------------------------------
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Servizi finti di embedding e LLM per il benchmark")
+    parser.add_argument("service", choices=("embedding", "llm"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    options = parser.parse_args()
+    service_app = embedding_app if options.service == "embedding" else llm_app
+    service_app.run(host=options.host, port=options.port, threaded=True)
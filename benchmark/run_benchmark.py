@@ -0,0 +1,735 @@
+# ==============================================================================
+# BENCHMARK END-TO-END DELLO STACK RAG
+#
+#   python benchmark/run_benchmark.py [--duration 60] [--chat-sessions 8] [--index-workers 1]
+#       [--pdf-pages 2,8,32] [--warmup-pdfs 2] [--stream] [--repeat-ratio 0.2]
+#       [--embedding fake|real|URL] [--llm fake|real|URL] [--vector-backend numpy|chroma]
+#       [--server sync|async] [--orchestrator-env CHIAVE=VALORE ...] [--model-cache DIR]
+#       [--output risultati.json]
+#
+#   python benchmark/run_benchmark.py --compare base.json nuovo.json [--tolerance 0.1]
+#
+# Avvia l'orchestratore (con Gunicorn, come nell'immagine) collegato a servizi
+# sostitutivi deterministici (fake_services.py) oppure ai servizi reali di
+# Embeddings/ e LLM/, o a servizi già in esecuzione indicandone l'URL. Con
+# --orchestrator-url si misura invece uno stack già avviato. I servizi reali
+# vengono avviati nelle loro cartelle con MODEL_CACHE_PATH=--model-cache invece
+# della cartella /app/model_cache del container; le altre variabili (token di
+# Hugging Face, EMBEDDING_MODEL_PATH, ...) passano dall'ambiente del benchmark.
+#
+# Durante il test girano insieme:
+# - index-workers client che caricano PDF generati (di --pdf-pages pagine, a
+#   rotazione) con /index-pdf asincrono e attendono la fine del job;
+# - chat-sessions utenti che fanno domande in sequenza sui documenti indicizzati
+#   (una quota --repeat-ratio ripete una domanda già fatta, come accade nella
+#   cache delle risposte).
+#
+# Il risultato (latenze p50/p95/p99, throughput, tassi di errore e tempo medio di
+# ogni fase dell'orchestratore) viene stampato e salvato in JSON; --compare
+# confronta due risultati ed esce con codice 1 se trova regressioni.
+#
+# Dipendenze: pip install -r benchmark/requirements.txt -r Orchestratore/requirements.txt
+# ==============================================================================
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# ------------------------------------------------------------------------------
+# 1. GENERAZIONE DEI DOCUMENTI
+# ------------------------------------------------------------------------------
+# Solo caratteri ASCII: il font standard Helvetica non richiede di incorporare font
+WORDS = (
+    "analisi", "archivio", "attivita", "bilancio", "cliente", "contratto", "controllo", "costo",
+    "dati", "documento", "fattura", "fornitore", "gestione", "impianto", "indice", "licenza",
+    "manutenzione", "modulo", "normativa", "ordine", "personale", "piano", "procedura", "processo",
+    "progetto", "qualita", "registro", "report", "requisito", "rischio", "servizio", "sicurezza",
+    "sistema", "sede", "scadenza", "sviluppo", "tecnico", "termine", "ufficio", "verifica",
+    "il", "la", "di", "per", "con", "del", "della", "nel", "e", "un", "una", "che", "sono", "viene",
+)
+LINES_PER_PAGE = 48
+WORDS_PER_LINE = 11
+
+
+def make_pdf(pages):
+    """Crea un PDF minimo con una pagina per ogni lista di righe.
+
+    Le righe che iniziano con "\\n" aprono un nuovo paragrafo: l'estrazione del
+    testo produce una riga vuota, come nei documenti reali.
+    """
+    objects = []
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    font_id = add(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    # L'oggetto /Pages viene aggiunto dopo contenuti e pagine (due oggetti per pagina)
+    pages_id = len(objects) + 2 * len(pages) + 1
+    page_ids = []
+    for lines in pages:
+        operations = ["BT /F1 11 Tf 14 TL 50 800 Td"]
+        for line in lines:
+            escaped = line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)").replace("\n", "\\n")
+            operations.append(f"({escaped}) Tj T*")
+        operations.append("ET")
+        stream = "\n".join(operations).encode("latin-1")
+        content_id = add(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        page_ids.append(add(
+            b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+            b"/Resources << /Font << /F1 %d 0 R >> >> >>" % (pages_id, content_id, font_id)
+        ))
+    add(b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % i for i in page_ids), len(page_ids)))
+    catalog_id = add(b"<< /Type /Catalog /Pages %d 0 R >>" % pages_id)
+
+    output = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(output))
+        output += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref_offset = len(output)
+    output += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        output += b"%010d 00000 n \n" % offset
+    output += b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, catalog_id, xref_offset)
+    return bytes(output)
+
+
+def generate_document(seed, number, page_count):
+    """Documento deterministico: (nome del file, PDF, domande sul suo contenuto).
+
+    Lo stesso seme e numero producono sempre lo stesso PDF; numeri diversi danno
+    file diversi, quindi nessun caricamento viene deduplicato dall'orchestratore.
+    """
+    rng = random.Random(f"{seed}-document-{number}")
+    pages, questions = [], []
+    for _ in range(page_count):
+        lines = []
+        while len(lines) < LINES_PER_PAGE:
+            paragraph = [" ".join(rng.choice(WORDS) for _ in range(WORDS_PER_LINE)) for _ in range(rng.randint(3, 6))]
+            paragraph[0] = "\n" + paragraph[0]
+            lines.extend(paragraph)
+            topic = [word for word in paragraph[-1].split() if len(word) > 4][:2] or ["documento"]
+            questions.append(f"Cosa dice il documento a proposito di {' e '.join(topic)}?")
+        pages.append(lines[:LINES_PER_PAGE])
+    return f"benchmark-{seed}-{number}-{page_count}p.pdf", make_pdf(pages), questions
+
+# ------------------------------------------------------------------------------
+# 2. AVVIO DEI SERVIZI
+# ------------------------------------------------------------------------------
+def free_port():
+    with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_process(stack, name, command, cwd, env, log_dir):
+    # Avvia un servizio in background; l'output finisce in <log_dir>/<name>.log
+    log_path = os.path.join(log_dir, f"{name}.log")
+    log_file = stack.enter_context(open(log_path, "w"))
+    process = subprocess.Popen(command, cwd=cwd, env=dict(os.environ, **env), stdout=log_file, stderr=subprocess.STDOUT)
+    stack.callback(stop_process, process)
+    process.log_path = log_path
+    return process
+
+
+def stop_process(process):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def wait_ready(name, url, process, timeout):
+    # Attende che il servizio risponda 200 sull'URL indicato
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            break
+        try:
+            if requests.get(url, timeout=5).status_code == 200:
+                print(f"  {name} pronto: {url}")
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    log_tail = ""
+    if process is not None:
+        with open(process.log_path, encoding="utf-8", errors="replace") as f:
+            log_tail = "".join(f.readlines()[-20:])
+    raise RuntimeError(f"{name} non è pronto su {url}.\n{log_tail}")
+
+
+def gunicorn_command(port, app_spec, workers=1, threads=1, timeout=300, extra=()):
+    return [
+        sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", str(workers),
+        "--threads", str(threads), "--timeout", str(timeout), *extra, app_spec
+    ]
+
+
+def start_embedding(stack, options, workdir, log_dir):
+    # Restituisce l'URL base del servizio di embedding
+    if options.embedding not in ("fake", "real"):
+        return options.embedding.rstrip("/")
+    port = free_port()
+    if options.embedding == "fake":
+        process = start_process(
+            stack, "embedding", gunicorn_command(port, "fake_services:embedding_app", threads=64), BENCHMARK_DIR,
+            {"FAKE_EMBEDDING_MS_PER_ITEM": str(options.embedding_ms_per_item)}, log_dir
+        )
+    else:
+        process = start_process(
+            stack, "embedding", [sys.executable, "-m", "gunicorn", "--config", "gunicorn.conf.py", "app:app"],
+            os.path.join(REPO_DIR, "Embeddings"),
+            {
+                "GUNICORN_BIND": f"127.0.0.1:{port}", "PROMETHEUS_MULTIPROC_DIR": os.path.join(workdir, "metrics-embedding"),
+                "MODEL_CACHE_PATH": options.model_cache,
+            },
+            log_dir
+        )
+    url = f"http://127.0.0.1:{port}"
+    wait_ready("embedding", url + "/ready", process, options.startup_timeout)
+    return url
+
+
+def start_llm(stack, options, log_dir):
+    # Restituisce l'URL base del servizio LLM
+    if options.llm not in ("fake", "real"):
+        return options.llm.rstrip("/")
+    port = free_port()
+    if options.llm == "fake":
+        process = start_process(
+            stack, "llm", gunicorn_command(port, "fake_services:llm_app", threads=64), BENCHMARK_DIR, {
+                "FAKE_LLM_PREFILL_MS_PER_TOKEN": str(options.llm_prefill_ms),
+                "FAKE_LLM_DECODE_MS_PER_TOKEN": str(options.llm_decode_ms),
+                "FAKE_LLM_COMPLETION_TOKENS": str(options.llm_completion_tokens),
+                "FAKE_LLM_SLOTS": str(options.llm_slots),
+            }, log_dir
+        )
+        ready_path = "/ready"
+    else:
+        # Stessi parametri del DockerFile di LLM/. Il servizio non ha un endpoint di
+        # readiness: /metrics va bene solo perché LLM/app.py carica il modello all'import,
+        # quindi il worker risponde soltanto a caricamento concluso. Se il caricamento
+        # fallisce /metrics risponde comunque e gli errori compaiono nelle chat (vedi llm.log).
+        process = start_process(
+            stack, "llm", gunicorn_command(port, "app:app", threads=32, timeout=1200), os.path.join(REPO_DIR, "LLM"),
+            {"MODEL_CACHE_PATH": options.model_cache}, log_dir
+        )
+        ready_path = "/metrics"
+    url = f"http://127.0.0.1:{port}"
+    wait_ready("llm", url + ready_path, process, options.startup_timeout)
+    return url
+
+
+def start_stack(stack, options, workdir):
+    """Avvia i servizi richiesti e l'orchestratore; restituisce l'URL dell'orchestratore."""
+    log_dir = os.path.join(workdir, "logs")
+    os.makedirs(log_dir, exist_ok=True)
+    print(f"Avvio dei servizi (log in {log_dir})...")
+    embedding_url = start_embedding(stack, options, workdir, log_dir)
+    llm_url = start_llm(stack, options, log_dir)
+
+    metrics_dir = os.path.join(workdir, "metrics-orchestrator")
+    os.makedirs(metrics_dir, exist_ok=True)
+    env = {
+        "EMBEDDING_API_URL": embedding_url + "/create-embedding",
+        "LLM_API_URL": llm_url + "/generate",
+        "VECTOR_BACKEND": options.vector_backend,
+        "VECTOR_INDEX_PATH": os.path.join(workdir, "vector-index"),
+        "JOBS_DIR": os.path.join(workdir, "jobs"),
+        "PROMETHEUS_MULTIPROC_DIR": metrics_dir,
+    }
+    if options.vector_backend == "chroma":
+        if options.chroma:
+            host, _, port = options.chroma.rpartition(":")
+        else:
+            # Chroma locale, con i dati nella cartella di lavoro
+            host, port = "127.0.0.1", str(free_port())
+            chroma = start_process(
+                stack, "chroma", ["chroma", "run", "--path", os.path.join(workdir, "chroma"), "--host", host, "--port", port],
+                workdir, {}, log_dir
+            )
+            wait_ready("chroma", f"http://{host}:{port}/api/v2/heartbeat", chroma, options.startup_timeout)
+        env.update(CHROMA_HOST=host, CHROMA_PORT=port)
+    for item in options.orchestrator_env:
+        key, _, value = item.partition("=")
+        env[key] = value
+
+    port = free_port()
+    if options.server == "async":
+        command = gunicorn_command(port, "asgi:app", workers=options.workers, extra=("-k", "uvicorn.workers.UvicornWorker"))
+    else:
+        command = gunicorn_command(port, "app:app", workers=options.workers)
+    process = start_process(stack, "orchestrator", command, os.path.join(REPO_DIR, "Orchestratore"), env, log_dir)
+    url = f"http://127.0.0.1:{port}"
+    wait_ready("orchestrator", url + "/metrics", process, options.startup_timeout)
+    return url
+
+# ------------------------------------------------------------------------------
+# 3. GENERAZIONE DEL CARICO
+# ------------------------------------------------------------------------------
+class Recorder:
+    """Raccoglie i campioni delle operazioni eseguite dai client (thread-safe)."""
+
+    def __init__(self):
+        self.samples = []
+        self.lock = threading.Lock()
+
+    def add(self, sample):
+        with self.lock:
+            self.samples.append(sample)
+
+
+class Corpus:
+    """Documenti indicizzati su cui gli utenti possono fare domande."""
+
+    def __init__(self):
+        self.documents = []
+        self.lock = threading.Lock()
+
+    def add(self, collection_name, questions):
+        with self.lock:
+            self.documents.append((collection_name, questions))
+
+    def pick(self, rng):
+        with self.lock:
+            return rng.choice(self.documents) if self.documents else (None, None)
+
+
+def failure(sample, status):
+    sample.update(ok=False, status=status)
+    return sample
+
+
+def index_document(session, base_url, filename, pdf_bytes, options):
+    """Carica un PDF con /index-pdf asincrono e attende la fine del job.
+
+    La latenza va dal caricamento alla fine dell'indicizzazione (con la
+    risoluzione di --poll-interval).
+    """
+    sample = {"operation": "index_pdf", "ok": True, "status": "ok", "size_bytes": len(pdf_bytes)}
+    started = time.perf_counter()
+    try:
+        response = session.post(
+            f"{base_url}/index-pdf", files={"file": (filename, pdf_bytes, "application/pdf")},
+            data={"async": "true"}, timeout=options.request_timeout
+        )
+        if response.status_code == 200:
+            job = response.json()
+        elif response.status_code != 202:
+            return failure(sample, f"http_{response.status_code}")
+        else:
+            job_url = f"{base_url}/jobs/{response.json()['job_id']}"
+            while True:
+                poll = session.get(job_url, timeout=options.request_timeout)
+                if poll.status_code != 200:
+                    # Un job sparito o un errore del server non si risolvono aspettando
+                    sample["error"] = poll.text[:500]
+                    print(f"{job_url}: HTTP {poll.status_code} {sample['error']}")
+                    return failure(sample, f"poll_http_{poll.status_code}")
+                job = poll.json()
+                if job.get("status") in ("done", "failed"):
+                    break
+                if time.perf_counter() - started > options.request_timeout:
+                    return failure(sample, "timeout")
+                time.sleep(options.poll_interval)
+            if job["status"] == "failed":
+                return failure(sample, "job_failed")
+        sample.update(
+            latency_s=time.perf_counter() - started, collection_name=job.get("collection_name"),
+            pages=job.get("pages_total"), chunks=job.get("chunks_indexed")
+        )
+        return sample
+    except (requests.RequestException, ValueError) as e:
+        return failure(sample, f"exception_{type(e).__name__}")
+
+
+def chat_turn(session, base_url, collection_name, question, options):
+    # Una domanda a /chat; in streaming misura anche il tempo al primo token
+    sample = {"operation": "chat", "ok": True, "status": "ok", "cached": False}
+    payload = {
+        "messages": [{"role": "user", "content": question}],
+        "max_tokens": options.max_tokens,
+        "collection_name": collection_name,
+        "stream": options.stream,
+    }
+    started = time.perf_counter()
+    try:
+        with session.post(f"{base_url}/chat", json=payload, stream=options.stream, timeout=options.request_timeout) as response:
+            if response.status_code != 200:
+                return failure(sample, f"http_{response.status_code}")
+            if not options.stream:
+                sample["cached"] = bool(response.json().get("cached"))
+            else:
+                for line in response.iter_lines():
+                    if not line.startswith(b"data:"):
+                        continue
+                    event = json.loads(line[len(b"data:"):])
+                    if "token" in event and "time_to_first_token_s" not in sample:
+                        sample["time_to_first_token_s"] = time.perf_counter() - started
+                    elif "error" in event:
+                        return failure(sample, "stream_error")
+                    elif event.get("done"):
+                        sample["cached"] = bool(event.get("cached"))
+        sample["latency_s"] = time.perf_counter() - started
+        return sample
+    except (requests.RequestException, ValueError) as e:
+        return failure(sample, f"exception_{type(e).__name__}")
+
+
+def index_worker(base_url, options, documents, corpus, recorder, deadline):
+    session = requests.Session()
+    while time.monotonic() < deadline:
+        number = next(documents)
+        page_count = options.pdf_pages[number % len(options.pdf_pages)]
+        filename, pdf_bytes, questions = generate_document(options.seed, number, page_count)
+        sample = index_document(session, base_url, filename, pdf_bytes, options)
+        recorder.add(sample)
+        if sample["ok"] and sample.get("collection_name"):
+            corpus.add(sample["collection_name"], questions)
+
+
+def chat_session(number, base_url, options, corpus, recorder, deadline):
+    rng = random.Random(f"{options.seed}-chat-{number}")
+    session = requests.Session()
+    asked = []
+    while time.monotonic() < deadline:
+        if asked and rng.random() < options.repeat_ratio:
+            collection_name, question = rng.choice(asked)
+        else:
+            collection_name, questions = corpus.pick(rng)
+            question = rng.choice(questions) if questions else f"Domanda generica numero {rng.randint(0, 10 ** 6)}?"
+            asked.append((collection_name, question))
+        recorder.add(chat_turn(session, base_url, collection_name, question, options))
+        if options.think_time:
+            time.sleep(rng.expovariate(1 / options.think_time))
+
+
+def run_load(base_url, options):
+    """Esegue il carico per --duration secondi; restituisce (campioni, durata effettiva).
+
+    Le operazioni in corso alla scadenza vengono completate e contate.
+    """
+    corpus, recorder = Corpus(), Recorder()
+    documents = itertools.count()
+    if options.warmup_pdfs:
+        print(f"Indicizzazione di {options.warmup_pdfs} documenti iniziali (esclusi dalle misure)...")
+    session = requests.Session()
+    for _ in range(options.warmup_pdfs):
+        number = next(documents)
+        filename, pdf_bytes, questions = generate_document(options.seed, number, options.pdf_pages[number % len(options.pdf_pages)])
+        sample = index_document(session, base_url, filename, pdf_bytes, options)
+        if not sample["ok"]:
+            detail = f": {sample['error']}" if sample.get("error") else ""
+            raise RuntimeError(f"Indicizzazione iniziale non riuscita: {sample['status']}{detail}")
+        corpus.add(sample["collection_name"], questions)
+
+    print(f"Carico per {options.duration}s: {options.index_workers} client di indicizzazione, {options.chat_sessions} sessioni di chat...")
+    started = time.monotonic()
+    deadline = started + options.duration
+    workers = [
+        threading.Thread(target=index_worker, args=(base_url, options, documents, corpus, recorder, deadline))
+        for _ in range(options.index_workers)
+    ] + [
+        threading.Thread(target=chat_session, args=(i, base_url, options, corpus, recorder, deadline))
+        for i in range(options.chat_sessions)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return recorder.samples, time.monotonic() - started
+
+# ------------------------------------------------------------------------------
+# 4. RISULTATI
+# ------------------------------------------------------------------------------
+def percentile(sorted_values, p):
+    # Percentile con interpolazione lineare tra i due campioni più vicini
+    if not sorted_values:
+        return None
+    position = (len(sorted_values) - 1) * p / 100
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+
+def distribution(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {
+        "p50": round(percentile(values, 50), 4),
+        "p95": round(percentile(values, 95), 4),
+        "p99": round(percentile(values, 99), 4),
+        "mean": round(sum(values) / len(values), 4),
+        "max": round(values[-1], 4),
+    }
+
+
+def summarize(samples, duration):
+    operations = {}
+    for operation in ("index_pdf", "chat"):
+        selected = [sample for sample in samples if sample["operation"] == operation]
+        ok = [sample for sample in selected if sample["ok"]]
+        errors = {}
+        for sample in selected:
+            if not sample["ok"]:
+                errors[sample["status"]] = errors.get(sample["status"], 0) + 1
+        summary = {
+            "requests": len(selected),
+            "errors": len(selected) - len(ok),
+            "error_rate": round((len(selected) - len(ok)) / len(selected), 4) if selected else 0.0,
+            "errors_by_status": errors,
+            "throughput_per_s": round(len(ok) / duration, 3),
+            "latency_s": distribution([sample["latency_s"] for sample in ok]),
+        }
+        if operation == "index_pdf":
+            summary["pages_per_s"] = round(sum(sample.get("pages") or 0 for sample in ok) / duration, 3)
+            summary["chunks_per_s"] = round(sum(sample.get("chunks") or 0 for sample in ok) / duration, 3)
+        else:
+            summary["cache_hits"] = sum(1 for sample in ok if sample["cached"])
+            summary["time_to_first_token_s"] = distribution(
+                [sample["time_to_first_token_s"] for sample in ok if "time_to_first_token_s" in sample]
+            )
+        operations[operation] = summary
+    return operations
+
+
+STAGE_SAMPLE = re.compile(r'^orchestrator_stage_seconds_(sum|count)\{([^}]*)\} (\S+)$')
+
+
+def scrape_stage_totals(base_url):
+    # Somme e conteggi di orchestrator_stage_seconds per (operazione, fase) da /metrics
+    totals = {}
+    try:
+        text = requests.get(f"{base_url}/metrics", timeout=10).text
+    except requests.RequestException:
+        return totals
+    for line in text.splitlines():
+        match = STAGE_SAMPLE.match(line)
+        if match:
+            labels = dict(re.findall(r'(\w+)="([^"]*)"', match.group(2)))
+            key = f"{labels.get('operation')}/{labels.get('stage')}"
+            totals.setdefault(key, {"sum": 0.0, "count": 0.0})[match.group(1)] += float(match.group(3))
+    return totals
+
+
+def stage_means(before, after):
+    # Tempo medio di ogni fase durante il test (differenza tra le due letture di /metrics)
+    means = {}
+    for key, total in sorted(after.items()):
+        previous = before.get(key, {"sum": 0.0, "count": 0.0})
+        count = total["count"] - previous["count"]
+        if count > 0:
+            means[key] = {"count": int(count), "mean_s": round((total["sum"] - previous["sum"]) / count, 4)}
+    return means
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_summary(result):
+    print(f"\n{'operazione':<12}{'richieste':>10}{'errori %':>10}{'op/s':>8}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}{'TTFT p95':>10}")
+    for operation, summary in result["operations"].items():
+        latency = summary["latency_s"] or {}
+        ttft = summary.get("time_to_first_token_s") or {}
+        print(f"{operation:<12}{summary['requests']:>10}{summary['error_rate'] * 100:>10.1f}{summary['throughput_per_s']:>8}"
+              f"{latency.get('p50', '-'):>9}{latency.get('p95', '-'):>9}{latency.get('p99', '-'):>9}{ttft.get('p95', '-'):>10}")
+    if result["stages"]:
+        print("\nTempo medio delle fasi dell'orchestratore:")
+        for key, stage in result["stages"].items():
+            print(f"  {key:<32}{stage['mean_s']:>9}s  ({stage['count']} campioni)")
+
+# ------------------------------------------------------------------------------
+# 5. CONFRONTO TRA DUE ESECUZIONI
+# ------------------------------------------------------------------------------
+# (operazione, metrica, percorso nel JSON, True se un valore più alto è peggiore)
+COMPARED_METRICS = [
+    (operation, name, path, higher_is_worse)
+    for operation in ("index_pdf", "chat")
+    for name, path, higher_is_worse in (
+        ("latenza p50", ("latency_s", "p50"), True),
+        ("latenza p95", ("latency_s", "p95"), True),
+        ("latenza p99", ("latency_s", "p99"), True),
+        ("TTFT p95", ("time_to_first_token_s", "p95"), True),
+        ("throughput", ("throughput_per_s",), False),
+        ("tasso di errore", ("error_rate",), True),
+    )
+]
+
+
+# Aumento assoluto del tasso di errore considerato una regressione (1 punto percentuale)
+ERROR_RATE_TOLERANCE = 0.01
+
+
+def metric_value(result, operation, path):
+    value = result["operations"].get(operation)
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+
+def compare(base_path, new_path, tolerance):
+    """Confronta due risultati; restituisce il numero di regressioni.
+
+    Una metrica regredisce se peggiora più della tolleranza relativa; per il tasso
+    di errore conta invece la differenza assoluta.
+    """
+    with open(base_path, encoding="utf-8") as f:
+        base = json.load(f)
+    with open(new_path, encoding="utf-8") as f:
+        new = json.load(f)
+    if base.get("config", {}).get("workload") != new.get("config", {}).get("workload"):
+        print("Attenzione: le due esecuzioni hanno un carico diverso, il confronto è solo indicativo.")
+
+    regressions = 0
+    print(f"{'operazione':<12}{'metrica':<18}{'base':>10}{'nuovo':>10}{'variazione':>12}")
+    for operation, name, path, higher_is_worse in COMPARED_METRICS:
+        old_value, new_value = metric_value(base, operation, path), metric_value(new, operation, path)
+        if old_value is None or new_value is None:
+            continue
+        if name == "tasso di errore":
+            change = new_value - old_value
+            label = f"{change * 100:+.1f} pt"
+            worse = change > ERROR_RATE_TOLERANCE
+        else:
+            change = (new_value - old_value) / old_value if old_value else 0.0
+            label = f"{change * 100:+.1f}%"
+            worse = change > tolerance if higher_is_worse else change < -tolerance
+        regressions += worse
+        print(f"{operation:<12}{name:<18}{old_value:>10}{new_value:>10}{label:>12}{'  REGRESSIONE' if worse else ''}")
+    print(f"\n{regressions} regressioni (tolleranza {tolerance * 100:.0f}%).")
+    return regressions
+
+# ------------------------------------------------------------------------------
+# 6. AVVIO
+# ------------------------------------------------------------------------------
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Benchmark end-to-end di indicizzazione e chat")
+    parser.add_argument("--compare", nargs=2, metavar=("BASE", "NUOVO"), help="confronta due file di risultati")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="peggioramento relativo tollerato nel confronto")
+    parser.add_argument("--output", help="file JSON in cui salvare i risultati")
+
+    workload = parser.add_argument_group("carico")
+    workload.add_argument("--duration", type=float, default=60)
+    workload.add_argument("--chat-sessions", type=int, default=8, help="utenti che fanno domande contemporaneamente")
+    workload.add_argument("--index-workers", type=int, default=1, help="client che caricano PDF contemporaneamente")
+    workload.add_argument("--pdf-pages", default="2,8,32", help="pagine dei PDF generati, a rotazione")
+    workload.add_argument("--warmup-pdfs", type=int, default=2, help="documenti indicizzati prima delle misure")
+    workload.add_argument("--repeat-ratio", type=float, default=0.2, help="quota di domande già fatte dalla sessione")
+    workload.add_argument("--think-time", type=float, default=0.0, help="pausa media in secondi tra due domande")
+    workload.add_argument("--max-tokens", type=int, default=256)
+    workload.add_argument("--stream", action="store_true", help="chat in streaming (misura anche il TTFT)")
+    workload.add_argument("--seed", type=int, default=0)
+    workload.add_argument("--poll-interval", type=float, default=0.2, help="intervallo di interrogazione di /jobs")
+    workload.add_argument("--request-timeout", type=float, default=600)
+
+    stack = parser.add_argument_group("servizi")
+    stack.add_argument("--orchestrator-url", help="misura un orchestratore già avviato invece di avviarne uno")
+    stack.add_argument("--embedding", default="fake", help="fake, real (Embeddings/app.py) oppure URL base")
+    stack.add_argument("--llm", default="fake", help="fake, real (LLM/app.py) oppure URL base")
+    stack.add_argument("--vector-backend", choices=("numpy", "chroma"), default="numpy")
+    stack.add_argument("--chroma", help="host:porta di Chroma (default: avvia 'chroma run' locale)")
+    stack.add_argument("--server", choices=("sync", "async"), default="sync", help="orchestratore WSGI (app.py) o ASGI (asgi.py)")
+    stack.add_argument("--workers", type=int, default=2, help="worker Gunicorn dell'orchestratore")
+    stack.add_argument("--orchestrator-env", action="append", default=[], metavar="CHIAVE=VALORE",
+                       help="variabile d'ambiente aggiuntiva per l'orchestratore (ripetibile)")
+    stack.add_argument("--startup-timeout", type=float, default=600)
+    stack.add_argument("--model-cache", default=os.getenv("MODEL_CACHE_PATH", os.path.expanduser("~/.cache/rag-benchmark/models")),
+                       help="cartella dei modelli per --embedding real e --llm real (al posto di /app/model_cache)")
+    stack.add_argument("--workdir", help="cartella per indice, job e log (default: temporanea)")
+    stack.add_argument("--keep-workdir", action="store_true")
+
+    fake = parser.add_argument_group("servizi finti")
+    fake.add_argument("--embedding-ms-per-item", type=float, default=5)
+    fake.add_argument("--llm-prefill-ms", type=float, default=1, help="ms di prefill per token del prompt")
+    fake.add_argument("--llm-decode-ms", type=float, default=50, help="ms per token generato")
+    fake.add_argument("--llm-completion-tokens", type=int, default=64)
+    fake.add_argument("--llm-slots", type=int, default=1, help="generazioni contemporanee (1 come llama.cpp)")
+
+    options = parser.parse_args(args)
+    options.pdf_pages = [int(pages) for pages in options.pdf_pages.split(",")]
+    return options
+
+
+def run(options):
+    workload = {
+        key: getattr(options, key) for key in (
+            "duration", "chat_sessions", "index_workers", "pdf_pages", "warmup_pdfs", "repeat_ratio",
+            "think_time", "max_tokens", "stream", "seed"
+        )
+    }
+    stack_config = {
+        key: getattr(options, key) for key in ("orchestrator_url", "server", "workers", "vector_backend", "orchestrator_env")
+    }
+    stack_config.update(embedding=options.embedding, llm=options.llm)
+    if options.embedding == "fake":
+        stack_config["fake_embedding"] = {"ms_per_item": options.embedding_ms_per_item}
+    if options.llm == "fake":
+        stack_config["fake_llm"] = {
+            "prefill_ms_per_token": options.llm_prefill_ms, "decode_ms_per_token": options.llm_decode_ms,
+            "completion_tokens": options.llm_completion_tokens, "slots": options.llm_slots,
+        }
+
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    workdir = options.workdir or tempfile.mkdtemp(prefix="rag-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    try:
+        with contextlib.ExitStack() as stack:
+            base_url = options.orchestrator_url.rstrip("/") if options.orchestrator_url else start_stack(stack, options, workdir)
+            before = scrape_stage_totals(base_url)
+            samples, duration = run_load(base_url, options)
+            stages = stage_means(before, scrape_stage_totals(base_url))
+    finally:
+        if options.keep_workdir or options.workdir:
+            print(f"Cartella di lavoro: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    result = {
+        "config": {"workload": workload, "stack": stack_config},
+        "environment": {"git_revision": git_revision(), "cpu_count": os.cpu_count(), "python": sys.version.split()[0]},
+        "started_at": started_at,
+        "duration_s": round(duration, 2),
+        "operations": summarize(samples, duration),
+        "stages": stages,
+    }
+    print_summary(result)
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+    return result
+
+
+if __name__ == '__main__':
+    options = parse_args(sys.argv[1:])
+    if options.compare:
+        sys.exit(1 if compare(*options.compare, options.tolerance) else 0)
+    run(options)
@@ -1,11 +1,20 @@
 import streamlit as st
 import requests
+import json
 import os
+import time
+import uuid
 
 # --- 1. CONFIGURAZIONE ---
 # Legge l'URL dell'API Orchestrator da una variabile d'ambiente per flessibilità in OpenShift.
 # Se non la trova, usa un valore di default per i test locali.
 ORCHESTRATOR_API_URL = os.getenv("ORCHESTRATOR_API_URL", "http://orchestrator-service:8080")
+# Ogni upload e ogni domanda ha un proprio ID, inviato in questo header e riportato nei
+# log di tutti i servizi: mostrato negli errori, permette di ritrovare la richiesta lenta.
+REQUEST_ID_HEADER = "X-Request-ID"
+# Attesa massima di un'indicizzazione e tempo massimo senza avanzamenti del job
+JOB_WAIT_TIMEOUT = int(os.getenv("JOB_WAIT_TIMEOUT", "3600"))
+JOB_STALL_TIMEOUT = int(os.getenv("JOB_STALL_TIMEOUT", "600"))
 
 # Imposta la configurazione della pagina Streamlit (titolo, layout, etc.)
 st.set_page_config(page_title="Chat RAG Multi-Sessione", layout="wide")
@@ -25,9 +34,46 @@ if "collection_name" not in st.session_state:
     st.session_state.collection_name = None
 if "last_uploaded_file" not in st.session_state:
     st.session_state.last_uploaded_file = None
+if "stream" not in st.session_state:
+    st.session_state.stream = True
 
 
 # --- 3. SIDEBAR DI CONFIGURAZIONE E UPLOAD ---
+def wait_for_job(job_id, request_id):
+    """Interroga /jobs/<id> finché l'indicizzazione non termina, mostrando l'avanzamento.
+
+    Restituisce lo stato finale del job ("done" oppure "failed"). Un job sconosciuto
+    all'orchestratore, fermo da più di JOB_STALL_TIMEOUT secondi o non concluso entro
+    JOB_WAIT_TIMEOUT secondi viene considerato fallito.
+    """
+    progress_bar = st.progress(0.0, text="Indicizzazione in coda...")
+    started = time.monotonic()
+    last_progress, last_progress_at = None, started
+    while True:
+        response = requests.get(f"{ORCHESTRATOR_API_URL}/jobs/{job_id}", headers={REQUEST_ID_HEADER: request_id}, timeout=10)
+        if response.status_code != 200:
+            progress_bar.empty()
+            return {"status": "failed", "error": response.json().get("error", f"Stato del job non disponibile (HTTP {response.status_code}).")}
+        job = response.json()
+        if job.get("status") in ("done", "failed"):
+            progress_bar.empty()
+            return job
+        now = time.monotonic()
+        progress = (job.get("status"), job.get("pages_done"), job.get("chunks_indexed"))
+        if progress != last_progress:
+            last_progress, last_progress_at = progress, now
+        if now - last_progress_at > JOB_STALL_TIMEOUT or now - started > JOB_WAIT_TIMEOUT:
+            progress_bar.empty()
+            return {"status": "failed", "error": "L'indicizzazione non avanza più: riprova a caricare il file."}
+        pages_total = job.get("pages_total") or 0
+        if pages_total:
+            progress_bar.progress(
+                min(job.get("pages_done", 0) / pages_total, 1.0),
+                text=f"Pagine lette: {job.get('pages_done', 0)}/{pages_total} · chunk indicizzati: {job.get('chunks_indexed', 0)}"
+            )
+        time.sleep(1)
+
+
 with st.sidebar:
     st.header("Configurazione")
     
@@ -39,14 +85,31 @@ with st.sidebar:
     if uploaded_file is not None and uploaded_file.id != st.session_state.get("last_uploaded_file_id"):
         st.info(f"Nuovo file rilevato: {uploaded_file.name}")
         with st.spinner('Indicizzazione in corso... Potrebbe richiedere tempo.'):
+            request_id = uuid.uuid4().hex
             try:
                 # Prepara il file per l'invio tramite una richiesta POST multipart/form-data.
                 files = {'file': (uploaded_file.name, uploaded_file.getvalue(), 'application/pdf')}
-                # Chiama l'API per indicizzare il file.
-                response = requests.post(f"{ORCHESTRATOR_API_URL}/index-pdf", files=files, timeout=300)
-                
-                if response.status_code == 200:
+                # Chiama l'API per indicizzare il file in modalità asincrona: la risposta
+                # contiene l'ID del job, il cui avanzamento viene poi interrogato periodicamente.
+                response = requests.post(
+                    f"{ORCHESTRATOR_API_URL}/index-pdf", files=files, data={"async": "true"},
+                    headers={REQUEST_ID_HEADER: request_id}, timeout=60
+                )
+
+                if response.status_code == 202:
+                    job = wait_for_job(response.json()["job_id"], request_id)
+                    if job["status"] == "done":
+                        response_data = job
+                    else:
+                        response_data = None
+                        st.error(f"Errore durante l'indicizzazione: {job.get('error', 'Errore sconosciuto')} (ID richiesta: {request_id})")
+                elif response.status_code == 200:
                     response_data = response.json()
+                else:
+                    response_data = None
+                    st.error(f"Errore dal server: {response.json().get('error', 'Errore sconosciuto')} (ID richiesta: {request_id})")
+
+                if response_data is not None:
                     st.success(response_data.get('message', 'File indicizzato!'))
                     
                     # Salva il nome della collection e l'ID del file nella sessione corrente.
@@ -56,10 +119,8 @@ with st.sidebar:
                     # Resetta la cronologia della chat per iniziare una nuova conversazione.
                     st.session_state.messages = [{"role": "assistant", "content": f"Ho letto il documento '{uploaded_file.name}'. Ora puoi farmi delle domande."}]
                     st.rerun() # Forza un refresh dell'interfaccia per mostrare subito il messaggio.
-                else:
-                    st.error(f"Errore dal server: {response.json().get('error', 'Errore sconosciuto')}")
             except Exception as e:
-                st.error(f"Errore di connessione all'API: {e}")
+                st.error(f"Errore di connessione all'API: {e} (ID richiesta: {request_id})")
 
     st.divider()
 
@@ -67,8 +128,42 @@ with st.sidebar:
     st.subheader("Parametri LLM")
     st.session_state.max_tokens = st.slider("Max Token di Risposta", 256, 4096, st.session_state.max_tokens, 256)
     st.session_state.system_prompt = st.text_area("System Prompt", st.session_state.system_prompt, height=250)
+    st.session_state.stream = st.checkbox("Mostra la risposta mentre viene generata", st.session_state.stream)
 
 # --- 4. INTERFACCIA DI CHAT PRINCIPALE ---
+def stream_chat(payload, message_placeholder, request_id):
+    """Chiama /chat in modalità streaming e mostra i token man mano che arrivano.
+
+    Restituisce il testo completo della risposta, oppure None in caso di errore.
+    """
+    # Il timeout di lettura vale tra un evento e il successivo: una risposta lunga
+    # non scade finché il modello continua a produrre token.
+    with requests.post(
+        f"{ORCHESTRATOR_API_URL}/chat", json=dict(payload, stream=True), headers={REQUEST_ID_HEADER: request_id},
+        stream=True, timeout=(10, 300)
+    ) as response:
+        if response.status_code != 200:
+            message_placeholder.markdown(f"Errore dal server: {response.json().get('error', 'Errore sconosciuto')} (ID richiesta: {request_id})")
+            return None
+
+        response.encoding = "utf-8"
+        assistant_response = ""
+        for line in response.iter_lines(decode_unicode=True):
+            # Ogni evento SSE ha la forma "data: {...}"; le righe vuote separano gli eventi.
+            if not line or not line.startswith("data:"):
+                continue
+            event = json.loads(line[len("data:"):])
+            if "token" in event:
+                assistant_response += event["token"]
+                message_placeholder.markdown(assistant_response + "▌")
+            elif "error" in event:
+                message_placeholder.markdown(f"Errore dal server: {event['error']} (ID richiesta: {request_id})")
+                return None
+
+        message_placeholder.markdown(assistant_response)
+        return assistant_response
+
+
 # Mostra tutti i messaggi salvati nella cronologia della sessione corrente.
 for message in st.session_state.messages:
     with st.chat_message(message["role"]):
@@ -84,28 +179,42 @@ if prompt := st.chat_input("Fai una domanda..."):
     # Prepara e invia la richiesta all'assistente.
     with st.chat_message("assistant"):
         message_placeholder = st.empty()
-        with st.spinner("Sto elaborando la tua richiesta..."):
+        request_id = uuid.uuid4().hex
+        # Costruisce il payload per l'API di chat.
+        # Include i parametri configurati e il nome della collection attiva.
+        payload = {
+            "messages": [{"role": "user", "content": prompt}],
+            "max_tokens": st.session_state.max_tokens,
+            "system_prompt": st.session_state.system_prompt,
+            "collection_name": st.session_state.collection_name # Sarà None se nessun file è stato caricato.
+        }
+
+        if st.session_state.stream:
+            # Modalità streaming: i token compaiono nel placeholder appena generati.
+            message_placeholder.markdown("Sto elaborando la tua richiesta...")
             try:
-                # Costruisce il payload per l'API di chat.
-                # Include i parametri configurati e il nome della collection attiva.
-                payload = {
-                    "messages": [{"role": "user", "content": prompt}],
-                    "max_tokens": st.session_state.max_tokens,
-                    "system_prompt": st.session_state.system_prompt,
-                    "collection_name": st.session_state.collection_name # Sarà None se nessun file è stato caricato.
-                }
-                
-                # Chiama l'endpoint di chat dell'orchestratore.
-                response = requests.post(f"{ORCHESTRATOR_API_URL}/chat", json=payload, timeout=120)
-                
-                if response.status_code == 200:
-                    assistant_response = response.json().get('response', 'Risposta non valida.')
-                    message_placeholder.markdown(assistant_response)
+                assistant_response = stream_chat(payload, message_placeholder, request_id)
+                if assistant_response is not None:
                     # Aggiunge la risposta dell'assistente alla cronologia.
                     st.session_state.messages.append({"role": "assistant", "content": assistant_response})
-                else:
-                    error_msg = f"Errore dal server: {response.json().get('error', 'Errore sconosciuto')}"
-                    message_placeholder.markdown(error_msg)
             except Exception as e:
-                error_msg = f"Errore di connessione all'API: {e}"
-                message_placeholder.markdown(error_msg)
\ No newline at end of file
+                message_placeholder.markdown(f"Errore di connessione all'API: {e} (ID richiesta: {request_id})")
+        else:
+            with st.spinner("Sto elaborando la tua richiesta..."):
+                try:
+                    # Chiama l'endpoint di chat dell'orchestratore.
+                    response = requests.post(
+                        f"{ORCHESTRATOR_API_URL}/chat", json=payload, headers={REQUEST_ID_HEADER: request_id}, timeout=120
+                    )
+
+                    if response.status_code == 200:
+                        assistant_response = response.json().get('response', 'Risposta non valida.')
+                        message_placeholder.markdown(assistant_response)
+                        # Aggiunge la risposta dell'assistente alla cronologia.
+                        st.session_state.messages.append({"role": "assistant", "content": assistant_response})
+                    else:
+                        error_msg = f"Errore dal server: {response.json().get('error', 'Errore sconosciuto')} (ID richiesta: {request_id})"
+                        message_placeholder.markdown(error_msg)
+                except Exception as e:
+                    error_msg = f"Errore di connessione all'API: {e} (ID richiesta: {request_id})"
+                    message_placeholder.markdown(error_msg)
\ No newline at end of file
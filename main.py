@@ -1,8 +1,17 @@
 # Importiamo le librerie necessarie
-from flask import Flask, request, jsonify
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from flask import Flask, Response, g, request, jsonify
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+from transformers import AutoTokenizer, AutoModelForCausalLM, DynamicCache
 import torch
+import json
 import os # Importiamo 'os' per leggere le variabili d'ambiente
+import queue
+import resource
+import subprocess
+import sys
+import threading
+import time
+import uuid
 
 # -----------------------------------------------------------------------------
 # 1. INIZIALIZZAZIONE DELL'APPLICAZIONE FLASK
@@ -12,6 +21,39 @@ app = Flask(__name__)
 # Imposta la codifica JSON per supportare correttamente i caratteri UTF-8 (es. lettere accentate)
 app.config['JSON_AS_ASCII'] = False
 
+# Metriche in formato Prometheus, esposte su /metrics (stessi nomi del servizio llama.cpp)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, 1200)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+REQUESTS = Counter("llm_requests_total", "Richieste di generazione concluse, per esito", ["outcome"])
+QUEUE_WAIT_SECONDS = Histogram("llm_queue_wait_seconds", "Attesa prima di entrare nel batch", buckets=LATENCY_BUCKETS)
+FIRST_TOKEN_SECONDS = Histogram(
+    "llm_time_to_first_token_seconds", "Tempo dall'ingresso nel batch al primo token (prefill compreso)",
+    buckets=LATENCY_BUCKETS
+)
+GENERATION_SECONDS = Histogram("llm_generation_seconds", "Durata della generazione, esclusa l'attesa", buckets=LATENCY_BUCKETS)
+PROMPT_TOKENS = Histogram("llm_prompt_tokens", "Token del prompt per richiesta", buckets=TOKEN_BUCKETS)
+COMPLETION_TOKENS = Histogram("llm_completion_tokens", "Token generati per richiesta", buckets=TOKEN_BUCKETS)
+DECODE_TOKENS_PER_SECOND = Histogram(
+    "llm_decode_tokens_per_second", "Velocità di decodifica per richiesta (primo token escluso)",
+    buckets=(0.5, 1, 2, 4, 8, 12, 16, 24, 32, 48, 64, 128)
+)
+BATCH_SIZE = Histogram("llm_batch_size", "Sequenze avanzate insieme in ogni passo di decodifica", buckets=(1, 2, 3, 4, 6, 8, 12, 16, 32))
+
+# L'orchestratore propaga il suo X-Request-ID: qui compare nel log di ogni
+# generazione (token di prompt e generati) ed è restituito al chiamante.
+REQUEST_ID_HEADER = "X-Request-ID"
+
+
+@app.before_request
+def assign_request_id():
+    g.request_id = (request.headers.get(REQUEST_ID_HEADER) or "").strip()[:64] or uuid.uuid4().hex
+
+
+@app.after_request
+def add_request_id_header(response):
+    response.headers[REQUEST_ID_HEADER] = g.request_id
+    return response
+
 # -----------------------------------------------------------------------------
 # 2. CARICAMENTO DEL MODELLO E DEL TOKENIZER
 #
@@ -19,34 +61,356 @@ app.config['JSON_AS_ASCII'] = False
 # -----------------------------------------------------------------------------
 
 # Definiamo un percorso dedicato per la cache del modello, che verrà montato come volume emptyDir
-MODEL_CACHE_PATH = "./model_cache" 
-model_id = "google/gemma-2-2b-it"  # Modello instruction-tuned di Gemma 2
-dtype = torch.float32  # Tipo di dato ottimale per la CPU
+MODEL_CACHE_PATH = "./model_cache"
+model_id = os.getenv("MAIN_MODEL_ID", "google/gemma-2-2b-it")  # Modello instruction-tuned di Gemma 2 (o cartella locale)
+
+# Precisione del modello su CPU:
+#   "fp32" - massima compatibilità (default)
+#   "bf16" - metà memoria; veloce solo su CPU con istruzioni bfloat16 (AVX512-BF16/AMX),
+#            altrimenti si torna a fp32
+#   "int8" - quantizzazione dinamica dei layer Linear (pesi int8, attivazioni fp32)
+MAIN_PRECISION = os.getenv("MAIN_PRECISION", "fp32")
+# Con "1" il forward del modello viene compilato con torch.compile
+MAIN_COMPILE = os.getenv("MAIN_COMPILE", "0") == "1"
+# Thread usati da PyTorch per ogni operazione (default: i core disponibili al processo)
+MAIN_THREADS = int(os.getenv("MAIN_THREADS", str(len(os.sched_getaffinity(0)))))
+# Token massimi generati per ogni risposta
+MAIN_MAX_NEW_TOKENS = int(os.getenv("MAIN_MAX_NEW_TOKENS", "250"))
+# Con "1" all'avvio viene eseguita una generazione di prova, così la prima
+# richiesta reale non paga inizializzazioni e compilazione
+MAIN_WARMUP = os.getenv("MAIN_WARMUP", "1") == "1"
+
+PRECISIONS = ("fp32", "bf16", "int8")
+
+
+def configure_threads(num_threads):
+    # Un solo pool di thread per le operazioni: i thread tra operazioni diverse
+    # competerebbero per gli stessi core durante la generazione
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # già impostato: è consentito una sola volta per processo
 
-print(f"Tentativo di caricamento del modello '{model_id}'...")
-print(f"La cache del modello verrà salvata e cercata in: {MODEL_CACHE_PATH}")
 
-try:
+def cpu_supports_bf16():
+    # Il bfloat16 su CPU è conveniente solo con il supporto hardware di oneDNN
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        try:
+            with open("/proc/cpuinfo", encoding="utf-8") as f:
+                flags = f.read()
+            return "avx512_bf16" in flags or "amx_bf16" in flags
+        except OSError:
+            return False
+
+
+def load_model(precision=MAIN_PRECISION, compile_model=MAIN_COMPILE):
+    """Carica tokenizer e modello nella precisione richiesta.
+
+    Restituisce (tokenizer, modello, precisione effettiva).
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Precisione non valida: {precision} (usa una tra {', '.join(PRECISIONS)})")
+    if precision == "bf16" and not cpu_supports_bf16():
+        print("ATTENZIONE: la CPU non supporta il bfloat16 in hardware, uso fp32.")
+        precision = "fp32"
+
     # Carichiamo il tokenizer, specificando dove salvarlo/cercarlo
     tokenizer = AutoTokenizer.from_pretrained(model_id, cache_dir=MODEL_CACHE_PATH)
-    
+
     # Carichiamo il modello, forzando l'uso della CPU e specificando la cache
     model = AutoModelForCausalLM.from_pretrained(
         model_id,
-        torch_dtype=dtype,
+        torch_dtype=torch.bfloat16 if precision == "bf16" else torch.float32,
         device_map="cpu",  # Forza l'uso della CPU
-        cache_dir=MODEL_CACHE_PATH 
+        cache_dir=MODEL_CACHE_PATH
     )
-    print("Modello caricato con successo su CPU. ✅")
+    model.eval()
+
+    if precision == "int8":
+        # Pesi dei layer Linear in int8, quantizzazione delle attivazioni a runtime
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+    if compile_model:
+        model.forward = torch.compile(model.forward, dynamic=True)
+    return tokenizer, model, precision
+
+
+def warmup(tokenizer, model):
+    # Generazione breve di prova: inizializza i kernel (e la compilazione, se attiva)
+    started = time.perf_counter()
+    input_ids = tokenizer("Ciao", return_tensors="pt").to("cpu")
+    with torch.inference_mode():
+        model.generate(**input_ids, max_new_tokens=8, do_sample=False)
+    print(f"Warmup completato in {time.perf_counter() - started:.1f}s.")
+
+
+def rss_mb():
+    # Memoria residente attuale e massima del processo, in MB
+    with open("/proc/self/status", encoding="utf-8") as f:
+        current = next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(current / 1024, 1), round(peak / 1024, 1)
+
+
+# Il benchmark carica il modello in processi separati, uno per modalità
+BENCHMARK_RUN = __name__ == '__main__' and len(sys.argv) > 1 and sys.argv[1].startswith("--benchmark")
+
+configure_threads(MAIN_THREADS)
+
+if BENCHMARK_RUN:
+    tokenizer = model = None
+else:
+    print(f"Tentativo di caricamento del modello '{model_id}' ({MAIN_PRECISION}, {MAIN_THREADS} thread)...")
+    print(f"La cache del modello verrà salvata e cercata in: {MODEL_CACHE_PATH}")
+
+    try:
+        tokenizer, model, MAIN_PRECISION = load_model()
+        print(f"Modello caricato con successo su CPU ({MAIN_PRECISION}). ✅")
+        if MAIN_WARMUP:
+            warmup(tokenizer, model)
+
+    except Exception as e:
+        print(f"ERRORE CRITICO durante il caricamento del modello: {e}")
+        # Se il modello non si carica, l'applicazione non può funzionare.
+        model = None
+        tokenizer = None
+
+# -----------------------------------------------------------------------------
+# 3. GENERAZIONE CON BATCHING CONTINUO
+#
+#    Le richieste in corso avanzano insieme, un token per passo, con un solo
+#    forward per tutto il batch: durante la decodifica i core restano occupati
+#    anche con più utenti. Una richiesta entra nel batch appena c'è posto (dopo
+#    il prefill del suo prompt) ed esce appena termina, senza aspettare le altre.
+# -----------------------------------------------------------------------------
+# Sequenze generate contemporaneamente (1 = una richiesta alla volta)
+MAIN_MAX_BATCH_SIZE = int(os.getenv("MAIN_MAX_BATCH_SIZE", "4"))
+
+
+class GenerationRequest:
+    def __init__(self, prompt_ids, max_new_tokens):
+        self.prompt_ids = prompt_ids
+        self.max_new_tokens = max_new_tokens
+        self.tokens = []
+        self.position = len(prompt_ids)  # posizione del prossimo token nella sequenza
+        self.error = None
+        self.done = threading.Event()
+        # Istanti (perf_counter) di arrivo, di ingresso nel batch e del primo token
+        self.enqueued_at = time.perf_counter()
+        self.admitted_at = None
+        self.first_token_at = None
+
+
+class BatchedGenerator:
+    """Decodifica greedy di più sequenze con una cache KV condivisa.
+
+    Le sequenze del batch sono allineate a destra: ognuna ha davanti delle
+    posizioni vuote (maschera di attenzione a 0) e i propri position_ids. Quando
+    una sequenza entra, cache e maschera vengono riempite a sinistra fino alla
+    stessa lunghezza e concatenate; quando esce, le sue righe vengono rimosse con
+    index_select e le colonne vuote per tutte le sequenze vengono eliminate.
+    """
+
+    def __init__(self, model, max_batch_size, eos_token_ids):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.eos_token_ids = set(eos_token_ids)
+        self.pending = queue.Queue()
+        self.active = []
+        self.cache = None
+        self.attention_mask = None
+        self.lock = threading.Lock()
+        self.worker = None
+        self.stats = {"requests": 0, "steps": 0, "batched_tokens": 0, "generated_tokens": 0, "busy_s": 0.0}
+
+    def generate(self, prompt_ids, max_new_tokens):
+        # Restituisce i token generati (senza il prompt); blocca fino alla fine
+        request = GenerationRequest(prompt_ids, max_new_tokens)
+        self._ensure_worker()
+        self.pending.put(request)
+        request.done.wait()
+        if request.error is not None:
+            REQUESTS.labels("error").inc()
+            raise request.error
+        self._record(request)
+        return request.tokens
 
-except Exception as e:
-    print(f"ERRORE CRITICO durante il caricamento del modello: {e}")
-    # Se il modello non si carica, l'applicazione non può funzionare.
-    model = None
-    tokenizer = None
+    def _record(self, request):
+        # Metriche della richiesta conclusa, calcolate nel thread del chiamante
+        finished = time.perf_counter()
+        completion_tokens = len(request.tokens)
+        decode_s = finished - request.first_token_at
+        REQUESTS.labels("completed").inc()
+        QUEUE_WAIT_SECONDS.observe(request.admitted_at - request.enqueued_at)
+        FIRST_TOKEN_SECONDS.observe(request.first_token_at - request.admitted_at)
+        GENERATION_SECONDS.observe(finished - request.admitted_at)
+        PROMPT_TOKENS.observe(len(request.prompt_ids))
+        COMPLETION_TOKENS.observe(completion_tokens)
+        if completion_tokens > 1 and decode_s > 0:
+            DECODE_TOKENS_PER_SECOND.observe((completion_tokens - 1) / decode_s)
+
+    def _ensure_worker(self):
+        # Avvio pigro: il thread nasce nel processo che serve le richieste
+        with self.lock:
+            if self.worker is None or not self.worker.is_alive():
+                self.worker = threading.Thread(target=self._run, name="batched-generator", daemon=True)
+                self.worker.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._admit(block=not self.active)
+                if self.active:
+                    started = time.perf_counter()
+                    with torch.inference_mode():
+                        self._step()
+                    self.stats["busy_s"] += time.perf_counter() - started
+            except Exception as e:
+                print(f"Errore durante la generazione in batch: {e}")
+                for request in self.active:
+                    request.error = e
+                    request.done.set()
+                self.active, self.cache, self.attention_mask = [], None, None
+
+    def _admit(self, block):
+        # Aggiunge al batch le richieste in attesa, finché c'è posto
+        while len(self.active) < self.max_batch_size:
+            try:
+                request = self.pending.get(block=block)
+            except queue.Empty:
+                return
+            block = False
+            try:
+                started = time.perf_counter()
+                request.admitted_at = started
+                with torch.inference_mode():
+                    self._prefill(request)
+                self.stats["busy_s"] += time.perf_counter() - started
+            except Exception as e:
+                request.error = e
+                request.done.set()
+
+    def _prefill(self, request):
+        self.stats["requests"] += 1
+        input_ids = torch.tensor([request.prompt_ids])
+        cache = DynamicCache()
+        outputs = self.model(
+            input_ids=input_ids, attention_mask=torch.ones_like(input_ids), past_key_values=cache, use_cache=True
+        )
+        if self._accept(request, int(outputs.logits[0, -1].argmax())):
+            return
+        self._join(request, cache_layers(outputs.past_key_values), torch.ones_like(input_ids))
+
+    def _accept(self, request, token):
+        # Registra il token generato; True se la richiesta è terminata
+        request.tokens.append(token)
+        if request.first_token_at is None:
+            request.first_token_at = time.perf_counter()
+        self.stats["generated_tokens"] += 1
+        if token in self.eos_token_ids or len(request.tokens) >= request.max_new_tokens:
+            request.done.set()
+            return True
+        return False
+
+    def _join(self, request, layers, attention_mask):
+        if self.active:
+            batch_layers = cache_layers(self.cache)
+            length = max(self.attention_mask.shape[1], attention_mask.shape[1])
+            layers = [
+                (torch.cat([left_pad(bk, length), left_pad(k, length)]), torch.cat([left_pad(bv, length), left_pad(v, length)]))
+                for (bk, bv), (k, v) in zip(batch_layers, layers)
+            ]
+            attention_mask = torch.cat([left_pad(self.attention_mask, length), left_pad(attention_mask, length)])
+        self.cache = build_cache(layers)
+        self.attention_mask = attention_mask
+        self.active.append(request)
+
+    def _step(self):
+        input_ids = torch.tensor([[request.tokens[-1]] for request in self.active])
+        position_ids = torch.tensor([[request.position] for request in self.active])
+        self.attention_mask = torch.cat([self.attention_mask, torch.ones_like(input_ids)], dim=1)
+        outputs = self.model(
+            input_ids=input_ids, attention_mask=self.attention_mask, position_ids=position_ids,
+            past_key_values=self.cache, use_cache=True
+        )
+        self.cache = outputs.past_key_values
+        self.stats["steps"] += 1
+        self.stats["batched_tokens"] += len(self.active)
+        BATCH_SIZE.observe(len(self.active))
+
+        keep = []
+        for i, (request, token) in enumerate(zip(self.active, outputs.logits[:, -1].argmax(dim=-1).tolist())):
+            request.position += 1
+            if not self._accept(request, token):
+                keep.append(i)
+        if len(keep) < len(self.active):
+            self._leave(keep)
+
+    def _leave(self, keep):
+        self.active = [self.active[i] for i in keep]
+        if not self.active:
+            self.cache, self.attention_mask = None, None
+            return
+        index = torch.tensor(keep)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # Le colonne iniziali vuote per tutte le sequenze rimaste non servono più
+        first = int(attention_mask.any(dim=0).nonzero()[0])
+        self.attention_mask = attention_mask[:, first:]
+        self.cache = build_cache([
+            (k.index_select(0, index)[:, :, first:], v.index_select(0, index)[:, :, first:])
+            for k, v in cache_layers(self.cache)
+        ])
+
+    def snapshot(self):
+        stats = dict(self.stats, active=len(self.active), queued=self.pending.qsize(), max_batch_size=self.max_batch_size)
+        stats["avg_batch_size"] = round(stats["batched_tokens"] / stats["steps"], 2) if stats["steps"] else None
+        stats["tokens_per_s"] = round(stats["generated_tokens"] / stats["busy_s"], 2) if stats["busy_s"] else None
+        stats["busy_s"] = round(stats["busy_s"], 2)
+        return stats
+
+
+def cache_layers(cache):
+    # Tensori (chiavi, valori) di ogni layer, di forma [batch, teste, token, dimensione]
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    return list(zip(cache.key_cache, cache.value_cache))
+
+
+def build_cache(layers):
+    # Cache senza finestra scorrevole: tutti i layer conservano l'intera sequenza,
+    # così hanno la stessa lunghezza e possono essere riallineati insieme
+    cache = DynamicCache()
+    for layer_idx, (keys, values) in enumerate(layers):
+        cache.update(keys, values, layer_idx)
+    return cache
+
+
+def left_pad(tensor, length):
+    # Riempie a sinistra con zeri la dimensione dei token (la 2 per la cache, la 1 per la maschera)
+    dim = 2 if tensor.dim() == 4 else 1
+    missing = length - tensor.shape[dim]
+    if missing == 0:
+        return tensor
+    shape = list(tensor.shape)
+    shape[dim] = missing
+    return torch.cat([tensor.new_zeros(shape), tensor], dim=dim)
+
+
+def eos_token_ids(model, tokenizer):
+    eos = model.generation_config.eos_token_id
+    eos = eos if isinstance(eos, (list, tuple)) else [eos]
+    return [token for token in eos if token is not None] or [tokenizer.eos_token_id]
+
+
+generator = BatchedGenerator(model, MAIN_MAX_BATCH_SIZE, eos_token_ids(model, tokenizer)) if model is not None else None
+if generator is not None:
+    Gauge("llm_queue_depth", "Richieste in attesa di entrare nel batch").set_function(generator.pending.qsize)
 
 # -----------------------------------------------------------------------------
-# 3. DEFINIZIONE DELL'ENDPOINT API
+# 4. DEFINIZIONE DELL'ENDPOINT API
 # -----------------------------------------------------------------------------
 @app.route('/generate', methods=['POST'])
 def generate_text():
@@ -62,38 +426,164 @@ def generate_text():
         return jsonify({"error": "Prompt non fornito nel corpo della richiesta."}), 400
 
     prompt = json_data['prompt']
-    
+
     try:
         # Prepariamo l'input per il modello nel formato di chat richiesto da Gemma
         chat = [
             { "role": "user", "content": prompt },
         ]
         input_text = tokenizer.apply_chat_template(chat, tokenize=False, add_generation_prompt=True)
-        
-        # Convertiamo il testo in token (numeri) e li spostiamo sulla CPU
-        input_ids = tokenizer(input_text, return_tensors="pt").to("cpu")
-
-        # Generiamo la risposta usando il modello, limitando la lunghezza
-        outputs = model.generate(**input_ids, max_new_tokens=250)
-        
-        # Riconvertiamo i token di output in testo leggibile
-        response_text = tokenizer.decode(outputs[0], skip_special_tokens=True)
-        
-        # Puliamo la risposta per restituire solo il testo generato dal modello,
-        # rimuovendo il prompt iniziale che viene incluso nell'output.
-        cleaned_response = response_text[len(input_text):].strip()
+
+        # Convertiamo il testo in token (numeri)
+        input_ids = tokenizer(input_text)["input_ids"]
+
+        # Generiamo la risposta nel batch condiviso con le altre richieste, limitando la lunghezza
+        request_started = time.perf_counter()
+        output_ids = generator.generate(input_ids, MAIN_MAX_NEW_TOKENS)
+        print(f"[{g.request_id}] Generazione: {len(input_ids)} token di prompt, {len(output_ids)} token generati "
+              f"in {time.perf_counter() - request_started:.2f}s.")
+
+        # Riconvertiamo in testo leggibile solo i token generati, senza il prompt
+        cleaned_response = tokenizer.decode(output_ids, skip_special_tokens=True).strip()
 
         # Restituiamo la risposta in formato JSON leggibile
         return jsonify({"response": cleaned_response})
 
     except Exception as e:
-        print(f"Errore durante la generazione del testo: {e}")
+        print(f"[{g.request_id}] Errore durante la generazione del testo: {e}")
         return jsonify({"error": "Errore interno del server durante la generazione del testo."}), 500
 
+@app.route('/engine-stats', methods=['GET'])
+def engine_stats():
+    # Dimensione media del batch e token/s aggregati del motore di generazione
+    if generator is None:
+        return jsonify({"error": "Modello non disponibile a causa di un errore di caricamento."}), 503
+    return jsonify(generator.snapshot())
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    # Metriche Prometheus (con PROMETHEUS_MULTIPROC_DIR si aggregano più processi)
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+# -----------------------------------------------------------------------------
+# 5. BENCHMARK DELLE MODALITÀ DI INFERENZA
+#
+#    python main.py --benchmark [--modes fp32,bf16,int8] [--compile]
+#                   [--prompt-tokens 256] [--new-tokens 64] [--concurrency 4]
+#                   [--output risultati.json]
+#
+#    Ogni modalità viene misurata in un processo separato, così memoria e tempi di
+#    caricamento non sono influenzati dalle modalità precedenti.
+# -----------------------------------------------------------------------------
+def benchmark_mode(precision, compile_model, prompt_tokens, new_tokens, concurrency):
+    # Misure di una singola modalità (eseguito nel processo figlio)
+    started = time.perf_counter()
+    tok, mdl, precision = load_model(precision, compile_model)
+    load_s = time.perf_counter() - started
+    rss_after_load, _ = rss_mb()
+
+    warmup(tok, mdl)
+    # Prompt sintetico della lunghezza richiesta
+    input_ids = torch.randint(1000, 20000, (1, prompt_tokens))
+    attention_mask = torch.ones_like(input_ids)
+
+    with torch.inference_mode():
+        # Prefill: un solo forward su tutto il prompt
+        started = time.perf_counter()
+        mdl(input_ids=input_ids, attention_mask=attention_mask, use_cache=True)
+        prefill_s = time.perf_counter() - started
+
+        # Generazione completa: il tempo oltre il prefill è la decodifica
+        started = time.perf_counter()
+        mdl.generate(
+            input_ids=input_ids, attention_mask=attention_mask, do_sample=False,
+            min_new_tokens=new_tokens, max_new_tokens=new_tokens
+        )
+        decode_s = max(time.perf_counter() - started - prefill_s, 1e-9)
+
+    # Throughput aggregato con più richieste contemporanee nel motore a batching continuo
+    # (nessun token di fine, così ogni richiesta genera esattamente new_tokens token)
+    batched = BatchedGenerator(mdl, concurrency, eos_token_ids=[])
+    prompts = [torch.randint(1000, 20000, (prompt_tokens,)).tolist() for _ in range(concurrency)]
+    workers = [threading.Thread(target=batched.generate, args=(prompt, new_tokens)) for prompt in prompts]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    batched_s = time.perf_counter() - started
+
+    _, peak_rss = rss_mb()
+    return {
+        "mode": precision + ("+compile" if compile_model else ""),
+        "threads": torch.get_num_threads(),
+        "load_s": round(load_s, 2),
+        "rss_after_load_mb": rss_after_load,
+        "peak_rss_mb": peak_rss,
+        "prefill_tokens_per_s": round(prompt_tokens / prefill_s, 1),
+        "decode_tokens_per_s": round(new_tokens / decode_s, 2),
+        "concurrency": concurrency,
+        "batched_tokens_per_s": round(concurrency * new_tokens / batched_s, 2),
+    }
+
+
+def run_benchmark(args):
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark delle modalità di inferenza su CPU")
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("--modes", default=",".join(PRECISIONS))
+    parser.add_argument("--compile", action="store_true", help="misura anche ogni modalità con torch.compile")
+    parser.add_argument("--prompt-tokens", type=int, default=256)
+    parser.add_argument("--new-tokens", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=MAIN_MAX_BATCH_SIZE, help="richieste contemporanee nel test a batching continuo")
+    parser.add_argument("--output", help="file JSON in cui salvare i risultati")
+    options = parser.parse_args(args)
+
+    runs = [(mode, False) for mode in options.modes.split(",")]
+    if options.compile:
+        runs += [(mode, True) for mode in options.modes.split(",")]
+
+    results = []
+    for precision, compile_model in runs:
+        print(f"Benchmark della modalità {precision}{' +compile' if compile_model else ''}...")
+        worker = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--benchmark-worker",
+             json.dumps([precision, compile_model, options.prompt_tokens, options.new_tokens, options.concurrency])],
+            capture_output=True, text=True
+        )
+        lines = [line for line in worker.stdout.splitlines() if line.startswith("{")]
+        if worker.returncode != 0 or not lines:
+            error = (worker.stderr.strip().splitlines() or ["errore sconosciuto"])[-1]
+            print(f"  non riuscito: {error}")
+            results.append({"mode": precision + ("+compile" if compile_model else ""), "error": error})
+            continue
+        results.append(json.loads(lines[-1]))
+        print(f"  {results[-1]}")
+
+    print(f"\n{'modalità':<16}{'load s':>8}{'RSS MB':>9}{'picco MB':>10}{'prefill tok/s':>15}{'decode tok/s':>14}{'batch tok/s':>13}")
+    for result in results:
+        if "error" in result:
+            print(f"{result['mode']:<16}  errore: {result['error']}")
+            continue
+        print(f"{result['mode']:<16}{result['load_s']:>8}{result['rss_after_load_mb']:>9}{result['peak_rss_mb']:>10}"
+              f"{result['prefill_tokens_per_s']:>15}{result['decode_tokens_per_s']:>14}{result['batched_tokens_per_s']:>13}")
+    if options.output:
+        with open(options.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
 # -----------------------------------------------------------------------------
-# 4. AVVIO DEL SERVER (usato solo per test locali con 'python app.py')
+# 6. AVVIO DEL SERVER (usato solo per test locali con 'python app.py')
 # -----------------------------------------------------------------------------
 if __name__ == '__main__':
-    # Avviamo il server Flask sulla porta 8080, accessibile da tutta la rete
-    # In produzione su OpenShift, questo blocco non viene eseguito; si usa Gunicorn.
-    app.run(host='0.0.0.0', port=8080)
\ No newline at end of file
+    if BENCHMARK_RUN and sys.argv[1] == "--benchmark-worker":
+        print(json.dumps(benchmark_mode(*json.loads(sys.argv[2]))))
+    elif BENCHMARK_RUN:
+        run_benchmark(sys.argv[1:])
+    else:
+        # Avviamo il server Flask sulla porta 8080, accessibile da tutta la rete
+        # In produzione su OpenShift, questo blocco non viene eseguito; si usa Gunicorn.
+        app.run(host='0.0.0.0', port=8080)